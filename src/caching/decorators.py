@@ -13,11 +13,8 @@
 #
 # Open vStorage is distributed in the hope that it will be useful,
 # but WITHOUT ANY WARRANTY of any kind.
-import os
 from functools import wraps
-
-
-_files_cache = {}
+from ovs_extensions.caching.filememoizer import FileMemoizer
 
 
 class FileCache(object):
@@ -51,43 +48,33 @@ class FileCache(object):
         return not self.__eq__(other)
 
 
-def cache_file(path):
-    # type: (str) -> callable
+def cache_file(path, max_entries=128, stat_interval=0, watch=False):
+    # type: (Union[str, List[str]], int, int, bool) -> callable
     """
-    The result of the decorated function is tied to a file
-    This means that the result of the function should be based of the file that is specified
+    The result of the decorated function is tied to a file (or multiple files)
+    This means that the result of the function should be based of the file(s) that is specified
     On evaluation either:
-    - Returns the result of the decorated function if it runs for the first time or the file has changed
+    - Returns the result of the decorated function if it runs for the first time with the given arguments or a file has changed
         or
-    - Returns the previous result if the file did not change
-    :param path: Path to the file
-    :type path: str
+    - Returns the previous result for the given arguments if the file(s) did not change
+    The underlying FileMemoizer is exposed as the `cache` attribute of the decorated function
+    :param path: Path to the file or list of paths to files
+    :type path: str or list
+    :param max_entries: Maximum amount of results (for different arguments) to keep
+    :type max_entries: int
+    :param stat_interval: Amount of milliseconds during which a file is not verified again. See FileMemoizer
+    :type stat_interval: int
+    :param watch: Watch the file(s) through inotify instead of verifying them on every call. See FileMemoizer
+    :type watch: bool
     """
-    def is_cache_valid():
-        # type: () -> bool
-        """
-        Determine if the cache is still valid
-        :return: True if the cache is still valid else false
-        :rtype: bool
-        """
-        if path in _files_cache:
-            file_cache = _files_cache[path]  # type: FileCache
-            return file_cache.mtime == os.path.getmtime(path)
-        return False
-
     def decorator(f):
         # type: (callable) -> callable
+        memoizer = FileMemoizer(path, max_entries=max_entries, stat_interval=stat_interval, watch=watch)
+
         @wraps(f)
         def return_cache(*args, **kwargs):
             # type: (*any, **any) -> any
-            if path in _files_cache and is_cache_valid():
-                file_cache = _files_cache[path]  # type: FileCache
-                return file_cache.contents
-            else:
-                # Store to cache
-                contents = f(*args, **kwargs)
-                file_cache = FileCache(path, os.path.getmtime(path), contents)
-                _files_cache[path] = file_cache
-                return file_cache.contents
+            return memoizer.get(f, *args, **kwargs)
+        return_cache.cache = memoizer
         return return_cache
     return decorator
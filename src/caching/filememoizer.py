@@ -0,0 +1,210 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+File backed memoization module
+"""
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from ovs_extensions.caching.filewatcher import InotifyWatcher
+
+
+class FileMemoizer(object):
+    """
+    Memoizes results which are derived from the contents of one or more files.
+    The results are keyed on the (hashable) arguments they were computed for and are tied to the state of the files:
+    a result is only returned as long as none of the files changed since the result was computed.
+    The state of a file is identified by a single `os.stat` call (mtime, size and inode). Optionally, the state of a file
+    is only verified once per `stat_interval` milliseconds. At most `max_entries` results are kept, the least recently
+    used results are evicted first.
+    Alternatively, the files can be watched through inotify. Results are then invalidated by the background thread of
+    the InotifyWatcher and returning a memoized result does not require any system call. Note that changes are then
+    picked up asynchronously, shortly after they happened. When inotify is not available,
+    or the files cannot be watched, the memoizer falls back to verifying the state of the files.
+    """
+
+    def __init__(self, paths, max_entries=128, stat_interval=0, watch=False):
+        # type: (Union[str, List[str]], int, int, bool) -> None
+        """
+        Initializes a new FileMemoizer
+        :param paths: Path or paths of the files the results depend on
+        :type paths: str or list
+        :param max_entries: Maximum amount of results to keep
+        :type max_entries: int
+        :param stat_interval: Amount of milliseconds during which the state of a file is not verified again. 0 to verify on every call
+        :type stat_interval: int
+        :param watch: Watch the files through inotify instead of verifying their state
+        :type watch: bool
+        """
+        self.paths = [paths] if isinstance(paths, basestring) else list(paths)
+        self.max_entries = max_entries
+        self.stat_interval = stat_interval / 1000.0
+
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._states = {}
+        self._watch = watch
+        self._watcher = None
+        self._watch_attempt = None
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_file_state(path):
+        # type: (str) -> Optional[tuple]
+        """
+        Returns the state of a file: its modification time, size and inode
+        :param path: Path to the file
+        :type path: str
+        :return: The state of the file or None when the file does not exist
+        :rtype: tuple
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size, stat.st_ino
+
+    def _get_states(self):
+        # type: () -> tuple
+        """
+        Returns the current states of all files, verifying them at most once per stat interval
+        :return: The states, in the order of the paths. When the files are watched, a counter of the changes
+        :rtype: tuple
+        """
+        if self._watch is True:
+            watcher = self._watcher
+            if watcher is None or not watcher.is_alive():
+                watcher = self._start_watching()
+            if watcher is not None:
+                return self._generation
+        if self.stat_interval <= 0:
+            return tuple(self.get_file_state(path) for path in self.paths)
+        now = time.time()
+        states = []
+        for path in self.paths:
+            state, checked_at = self._states.get(path, (None, None))
+            if checked_at is None or now - checked_at >= self.stat_interval:
+                state = self.get_file_state(path)
+                self._states[path] = (state, now)
+            states.append(state)
+        return tuple(states)
+
+    def _start_watching(self):
+        # type: () -> Optional[InotifyWatcher]
+        """
+        Registers the files with the InotifyWatcher of the current process. This is only attempted once per watcher
+        :return: The watcher or None when the files could not be watched
+        :rtype: InotifyWatcher
+        """
+        with self._lock:
+            if self._watcher is not None and self._watcher.is_alive():
+                return self._watcher
+            watcher = InotifyWatcher.get_instance()
+            if watcher is None or watcher is self._watch_attempt:
+                return None
+            self._watch_attempt = watcher
+            watched = []
+            for path in self.paths:
+                if watcher.watch(path, self._on_change) is False:
+                    for watched_path in watched:
+                        watcher.unwatch(watched_path, self._on_change)
+                    return None
+                watched.append(path)
+            self._generation += 1
+            self._watcher = watcher
+            return watcher
+
+    def _on_change(self, lost=False):
+        # type: (bool) -> None
+        """
+        Called by the InotifyWatcher when a file changed
+        :param lost: The files are no longer watched
+        :type lost: bool
+        :return: None
+        """
+        with self._lock:
+            self._generation += 1
+            if lost is True and self._watcher is not None:
+                watcher = self._watcher
+                self._watcher = None
+                for path in self.paths:
+                    watcher.unwatch(path, self._on_change)
+
+    def get(self, function, *args, **kwargs):
+        # type: (callable, *any, **any) -> any
+        """
+        Returns the memoized result of the given function for the given arguments, or computes it when the files changed.
+        Results for unhashable arguments are never memoized
+        :param function: Function computing the result
+        :type function: callable
+        :return: The result of the function
+        """
+        key = (args, tuple(sorted(kwargs.iteritems())))
+        try:
+            hash(key)
+        except TypeError:
+            with self._lock:
+                self.misses += 1
+            return function(*args, **kwargs)
+
+        states = self._get_states()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] == states:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # The states are gathered before computing, so changes during the computation invalidate the result
+        result = function(*args, **kwargs)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (states, result)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def invalidate(self):
+        # type: () -> None
+        """
+        Discards all memoized results
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self._states.clear()
+            self._generation += 1
+
+    def get_stats(self):
+        # type: () -> dict
+        """
+        Returns the statistics of this memoizer
+        :return: The amount of hits, misses, evictions and currently memoized results
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries)}
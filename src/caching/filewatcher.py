@@ -0,0 +1,232 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Inotify based file watching module
+"""
+import os
+import errno
+import ctypes
+import ctypes.util
+import struct
+import logging
+from threading import Lock, Thread
+
+
+class InotifyWatcher(object):
+    """
+    Watches files for changes using Linux inotify. All watches are served by a single background thread.
+    The parent directories of the files are watched rather than the files themselves, so files which are replaced
+    (e.g. through an atomic rename) or re-created keep being watched.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    _logger = logging.getLogger(__name__)
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self):
+        # type: () -> None
+        """
+        Initializes a new InotifyWatcher and starts its background thread
+        :raises OSError: When inotify is not available
+        """
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(InotifyWatcher.IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._lock = Lock()
+        self._directories = {}  # Watch descriptor -> directory
+        self._descriptors = {}  # Directory -> watch descriptor
+        self._callbacks = {}  # Directory -> {file name: [callbacks]}
+        self._thread = Thread(target=self._run, name='inotify-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def get_instance(cls):
+        # type: () -> Optional[InotifyWatcher]
+        """
+        Returns the watcher of the current process. Threads do not survive a fork, so a new watcher is started when the
+        watcher was inherited from the parent process
+        :return: The watcher, or None when inotify is not available
+        :rtype: InotifyWatcher
+        """
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance.is_alive():
+                try:
+                    cls._instance = InotifyWatcher()
+                except (OSError, AttributeError):
+                    cls._logger.warning('Inotify is not available, falling back to polling')
+                    cls._instance = None
+            return cls._instance
+
+    def is_alive(self):
+        # type: () -> bool
+        """
+        Returns whether the watcher is still delivering events
+        :return: True when events are still delivered
+        :rtype: bool
+        """
+        return self._thread.is_alive()
+
+    def watch(self, path, callback):
+        # type: (str, callable) -> bool
+        """
+        Starts watching a file. The callback is called without arguments when the file changes, is created, replaced or
+        removed. When the watch is lost (e.g. the parent directory is removed), the callback is called once more with
+        `lost=True` and is not called anymore afterwards
+        :param path: Path of the file to watch
+        :type path: str
+        :param callback: Callback to call on changes
+        :type callback: callable
+        :return: True when the file is being watched, False when the watch could not be set up (e.g. the parent
+        directory does not exist or the limit of inotify watches is reached)
+        :rtype: bool
+        """
+        directory, name = os.path.split(os.path.abspath(path))
+        with self._lock:
+            if directory not in self._descriptors:
+                descriptor = self._libc.inotify_add_watch(self._fd, directory, InotifyWatcher.WATCH_MASK)
+                if descriptor < 0:
+                    self._logger.warning('Could not watch {0}: {1}'.format(directory, os.strerror(ctypes.get_errno())))
+                    return False
+                self._directories[descriptor] = directory
+                self._descriptors[directory] = descriptor
+                self._callbacks[directory] = {}
+            self._callbacks[directory].setdefault(name, []).append(callback)
+        return True
+
+    def unwatch(self, path, callback):
+        # type: (str, callable) -> None
+        """
+        Stops calling the given callback for changes of the given file
+        :param path: Path of the watched file
+        :type path: str
+        :param callback: The callback that was passed to `watch`
+        :type callback: callable
+        :return: None
+        """
+        directory, name = os.path.split(os.path.abspath(path))
+        with self._lock:
+            callbacks = self._callbacks.get(directory, {}).get(name, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if len(callbacks) == 0:
+                self._callbacks.get(directory, {}).pop(name, None)
+            if directory in self._descriptors and len(self._callbacks[directory]) == 0:
+                descriptor = self._descriptors.pop(directory)
+                self._directories.pop(descriptor)
+                self._callbacks.pop(directory)
+                self._libc.inotify_rm_watch(self._fd, descriptor)
+
+    def _run(self):
+        # type: () -> None
+        """
+        Reads and dispatches the inotify events
+        :return: None
+        """
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                self._logger.exception('Reading inotify events failed')
+                self._lose_all()
+                return
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, _, length = InotifyWatcher.EVENT_HEADER.unpack_from(data, offset)
+                offset += InotifyWatcher.EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                try:
+                    self._dispatch(descriptor, mask, name)
+                except Exception:
+                    self._logger.exception('Dispatching inotify event failed')
+
+    def _dispatch(self, descriptor, mask, name):
+        # type: (int, int, str) -> None
+        """
+        Calls the callbacks for a single inotify event
+        :param descriptor: The watch descriptor
+        :type descriptor: int
+        :param mask: The event mask
+        :type mask: int
+        :param name: Name of the file within the watched directory, if any
+        :type name: str
+        :return: None
+        """
+        if mask & InotifyWatcher.IN_Q_OVERFLOW:
+            # Events were dropped, so every watched file might have changed
+            with self._lock:
+                callbacks = [callback for entries in self._callbacks.itervalues() for callback_list in entries.itervalues() for callback in callback_list]
+            for callback in callbacks:
+                callback()
+            return
+        lost = mask & (InotifyWatcher.IN_DELETE_SELF | InotifyWatcher.IN_MOVE_SELF | InotifyWatcher.IN_IGNORED) != 0
+        with self._lock:
+            directory = self._directories.get(descriptor)
+            if directory is None:
+                return
+            if lost is True:
+                entries = self._callbacks.pop(directory)
+                self._descriptors.pop(directory)
+                self._directories.pop(descriptor)
+                if not mask & InotifyWatcher.IN_IGNORED:
+                    self._libc.inotify_rm_watch(self._fd, descriptor)
+                callbacks = [callback for callback_list in entries.itervalues() for callback in callback_list]
+            else:
+                callbacks = list(self._callbacks[directory].get(name, []))
+        for callback in callbacks:
+            if lost is True:
+                callback(lost=True)
+            else:
+                callback()
+
+    def _lose_all(self):
+        # type: () -> None
+        """
+        Drops all watches, notifying their callbacks
+        :return: None
+        """
+        with self._lock:
+            callbacks = [callback for entries in self._callbacks.itervalues() for callback_list in entries.itervalues() for callback in callback_list]
+            self._callbacks.clear()
+            self._descriptors.clear()
+            self._directories.clear()
+        for callback in callbacks:
+            callback(lost=True)
@@ -0,0 +1,146 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Test module for the file caching
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from ovs_extensions.caching.decorators import cache_file
+from ovs_extensions.caching.filewatcher import InotifyWatcher
+
+
+class FileCacheTest(unittest.TestCase):
+    """
+    Test the file backed memoization
+    """
+
+    def setUp(self):
+        """
+        Creates the files to cache
+        """
+        self._folder = tempfile.mkdtemp()
+        self._paths = [os.path.join(self._folder, name) for name in ['first', 'second']]
+        for path in self._paths:
+            self._write(path, 'foo')
+
+    def tearDown(self):
+        """
+        Removes the cached files
+        """
+        shutil.rmtree(self._folder)
+
+    @staticmethod
+    def _write(path, contents, rename=False):
+        """
+        Writes a file, optionally through an atomic rename
+        """
+        target = '{0}.tmp'.format(path) if rename is True else path
+        with open(target, 'w') as the_file:
+            the_file.write(contents)
+        if rename is True:
+            os.rename(target, path)
+
+    def test_cache_file(self):
+        """
+        Validates the results are cached per argument and are invalidated when one of the files changes
+        """
+        calls = []
+
+        @cache_file(self._paths, max_entries=2)
+        def _read(suffix):
+            calls.append(suffix)
+            return ''.join(open(path).read() for path in self._paths) + ''.join(suffix)
+
+        self.assertEqual(_read('a'), 'foofooa')
+        self.assertEqual(_read('b'), 'foofoob')
+        self.assertEqual(_read('a'), 'foofooa')
+        self.assertEqual(calls, ['a', 'b'])
+
+        self._write(self._paths[1], 'bar', rename=True)
+        self.assertEqual(_read('a'), 'foobara')
+        self._write(self._paths[0], 'barbar')  # Size changes
+        self.assertEqual(_read('a'), 'barbarbara')
+        self.assertEqual(calls, ['a', 'b', 'a', 'a'])
+
+        _read('b')
+        _read('c')  # Evicts 'a'
+        _read('a')
+        self.assertEqual(_read.cache.get_stats(), {'hits': 1, 'misses': 7, 'evictions': 2, 'entries': 2})
+        self.assertEqual(_read(['d']), 'barbarbard')  # Unhashable arguments are not cached
+        self.assertEqual(_read.cache.get_stats()['entries'], 2)
+
+    def test_stat_interval(self):
+        """
+        Validates that files are only verified once per stat interval
+        """
+        @cache_file(self._paths[0], stat_interval=200)
+        def _read():
+            return open(self._paths[0]).read()
+
+        self.assertEqual(_read(), 'foo')
+        self._write(self._paths[0], 'foobar')
+        self.assertEqual(_read(), 'foo')
+        time.sleep(0.25)
+        self.assertEqual(_read(), 'foobar')
+
+    @unittest.skipIf(InotifyWatcher.get_instance() is None, 'Inotify is not available')
+    def test_watch(self):
+        """
+        Validates the invalidation through inotify, and the fallback to verifying the files when they can't be watched
+        """
+        def _wait_for(function, expected):
+            for _ in xrange(100):
+                if function() == expected:
+                    return
+                time.sleep(0.02)
+            self.assertEqual(function(), expected)
+
+        @cache_file(self._paths[0], watch=True)
+        def _read():
+            return open(self._paths[0]).read()
+
+        self.assertEqual(_read(), 'foo')
+        self.assertIsNotNone(_read.cache._watcher)
+        stat = os.stat
+        os.stat = None  # Memoized results are returned without verifying the file
+        try:
+            self.assertEqual(_read(), 'foo')
+        finally:
+            os.stat = stat
+        self._write(self._paths[0], 'bar')
+        _wait_for(_read, 'bar')
+        self._write(self._paths[0], 'baz', rename=True)
+        _wait_for(_read, 'baz')
+        os.remove(self._paths[0])
+        self._write(self._paths[0], 'foobar')
+        _wait_for(_read, 'foobar')
+
+        missing = os.path.join(self._folder, 'missing', 'file')
+
+        @cache_file(missing, watch=True)
+        def _read_missing():
+            return open(missing).read() if os.path.exists(missing) else None
+
+        self.assertIsNone(_read_missing())
+        self.assertIsNone(_read_missing.cache._watcher)
+        os.mkdir(os.path.dirname(missing))
+        self._write(missing, 'foo')
+        self.assertEqual(_read_missing(), 'foo')
@@ -27,5 +27,6 @@ OVS_CONFIG = os.path.join(os.path.sep, 'opt', 'OpenvStorage', 'config')
 CACC_LOCATION = os.path.join(OVS_CONFIG, 'arakoon_cacc.ini')                                # /opt/OpenvStorage/config/arakoon_cacc.ini
 CONFIG_STORE_LOCATION = os.path.join(OVS_CONFIG, 'framework.json')                          # /opt/OpenvStorage/config/framework.json
 CONFIG_ARAKOON_LOCATION = os.path.join(OVS_CONFIG, 'arakoon_{0}.ini')                       # /opt/OpenvStorage/config/arakoon_{0}.ini
+CONFIG_SNAPSHOT_LOCATION = os.path.join(os.path.sep, 'run', 'ovs', 'configuration.snapshot')    # /run/ovs/configuration.snapshot
 
 COMPONENTS_KEY = os.path.join(os.path.sep, 'ovs', 'machines', '{0}', 'components')                      # /ovs/machines/{0}/components
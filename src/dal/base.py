@@ -18,8 +18,12 @@
 This package contains the DAL object's base class.
 """
 
+import os
 import json
+import hashlib
 import sqlite3
+from contextlib import contextmanager
+from threading import local, RLock
 from ovs_extensions.dal.relations import RelationMapper
 from ovs_extensions.generic.filemutex import file_mutex
 
@@ -29,6 +33,54 @@ class ObjectNotFoundException(Exception):
     pass
 
 
+class _TransactionConnection(object):
+    """
+    Connection handed out by `Base.connector` while a transaction (eg. a unit of work) is ongoing.
+    Using it as a context manager doesn't commit or roll back: the transaction does so when it ends.
+    All other calls are passed on to the underlying SQLite connection.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, item):
+        return getattr(self.connection, item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+# noinspection PyProtectedMember
+class DalObjectType(type):
+    """
+    Metaclass of the DAL objects. It generates the slots holding the property values and relation identifiers, and the
+    relation and dynamic descriptors, once when the class is created instead of on every instantiation.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        if '__slots__' not in attrs:
+            inherited = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    slots = klass.__dict__.get('__slots__', ())
+                    inherited.update([slots] if isinstance(slots, basestring) else slots)
+            names = [prop.name for prop in attrs.get('_properties', [])]
+            for relation in attrs.get('_relations', []):
+                names.extend(['_{0}_id'.format(relation[0]), '_{0}_object'.format(relation[0])])
+            attrs['__slots__'] = tuple(slot for slot in names if slot not in inherited and slot not in attrs)
+        return super(DalObjectType, mcs).__new__(mcs, name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        super(DalObjectType, cls).__init__(name, bases, attrs)
+        for relation in attrs.get('_relations', []):
+            cls._add_relation(relation)
+        for key in attrs.get('_dynamics', []):
+            cls._add_dynamic(key)
+
+
 # noinspection SqlDialectInspection,SqlNoDataSourceInspection,PyTypeChecker,PyProtectedMember
 class Base(object):
     """
@@ -38,14 +90,44 @@ class Base(object):
          removed and replaced by a bump of the timeout time of an SQLite call.
       2. The `ensure_table` function is called at some points in the DAL query. This function does -what's in a name-,
          ensures that the table for given requested object exists in the database, before continuing and performing
-         other actions. Be sure to not unnecessarily call this function however, as it may result in unnecessary DB calls,
-         causing needless stress.
+         other actions. The outcome is registered process-wide per database and table definition, so only the first
+         call for a given schema results in DB calls. Changing constraints of existing columns requires `migrate`.
+         Next to the table, the indexes are created: one for every indexed property, one for every relation and the
+         composite indexes listed in `_indexes` (lists of property and/or relation names).
+      3. Connections are pooled per thread and per database. Re-using the connection keeps SQLite's page cache and the
+         compiled statement cache warm. The connection settings (journal mode, synchronous level, cache and mmap sizes)
+         can be tuned by overruling the corresponding class attributes in the DAL base class of a plugin.
+      4. Property values and relation identifiers are stored in slots, generated by the `DalObjectType` metaclass. Other
+         attributes can still be set on an object, these end up in its (lazily created) `__dict__`. The relation state
+         is still exposed read-only as `_<relation>` (a dict with the `id` and the `object`). As every DAL class has its
+         own slots, a class can inherit from a single DAL class only (mixins without slots are fine).
+      5. The serialized values are remembered when an object is loaded or saved, so saving an object only writes the
+         changed columns, and nothing at all when nothing changed.
+      6. Within a unit of work (`with Base.unit_of_work():`), every object is loaded only once: relations, foreign
+         relations and queries return the instance that was already loaded in that unit of work.
     """
+    __metaclass__ = DalObjectType
+    __slots__ = ('id', '_original', '_prefetched', '__dict__', '__weakref__')
+
     NAME = None
     SOURCE_FOLDER = None
     DATABASE_FOLDER = None
 
+    JOURNAL_MODE = 'WAL'
+    SYNCHRONOUS = 'NORMAL'  # WAL mode is safe from corruption with NORMAL, only the last commits can be lost on power loss
+    CACHE_SIZE = -16384  # Negative values are expressed in KiB
+    MMAP_SIZE = 64 * 1024 * 1024
+    CACHED_STATEMENTS = 256
+
     _table = None
+    _schemas = set()
+    _prepared_classes = set()
+    _schema_hashes = {}
+    _schema_lock = RLock()
+    _update_statements = {}
+    _connections = local()
+    _units_of_work = local()
+    _indexes = []
     _dynamics = []
     _relations = []
     _properties = []
@@ -61,121 +143,439 @@ class Base(object):
         self.id = identifier
         if ensure_table:
             self._ensure_table()
-        with self.connector() as connection:
-            if identifier is not None:
+        if identifier is not None:
+            with self._connection() as connection:
                 cursor = connection.cursor()
                 cursor.execute('SELECT * FROM {0} WHERE id=?'.format(self._table), [self.id])
                 row = cursor.fetchone()
-                if row is None:
-                    raise ObjectNotFoundException()
-                for prop in self._properties:
-                    setattr(self, prop.name, Base._deserialize(prop.property_type, row[prop.name]))
-                for relation in self._relations:
-                    setattr(self, '_{0}'.format(relation[0]), {'id': row['_{0}_id'.format(relation[0])],
-                                                               'object': None})
-            else:
-                for prop in self._properties:
-                    setattr(self, prop.name, None)
-                for relation in self._relations:
-                    setattr(self, '_{0}'.format(relation[0]), {'id': None,
-                                                               'object': None})
+            if row is None:
+                raise ObjectNotFoundException()
+            self._load(row)
+        else:
+            for prop in self._properties:
+                setattr(self, prop.name, None)
+            for relation in self._relations:
+                setattr(self, '_{0}_id'.format(relation[0]), None)
+                setattr(self, '_{0}_object'.format(relation[0]), None)
+        self._add_foreign_relations()
+        identity_map = Base._get_identity_map()
+        if identity_map is not None and identifier is not None:
+            identity_map.setdefault((self.__class__, identifier), self)
+
+    @classmethod
+    @contextmanager
+    def unit_of_work(cls):
+        """
+        Context manager grouping all DAL work of the current thread:
+        * All changes are committed in a single transaction when the unit of work ends, or rolled back on an exception.
+          Note that statements altering the schema (which only happen when a table is used for the first time) commit
+          the work done so far. Statements executed on a connection retrieved through `connector` are part of the unit
+          of work as well: using that connection as a context manager doesn't commit or roll back anything.
+        * Each object is only loaded once: the same instance is shared between all relations and queries loading it.
+          Explicitly constructing an object with its identifier still reloads it from the database.
+        Nested units of work join the outer one.
+        """
+        if Base._get_identity_map() is not None:
+            yield
+            return
+        Base._units_of_work.identity_map = {}
+        try:
+            with Base._transaction():
+                yield
+        finally:
+            Base._units_of_work.identity_map = None
+
+    @staticmethod
+    @contextmanager
+    def _transaction():
+        """
+        Context manager committing all statements executed through `_connection` within the context at once when it
+        ends, or rolling them back on an exception. Nested transactions join the outer one.
+        """
+        if getattr(Base._units_of_work, 'connections', None) is not None:
+            yield
+            return
+        connections = Base._units_of_work.connections = []
+        try:
+            yield
+        except Exception:
+            for connection in connections:
+                connection.rollback()
+            raise
+        else:
+            for connection in connections:
+                connection.commit()
+        finally:
+            Base._units_of_work.connections = None
+
+    @classmethod
+    @contextmanager
+    def _connection(cls):
+        """
+        Context manager yielding the connection to execute statements on. The statements are committed (or rolled back)
+        when leaving the context, unless a transaction is ongoing. Then this happens when the transaction ends.
+        """
+        connection = cls._get_connection()
+        connections = getattr(Base._units_of_work, 'connections', None)
+        if connections is None:
+            with connection:
+                yield connection
+        else:
+            if connection not in connections:
+                connections.append(connection)
+            yield connection
+
+    @staticmethod
+    def _get_identity_map():
+        # type: () -> Optional[dict]
+        """
+        Returns the identity map of the current unit of work, if any
+        :return: Mapping of (class, identifier) to the loaded object, or None when not within a unit of work
+        :rtype: dict
+        """
+        return getattr(Base._units_of_work, 'identity_map', None)
+
+    @classmethod
+    def _get_instance(cls, identifier):
+        """
+        Returns the object with given identifier. Within a unit of work, an already loaded instance is returned
+        :param identifier: Identifier (primary key)
+        :type identifier: int
+        :return: The object
+        """
+        identity_map = Base._get_identity_map()
+        if identity_map is not None and (cls, identifier) in identity_map:
+            return identity_map[(cls, identifier)]
+        return cls(identifier)
+
+    @classmethod
+    def _from_row(cls, row):
+        """
+        Builds an object from a complete table row, without querying the database.
+        Within a unit of work, an already loaded instance is returned as is.
+        Classes overruling `__init__` are built through their constructor instead (which loads the object again), as
+        building the object from the row would skip any additional state set up by that constructor
+        :param row: The row (all columns of the object's table)
+        :type row: sqlite3.Row
+        :return: The object
+        """
+        identity_map = Base._get_identity_map()
+        if identity_map is not None and (cls, row['id']) in identity_map:
+            return identity_map[(cls, row['id'])]
+        if cls.__init__.__func__ is not Base.__init__.__func__:
+            return cls(row['id'], ensure_table=False)
+        instance = cls.__new__(cls)
+        instance.id = row['id']
+        instance._load(row)
+        cls._add_foreign_relations()
+        if identity_map is not None:
+            identity_map[(cls, instance.id)] = instance
+        return instance
+
+    def _load(self, row):
+        """ Loads the properties and relations from a table row. """
+        original = []
+        for prop in self._properties:
+            original.append(row[prop.name])
+            setattr(self, prop.name, Base._deserialize(prop.property_type, row[prop.name]))
         for relation in self._relations:
-            self._add_relation(relation)
-        for key, relation_info in RelationMapper.load_foreign_relations(self.__class__).iteritems():
-            self._add_foreign_relation(key, relation_info)
-        for key in self._dynamics:
-            self._add_dynamic(key)
+            original.append(row['_{0}_id'.format(relation[0])])
+            setattr(self, '_{0}_id'.format(relation[0]), original[-1])
+            setattr(self, '_{0}_object'.format(relation[0]), None)
+        self._original = original
+
+    @classmethod
+    def _add_foreign_relations(cls):
+        """
+        Generates the foreign relations on a class. These can only be resolved once all DAL objects can be loaded,
+        so this happens when the first object of the class is instantiated
+        """
+        if cls in Base._prepared_classes:
+            return
+        for key, relation_info in RelationMapper.load_foreign_relations(cls).iteritems():
+            cls._add_foreign_relation(key, relation_info)
+        Base._prepared_classes.add(cls)
 
     @classmethod
     def connector(cls):
-        """ Creates and returns a new connection to SQLite. """
-        connection = sqlite3.connect('{0}/main.db'.format(cls.DATABASE_FOLDER), timeout=60.0)
-        connection.row_factory = sqlite3.Row
+        """
+        Returns the connection to SQLite for the current thread. The connection is created the first time the database
+        is accessed from a thread and is re-used afterwards. Using the connection as a context manager still commits
+        (or rolls back) the work done within that block, unless a transaction (eg. a unit of work) is ongoing: the
+        connection then joins that transaction and is committed (or rolled back) when the transaction ends.
+        :return: The SQLite connection
+        :rtype: sqlite3.Connection
+        """
+        connection = cls._get_connection()
+        connections = getattr(Base._units_of_work, 'connections', None)
+        if connections is None:
+            return connection
+        if connection not in connections:
+            connections.append(connection)
+        return _TransactionConnection(connection)
+
+    @classmethod
+    def _get_connection(cls):
+        """
+        Returns the pooled connection to SQLite for the current thread, creating it if needed
+        :return: The SQLite connection
+        :rtype: sqlite3.Connection
+        """
+        database = '{0}/main.db'.format(cls.DATABASE_FOLDER)
+        connections = Base._get_connections()
+        connection = connections.get(database)
+        if connection is None:
+            connection = sqlite3.connect(database, timeout=60.0, cached_statements=cls.CACHED_STATEMENTS)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode={0}'.format(cls.JOURNAL_MODE))
+            connection.execute('PRAGMA synchronous={0}'.format(cls.SYNCHRONOUS))
+            connection.execute('PRAGMA cache_size={0}'.format(cls.CACHE_SIZE))
+            connection.execute('PRAGMA mmap_size={0}'.format(cls.MMAP_SIZE))
+            connections[database] = connection
         return connection
 
-    def _add_dynamic(self, key):
-        """ Generates a new dynamic value on an object. """
-        setattr(self.__class__, key, property(lambda s: getattr(s, '_{0}'.format(key))()))
+    @staticmethod
+    def _get_connections():
+        # type: () -> dict
+        """
+        Returns the connections of the current thread, keyed by database path.
+        Connections inherited from a parent process are never re-used as SQLite connections cannot be shared over a fork
+        :return: Mapping of database path to connection
+        :rtype: dict
+        """
+        pid = os.getpid()
+        if getattr(Base._connections, 'pid', None) != pid:
+            Base._connections.pid = pid
+            Base._connections.connections = {}
+        return Base._connections.connections
+
+    @staticmethod
+    def close_connections():
+        # type: () -> None
+        """
+        Closes all pooled connections of the current thread
+        :return: None
+        """
+        connections = Base._get_connections()
+        while connections:
+            _, connection = connections.popitem()
+            connection.close()
+
+    @classmethod
+    def _add_dynamic(cls, key):
+        """ Generates a new dynamic value on a class. """
+        setattr(cls, key, property(lambda s: getattr(s, '_{0}'.format(key))()))
 
-    def _add_foreign_relation(self, key, relation_info):
-        """ Generates a new foreign relation on an object. """
-        setattr(self.__class__, key, property(lambda s: s._get_foreign_relation(relation_info)))
+    @classmethod
+    def _add_foreign_relation(cls, key, relation_info):
+        """ Generates a new foreign relation on a class. """
+        setattr(cls, key, property(lambda s: s._get_foreign_relation(relation_info)))
 
     def _get_foreign_relation(self, relation_info):
         """ Getter logic for a foreign relation. """
         remote_class = relation_info['class']
+        prefetched = getattr(self, '_prefetched', None)
+        if prefetched is not None and (remote_class, relation_info['key']) in prefetched:
+            return list(prefetched[(remote_class, relation_info['key'])])
         remote_class._ensure_table()
-        entries = []
-        with self.connector() as connection:
+        with self._connection() as connection:
             cursor = connection.cursor()
-            cursor.execute('SELECT id FROM {0} WHERE _{1}_id=?'.format(remote_class._table, relation_info['key']),
+            cursor.execute('SELECT * FROM {0} WHERE _{1}_id=?'.format(remote_class._table, relation_info['key']),
                            [self.id])
-            for row in cursor.fetchall():
-                entries.append(remote_class(row['id'], ensure_table=False))
-        return entries
+            return [remote_class._from_row(row) for row in cursor.fetchall()]
 
-    def _add_relation(self, relation):
-        """ Generates a new relation on an object. """
-        setattr(self.__class__, relation[0], property(lambda s: s._get_relation(relation),
-                                                      lambda s, v: s._set_relation(relation, v)))
-        setattr(self.__class__, '{0}_id'.format(relation[0]), property(lambda s: s._get_relation_id(relation)))
+    @classmethod
+    def _add_relation(cls, relation):
+        """ Generates a new relation on a class. """
+        setattr(cls, relation[0], property(lambda s: s._get_relation(relation),
+                                           lambda s, v: s._set_relation(relation, v)))
+        setattr(cls, '{0}_id'.format(relation[0]), property(lambda s: s._get_relation_id(relation)))
+        setattr(cls, '_{0}'.format(relation[0]), property(lambda s: s._get_relation_state(relation)))
 
     def _get_relation(self, relation):
         """ Getter for a relation. """
-        data = getattr(self, '_{0}'.format(relation[0]))
-        if data['object'] is None and data['id'] is not None:
-            data['object'] = relation[1](data['id'])
-        return data['object']
+        value = getattr(self, '_{0}_object'.format(relation[0]))
+        identifier = getattr(self, '_{0}_id'.format(relation[0]))
+        if value is None and identifier is not None:
+            value = (relation[1] or self.__class__)._get_instance(identifier)
+            setattr(self, '_{0}_object'.format(relation[0]), value)
+        return value
 
     def _set_relation(self, relation, value):
         """ Setter for a relation. """
-        data = getattr(self, '_{0}'.format(relation[0]))
-        if value is None:
-            data['id'] = None
-            data['object'] = None
-        else:
-            data['id'] = value.id
-            data['object'] = value
+        setattr(self, '_{0}_id'.format(relation[0]), None if value is None else value.id)
+        setattr(self, '_{0}_object'.format(relation[0]), value)
 
     def _get_relation_id(self, relation):
         """ Getter for a relation identifier. """
-        return getattr(self, '_{0}'.format(relation[0]))['id']
+        return getattr(self, '_{0}_id'.format(relation[0]))
+
+    def _get_relation_state(self, relation):
+        """ Getter for the state of a relation, as it was stored before the relations were kept in slots. """
+        return {'id': getattr(self, '_{0}_id'.format(relation[0])),
+                'object': getattr(self, '_{0}_object'.format(relation[0]))}
 
     def save(self):
         """
         Saves the current object. If not existing, it is created and the identifier field is filled.
+        Otherwise, only the columns that changed since the object was loaded or saved are written.
         :return: None
         """
-        prop_values = []
-        for prop in self._properties:
-            if prop.property_type is None and prop.mandatory is True and getattr(self, prop.name) is None:  # None value would otherwise be JSON serialized to 'null', bypassing the mandatory CONSTRAINT
-                prop_values.append(None)
-            else:
-                prop_values.append(Base._serialize(prop.property_type, getattr(self, prop.name)))
-        prop_values.extend([getattr(self, '_{0}'.format(relation[0])).get('id') for relation in self._relations])
+        prop_values = self._get_values()
         if self.id is None:
-            field_names = ', '.join([prop.name for prop in self._properties] +
-                                    ['_{0}_id'.format(relation[0]) for relation in self._relations])
-            prop_statement = ', '.join('?' for _ in self._properties + self._relations)
-            with self.connector() as connection:
+            with self._connection() as connection:
                 cursor = connection.cursor()
-                cursor.execute('INSERT INTO {0}({1}) VALUES ({2})'.format(self._table, field_names, prop_statement),
-                               prop_values)
+                cursor.execute(self._get_insert_statement(), prop_values)
                 self.id = cursor.lastrowid
+            self._original = prop_values
+            identity_map = Base._get_identity_map()
+            if identity_map is not None:
+                identity_map[(self.__class__, self.id)] = self
         else:
-            prop_statement = ', '.join(['{0}=?'.format(prop.name) for prop in self._properties] +
-                                       ['_{0}_id=?'.format(relation[0]) for relation in self._relations])
-            with self.connector() as connection:
-                connection.execute('UPDATE {0} SET {1} WHERE id=? LIMIT 1'.format(self._table, prop_statement),
-                                   prop_values + [self.id])
+            changes = self._get_changes(prop_values)
+            if len(changes) == 0:
+                return
+            with self._connection() as connection:
+                connection.execute(self._get_update_statement(tuple(changes)), [prop_values[index] for index in changes] + [self.id])
+            self._original = prop_values
 
     def delete(self):
         """
         Deletes the current object from the SQLite database.
         :return: None
         """
-        with self.connector() as connection:
+        with self._connection() as connection:
             connection.execute('DELETE FROM {0} WHERE id=? LIMIT 1'.format(self._table), [self.id])
+        identity_map = Base._get_identity_map()
+        if identity_map is not None:
+            identity_map.pop((self.__class__, self.id), None)
+
+    @staticmethod
+    def bulk_save(objects):
+        """
+        Saves the given objects in a single transaction. The INSERT and UPDATE statements are executed in batches per
+        class. New objects get their identifier filled in. When saving fails, the new objects are left without
+        identifier and nothing is saved (within a unit of work, once the failure ends the unit of work).
+        :param objects: The objects to save
+        :type objects: list
+        :return: The identifiers assigned to the new objects, in the order the objects were given
+        :rtype: list
+        """
+        inserts = {}
+        updates = {}
+        for obj in objects:
+            batch = inserts if obj.id is None else updates
+            batch.setdefault(obj.__class__, []).append(obj)
+        saved = []
+        created = []
+        try:
+            with Base._transaction():
+                for object_type, entries in inserts.iteritems():
+                    values = [entry._get_values() for entry in entries]
+                    saved.extend(zip(entries, values))
+                    with object_type._connection() as connection:
+                        connection.executemany(object_type._get_insert_statement(), values)
+                        # Within a transaction, the rows of a single statement get consecutive row ids
+                        last_id = connection.execute('SELECT last_insert_rowid()').fetchone()[0]
+                    for index, entry in enumerate(entries):
+                        entry.id = last_id - len(entries) + 1 + index
+                        created.append(entry)
+                for object_type, entries in updates.iteritems():
+                    batches = {}
+                    for entry in entries:
+                        prop_values = entry._get_values()
+                        changes = tuple(entry._get_changes(prop_values))
+                        if len(changes) > 0:
+                            batches.setdefault(changes, []).append((entry, prop_values))
+                    for changes, batch in batches.iteritems():
+                        with object_type._connection() as connection:
+                            connection.executemany(object_type._get_update_statement(changes),
+                                                   [[prop_values[index] for index in changes] + [entry.id] for entry, prop_values in batch])
+                        saved.extend(batch)
+        except Exception:
+            for entry in created:
+                entry.id = None
+            raise
+        for entry, prop_values in saved:
+            entry._original = prop_values
+        identity_map = Base._get_identity_map()
+        if identity_map is not None:
+            for entry in created:
+                identity_map[(entry.__class__, entry.id)] = entry
+        created_ids = set(id(entry) for entry in created)
+        return [obj.id for obj in objects if id(obj) in created_ids]
+
+    @staticmethod
+    def bulk_delete(objects):
+        """
+        Deletes the given objects in a single transaction
+        :param objects: The objects to delete
+        :type objects: list
+        :return: None
+        """
+        deletes = {}
+        for obj in objects:
+            deletes.setdefault(obj.__class__, []).append(obj)
+        with Base._transaction():
+            for object_type, entries in deletes.iteritems():
+                with object_type._connection() as connection:
+                    connection.executemany('DELETE FROM {0} WHERE id=?'.format(object_type._table), [[entry.id] for entry in entries])
+        identity_map = Base._get_identity_map()
+        if identity_map is not None:
+            for obj in objects:
+                identity_map.pop((obj.__class__, obj.id), None)
+
+    def _get_values(self):
+        """ Returns the serialized property values and relation identifiers, in column order. """
+        prop_values = []
+        for prop in self._properties:
+            if prop.property_type is None and prop.mandatory is True and getattr(self, prop.name) is None:  # None value would otherwise be JSON serialized to 'null', bypassing the mandatory CONSTRAINT
+                prop_values.append(None)
+            else:
+                prop_values.append(Base._serialize(prop.property_type, getattr(self, prop.name)))
+        prop_values.extend([getattr(self, '_{0}_id'.format(relation[0])) for relation in self._relations])
+        return prop_values
+
+    def _get_changes(self, prop_values):
+        """
+        Returns the positions of the given serialized values which differ from the values loaded or last saved
+        :param prop_values: The serialized values, as returned by `_get_values`
+        :type prop_values: list
+        :return: The positions of the changed values
+        :rtype: list
+        """
+        original = getattr(self, '_original', None)
+        if original is None:
+            return range(len(prop_values))
+        return [index for index, value in enumerate(prop_values) if value != original[index]]
+
+    @classmethod
+    def _get_column_names(cls):
+        """ Returns the names of all columns, except for the primary key, in column order. """
+        return [prop.name for prop in cls._properties] + ['_{0}_id'.format(relation[0]) for relation in cls._relations]
+
+    @classmethod
+    def _get_insert_statement(cls):
+        """ Returns the INSERT statement for all columns. """
+        column_names = cls._get_column_names()
+        return 'INSERT INTO {0}({1}) VALUES ({2})'.format(cls._table, ', '.join(column_names), ', '.join('?' for _ in column_names))
+
+    @classmethod
+    def _get_update_statement(cls, changes):
+        """
+        Returns the UPDATE statement for the given columns. The statements are cached per class and set of columns
+        :param changes: The positions of the columns to update, as returned by `_get_changes`
+        :type changes: tuple
+        :return: The UPDATE statement
+        :rtype: str
+        """
+        statement = Base._update_statements.get((cls, changes))
+        if statement is None:
+            column_names = cls._get_column_names()
+            prop_statement = ', '.join('{0}=?'.format(column_names[index]) for index in changes)
+            statement = 'UPDATE {0} SET {1} WHERE id=? LIMIT 1'.format(cls._table, prop_statement)
+            Base._update_statements[(cls, changes)] = statement
+        return statement
 
     @staticmethod
     def _get_prop_type(prop_type):
@@ -208,39 +608,101 @@ class Base(object):
             return 1 if data else 0
         raise ValueError('The type {0} is not supported. Supported types: int, str, list, dict, bool'.format(prop_type))
 
+    @classmethod
+    def _get_schema_key(cls):
+        # type: () -> tuple
+        """
+        Returns the key under which the table of this object is registered as verified: the database path, the table
+        name and a hash of the object definition
+        :return: The schema key
+        :rtype: tuple
+        """
+        schema_hash = Base._schema_hashes.get(cls)
+        if schema_hash is None:
+            definition = json.dumps([[prop.name, Base._get_prop_type(prop.property_type), prop.mandatory, prop.unique, prop.indexed] for prop in cls._properties] +
+                                    [relation[0] for relation in cls._relations] +
+                                    [list(index) for index in cls._indexes])
+            schema_hash = hashlib.md5(definition).hexdigest()
+            Base._schema_hashes[cls] = schema_hash
+        return '{0}/main.db'.format(cls.DATABASE_FOLDER), cls._table, schema_hash
+
     @classmethod
     def _ensure_table(cls):
-        # type (None): -> None
-        relation_list = ['_{0}_id'.format(relation[0]) for relation in cls._relations]
-        relations = ['{0} INTEGER'.format(relation) for relation in relation_list]
-        properties = ['{0} {1} {2} {3}'.format(prop.name,
-                                               Base._get_prop_type(prop.property_type),
-                                               'NOT NULL' if prop.mandatory is True else '',
-                                               'UNIQUE' if prop.unique is True else '') for prop in cls._properties]
-        primary_key = ['id INTEGER PRIMARY KEY AUTOINCREMENT']
-
-        with cls.connector() as connection:
-            connection.execute('CREATE TABLE IF NOT EXISTS {0} ({1})'.format(cls._table, ', '.join(primary_key + properties + relations)))
-            cursor = connection.cursor()
-            cursor.execute('PRAGMA table_info({0})'.format(cls._table))
-            current_relations = []
-            current_properties = []
-            for row in cursor.fetchall():
-                if row['name'].startswith('_'):
-                    current_relations.append(row['name'])
-                else:
-                    current_properties.append(row['name'])
-
-            # ALTER TABLE does not allow to add columns with UNIQUE or NOT NULL constraints
-            for prop in cls._properties:
-                if prop.name not in current_properties:
-                    connection.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(cls._table,
-                                                                                   prop.name,
-                                                                                   Base._get_prop_type(prop.property_type)))
-
-            for rel_name in relation_list:
-                if rel_name not in current_relations:
-                    connection.execute('ALTER TABLE {0} ADD COLUMN {1} INTEGER'.format(cls._table, rel_name))
+        # type: () -> None
+        """
+        Makes sure the table exists and contains all columns of the object definition.
+        This is only verified once per database and object definition within the process
+        :return: None
+        """
+        schema_key = cls._get_schema_key()
+        if schema_key in Base._schemas:
+            return
+        with Base._schema_lock:
+            if schema_key in Base._schemas:
+                return
+            relation_list = ['_{0}_id'.format(relation[0]) for relation in cls._relations]
+            relations = ['{0} INTEGER'.format(relation) for relation in relation_list]
+            properties = ['{0} {1} {2} {3}'.format(prop.name,
+                                                   Base._get_prop_type(prop.property_type),
+                                                   'NOT NULL' if prop.mandatory is True else '',
+                                                   'UNIQUE' if prop.unique is True else '') for prop in cls._properties]
+            primary_key = ['id INTEGER PRIMARY KEY AUTOINCREMENT']
+
+            with cls._connection() as connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS {0} ({1})'.format(cls._table, ', '.join(primary_key + properties + relations)))
+                cursor = connection.cursor()
+                cursor.execute('PRAGMA table_info({0})'.format(cls._table))
+                current_relations = []
+                current_properties = []
+                for row in cursor.fetchall():
+                    if row['name'].startswith('_'):
+                        current_relations.append(row['name'])
+                    else:
+                        current_properties.append(row['name'])
+
+                # ALTER TABLE does not allow to add columns with UNIQUE or NOT NULL constraints
+                for prop in cls._properties:
+                    if prop.name not in current_properties:
+                        connection.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(cls._table,
+                                                                                       prop.name,
+                                                                                       Base._get_prop_type(prop.property_type)))
+
+                for rel_name in relation_list:
+                    if rel_name not in current_relations:
+                        connection.execute('ALTER TABLE {0} ADD COLUMN {1} INTEGER'.format(cls._table, rel_name))
+            cls._ensure_indexes()
+            Base._schemas.add(schema_key)
+
+    @classmethod
+    def _ensure_indexes(cls):
+        # type: () -> None
+        """
+        Creates the missing indexes for the indexed properties, the relations and the composite indexes
+        :return: None
+        """
+        relation_names = [relation[0] for relation in cls._relations]
+        indexes = [[prop.name] for prop in cls._properties if prop.indexed is True and prop.unique is False]  # UNIQUE columns are indexed by SQLite
+        indexes.extend([[relation_name] for relation_name in relation_names])
+        indexes.extend(cls._indexes)
+        with cls._connection() as connection:
+            for index in indexes:
+                columns = ['_{0}_id'.format(name) if name in relation_names else name for name in index]
+                connection.execute('CREATE INDEX IF NOT EXISTS {0}_{1}_index ON {0} ({2})'.format(cls._table, '_'.join(index), ', '.join(columns)))
+
+    @classmethod
+    def migrate(cls):
+        # type: () -> None
+        """
+        Migrates the table to the current object definition. Next to adding missing columns, this also applies changed
+        constraints (UNIQUE, NOT NULL) of existing columns by rebuilding the table. Use with caution (only during code migrations)
+        :return: None
+        """
+        schema_key = cls._get_schema_key()
+        with Base._schema_lock:
+            Base._schemas.discard(schema_key)
+            cls._ensure_table()
+            cls._update_table()
+            cls._ensure_indexes()  # Rebuilding the table drops its indexes
 
     @classmethod
     def _update_table(cls):
@@ -261,9 +723,10 @@ class Base(object):
                                                 cls._get_prop_type(prop.property_type),
                                                 'NOT NULL' if prop.mandatory is True else '',
                                                 'UNIQUE' if prop.unique is True else '') for prop in cls._properties]
+        dal_entries.extend(['_{0}_id INTEGER'.format(relation[0]) for relation in cls._relations])
 
         # Fetch SQL entries
-        with cls.connector() as con:
+        with cls._connection() as con:
             cur = con.cursor()
             cur.execute("select sql from sqlite_master where type='table' and name='{0}' order by NAME ".format(cls._table))
             schema = cur.fetchall()
@@ -272,20 +735,16 @@ class Base(object):
         create_cmd = schema[0][0]
         sql_entries = create_cmd.split('(')[1].split(',')
         sql_entries = [entry.strip().strip(')') for entry in sql_entries]
-
-        for index, entry in enumerate(sql_entries): # SQL table contains id, DAL does not, so has to be removed for comparison
-            if 'id ' in entry:
-                sql_entries.pop(index)
-                break
+        # SQL table contains id, DAL does not, so has to be removed for comparison
+        sql_constraints = dict((constraint.name, constraint) for constraint in (SQLConstraint(entry) for entry in sql_entries) if constraint.name != 'id')
 
         # Comparison
         difference = False
         set = SQLConstraintset(add_id=True)
-        for sql_entry, dal_entry in zip(sorted(sql_entries), sorted(dal_entries)):
-            sql_constraint = SQLConstraint(sql_entry)
+        for dal_entry in dal_entries:
             dal_constraint = SQLConstraint(dal_entry)
             set.add(dal_constraint)
-            if sql_constraint != dal_constraint:
+            if sql_constraints.get(dal_constraint.name) != dal_constraint:
                 difference = True
 
         # Alter SQL DB if difference between dal and sql constraints
@@ -302,6 +761,20 @@ class Base(object):
                                   "PRAGMA foreign_keys = on;"
                                   "".format(cls._table, str(set), set.names()))
 
+    def __getstate__(self):
+        """ Returns the state to pickle. Objects with slots can otherwise only be pickled using protocol 2 or higher """
+        state = dict(self.__dict__)
+        for klass in self.__class__.__mro__:
+            for slot in klass.__dict__.get('__slots__', ()):
+                if slot not in ('__dict__', '__weakref__') and hasattr(self, slot):
+                    state[slot] = getattr(self, slot)
+        return state
+
+    def __setstate__(self, state):
+        """ Restores a pickled state """
+        for key, value in state.iteritems():
+            setattr(self, key, value)
+
     def __repr__(self):
         """ Short representation of the object. """
         return '<{0} (id: {1}, at: {2})>'.format(self.__class__.__name__, self.id, hex(id(self)))
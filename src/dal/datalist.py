@@ -17,6 +17,7 @@
 """
 This package contains the DAL list engine
 """
+from ovs_extensions.dal.relations import RelationMapper
 
 
 # noinspection PyProtectedMember
@@ -24,9 +25,10 @@ class DataList(object):
     """
     The DataList class contains method(s) to query the underlying SQLite database.
     """
+    CHUNK_SIZE = 500  # Stays well below SQLite's default limit of 999 host parameters per statement
 
     @staticmethod
-    def query(object_type, query, parameters=None):
+    def query(object_type, query, parameters=None, prefetch=None):
         """
         This is a basic query wrapper that exposes a few "user friendly" features:
         * Translates relations to their internal fields:
@@ -35,28 +37,158 @@ class DataList(object):
           `SELECT id FROM {table} WHERE name=?` => `SELECT id FROM setting WHERE name=?`
 
         A few remarks/limitations:
-        * This isn't written (nor meant to be) very efficient. It requires the query to return the primary key(s) of
-          the  objects to return and will execute a separate query to fetch the actual data and yield the object.
+        * The query should return the primary key of the objects to return as its first column. When the query returns
+          all columns of the table (e.g. `SELECT * FROM {table} ...`), the objects are built directly from the result.
+          Otherwise, the objects are loaded in chunks using `SELECT * FROM {table} WHERE id IN (...)`.
         * While the DAL supports more complex objects like `list` and `dict`, these are serialized into JSON, and should
           be queried as such. E.g. a list property might contains ['foo', 'bar'], but when executing queries, keep in
           mind the DB's content will be '["bar","foo"].
+        * Relations and foreign relations passed in `prefetch` are loaded upfront using one `IN (...)` query per
+          relation. Accessing them afterwards does not query the database anymore. Prefetched foreign relations reflect
+          the state at the time of the query.
 
+        :param object_type: The object type to return
+        :param query: The SQLite compatibly query
+        :param parameters: SQLite compatible query parameters
+        :param prefetch: Names of the relations and foreign relations to load for all returned objects
+        :type prefetch: list
+        :return: List of instances of the given object type
+        """
+        query = DataList._prepare(object_type, query)
+        with object_type._connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(query, parameters or [])
+            rows = cursor.fetchall()
+            columns = set(description[0] for description in cursor.description or [])
+        if DataList._get_columns(object_type).issubset(columns):
+            entries = [object_type._from_row(row) for row in rows]
+        else:
+            entries = list(DataList._hydrate(object_type, [row[0] for row in rows]))
+        for name in prefetch or []:
+            DataList._prefetch(object_type, entries, name)
+        return entries
+
+    @staticmethod
+    def iterate(object_type, query, parameters=None):
+        """
+        Lazy variant of `query`: only the primary keys of the result are kept in memory, the objects are loaded and
+        yielded one chunk at a time. Objects removed in the meantime are skipped.
         :param object_type: The object type to return
         :param query: The SQLite compatibly query
         :param parameters: SQLite compatible query parameters
         :return: Yields instances of the given object type
         """
-        entries = []
-        if parameters is None:
-            parameters = []
+        query = DataList._prepare(object_type, query)
+        with object_type._connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(query, parameters or [])
+            identifiers = [row[0] for row in cursor.fetchall()]
+        for entry in DataList._hydrate(object_type, identifiers):
+            yield entry
+
+    @staticmethod
+    def get_query_plan(object_type, query, parameters=None):
+        """
+        Returns the plan SQLite would use to execute the given query, as reported by `EXPLAIN QUERY PLAN`. The query is
+        translated as in `query`. Mainly useful to validate in tests that a query uses an index, e.g.
+        `SEARCH setting USING INDEX setting_node_index (_node_id=?)`
+        :param object_type: The object type the query is executed for
+        :param query: The SQLite compatibly query
+        :param parameters: SQLite compatible query parameters
+        :return: The details of the steps of the plan
+        :rtype: list
+        """
+        query = DataList._prepare(object_type, query)
+        with object_type._connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN {0}'.format(query), parameters or [])
+            return [row[-1] for row in cursor.fetchall()]
+
+    @staticmethod
+    def _prepare(object_type, query):
+        """ Ensures the table exists and translates the table and relation names in the query. """
         object_type._ensure_table()
         query = query.format(table=object_type._table)
         for relation in object_type._relations:
             query = query.replace('{0}_id'.format(relation[0]),
                                   '_{0}_id'.format(relation[0]))
-        with object_type.connector() as connection:
-            cursor = connection.cursor()
-            result = cursor.execute(query, parameters)
-            for row in result.fetchall():
-                entries.append(object_type(row[0], ensure_table=False))
-        return entries
+        return query
+
+    @staticmethod
+    def _get_columns(object_type):
+        """ Returns the names of all columns of the object type's table. """
+        return set(['id'] +
+                   [prop.name for prop in object_type._properties] +
+                   ['_{0}_id'.format(relation[0]) for relation in object_type._relations])
+
+    @staticmethod
+    def _hydrate(object_type, identifiers):
+        """
+        Loads the objects with given identifiers, querying the database once per chunk
+        :param object_type: The object type to return
+        :param identifiers: The primary keys of the objects, in the order the objects should be yielded
+        :type identifiers: list
+        :return: Yields instances of the given object type. Objects which no longer exist are skipped
+        """
+        for chunk, rows in DataList._fetch_rows(object_type, 'id', identifiers):
+            rows = dict((row['id'], row) for row in rows)
+            for identifier in chunk:
+                if identifier in rows:
+                    yield object_type._from_row(rows[identifier])
+
+    @staticmethod
+    def _fetch_rows(object_type, column, values):
+        """
+        Fetches the rows of which the given column matches one of the given values, querying the database once per chunk
+        :param object_type: The object type of which the rows should be fetched
+        :param column: The column to match
+        :type column: str
+        :param values: The values to match
+        :type values: list
+        :return: Yields tuples of the chunk of values and the matching rows
+        """
+        for index in xrange(0, len(values), DataList.CHUNK_SIZE):
+            chunk = values[index:index + DataList.CHUNK_SIZE]
+            with object_type._connection() as connection:
+                cursor = connection.cursor()
+                cursor.execute('SELECT * FROM {0} WHERE {1} IN ({2})'.format(object_type._table, column, ', '.join('?' for _ in chunk)),
+                               chunk)
+                rows = cursor.fetchall()
+            yield chunk, rows
+
+    @staticmethod
+    def _prefetch(object_type, entries, name):
+        """
+        Loads a relation or foreign relation for all given objects at once
+        :param object_type: The object type of the given objects
+        :param entries: The objects
+        :type entries: list
+        :param name: Name of the relation or foreign relation
+        :type name: str
+        :return: None
+        """
+        for relation in object_type._relations:
+            if relation[0] == name:
+                remote_class = relation[1] or object_type
+                remote_class._ensure_table()
+                id_field = '_{0}_id'.format(name)
+                object_field = '_{0}_object'.format(name)
+                identifiers = list(set(getattr(entry, id_field) for entry in entries if getattr(entry, id_field) is not None))
+                remotes = dict((remote.id, remote) for remote in DataList._hydrate(remote_class, identifiers))
+                for entry in entries:
+                    setattr(entry, object_field, remotes.get(getattr(entry, id_field)))
+                return
+        relation_info = RelationMapper.load_foreign_relations(object_type).get(name)
+        if relation_info is None:
+            raise ValueError('{0} has no relation or foreign relation {1}'.format(object_type.__name__, name))
+        remote_class = relation_info['class']
+        remote_class._ensure_table()
+        id_field = '_{0}_id'.format(relation_info['key'])
+        remotes = dict((entry.id, []) for entry in entries)
+        for _, rows in DataList._fetch_rows(remote_class, id_field, remotes.keys()):
+            for row in rows:
+                remotes[row[id_field]].append(remote_class._from_row(row))
+        for entry in entries:
+            if getattr(entry, '_prefetched', None) is None:
+                entry._prefetched = {}
+            entry._prefetched[(remote_class, relation_info['key'])] = remotes[entry.id]
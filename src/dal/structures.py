@@ -24,11 +24,12 @@ class Property(object):
     Property
     """
 
-    def __init__(self, name, property_type, unique=False, mandatory=True):
+    def __init__(self, name, property_type, unique=False, mandatory=True, indexed=False):
         """
         Initializes a property
         """
         self.name = name
         self.unique = unique
+        self.indexed = indexed
         self.mandatory = mandatory
         self.property_type = property_type
@@ -0,0 +1,148 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Benchmarks for the DAL. Run as a module:
+python -m ovs_extensions.dal.tests.benchmark [amount] [constructions]
+"""
+import gc
+import sys
+import time
+import resource
+import sqlite3
+from ovs_extensions.dal.base import Base
+from ovs_extensions.dal.datalist import DataList
+from ovs_extensions.dal.tests.objects import Node, setup_database, teardown_database
+
+
+def _legacy_connector(cls):
+    """
+    Connector as it was before the connections were pooled: a new connection with default settings for every call
+    """
+    connection = sqlite3.connect('{0}/main.db'.format(cls.DATABASE_FOLDER), timeout=60.0)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def _timed(function, amount):
+    """
+    Executes the given function `amount` times and returns the operations per second
+    """
+    start = time.time()
+    for index in xrange(amount):
+        function(index)
+    return amount / (time.time() - start)
+
+
+def run(amount=1000, legacy=False):
+    """
+    Saves, loads and updates `amount` objects against a fresh database
+    :param amount: Amount of objects
+    :type amount: int
+    :param legacy: Use a new connection for every database call
+    :type legacy: bool
+    :return: Operations per second per action
+    :rtype: dict
+    """
+    connector = Base.__dict__['connector']
+    database_folder = setup_database()
+    if legacy is True:
+        Base.connector = classmethod(_legacy_connector)
+    try:
+        Node._ensure_table()
+        identifiers = []
+
+        def _save(index):
+            node = Node(ensure_table=False)
+            node.name = 'node_{0}'.format(index)
+            node.data = {'index': index}
+            node.save()
+            identifiers.append(node.id)
+
+        def _load(index):
+            Node(identifiers[index], ensure_table=False)
+
+        def _update(index):
+            node = Node(identifiers[index], ensure_table=False)
+            node.enabled = True
+            node.save()
+
+        def _bulk_save(_):
+            nodes = []
+            for index in xrange(amount):
+                node = Node(ensure_table=False)
+                node.name = 'bulk_{0}'.format(index)
+                node.data = {'index': index}
+                nodes.append(node)
+            Base.bulk_save(nodes)
+
+        def _query(_):
+            DataList.query(Node, 'SELECT id FROM {table}')
+
+        return {'save': _timed(_save, amount),
+                'load': _timed(_load, amount),
+                'update': _timed(_update, amount),
+                'query': _timed(_query, 10) * amount,  # Expressed as objects per second
+                'bulk save': _timed(_bulk_save, 1) * amount}
+    finally:
+        Base.connector = connector
+        teardown_database(database_folder)
+
+
+def run_construction(amount=100000):
+    """
+    Constructs `amount` objects, both as new objects and from table rows, and measures the memory they occupy
+    :param amount: Amount of objects
+    :type amount: int
+    :return: Objects per second per action and the memory footprint per object in bytes
+    :rtype: dict
+    """
+    database_folder = setup_database()
+    try:
+        node = Node()
+        node.name = 'node'
+        node.data = {'foo': 'bar'}
+        node.save()
+        with Node.connector() as connection:
+            row = connection.execute('SELECT * FROM node WHERE id=?', [node.id]).fetchone()
+
+        gc.collect()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        objects = [Node._from_row(row) for _ in xrange(amount)]
+        hydrate = amount / (time.time() - start)
+        footprint = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) * 1024.0 / amount
+        del objects
+        construct = _timed(lambda _: Node(ensure_table=False), amount)
+        return {'construct': construct,
+                'hydrate': hydrate,
+                'footprint': footprint}
+    finally:
+        teardown_database(database_folder)
+
+
+if __name__ == '__main__':
+    _amount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    _constructions = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    _construction = run_construction(_constructions)  # Executed first, as the footprint is derived from the peak memory usage
+    _before = run(_amount, legacy=True)
+    _after = run(_amount)
+    for _action in ['save', 'load', 'update', 'query', 'bulk save']:
+        print '{0:<9} before: {1:>10.0f} ops/s  after: {2:>10.0f} ops/s  ({3:.1f}x)'.format(_action, _before[_action], _after[_action], _after[_action] / _before[_action])
+    print 'construct {0:>10.0f} objects/s'.format(_construction['construct'])
+    print 'hydrate   {0:>10.0f} objects/s'.format(_construction['hydrate'])
+    print 'footprint {0:>10.0f} bytes/object'.format(_construction['footprint'])
@@ -0,0 +1,108 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+DAL objects and helpers used by the DAL tests and benchmarks
+"""
+import shutil
+import tempfile
+import unittest
+from ovs_extensions.dal.base import Base
+from ovs_extensions.dal.relations import RelationMapper
+from ovs_extensions.dal.structures import Property
+from ovs_extensions.generic.plugin import PluginController
+
+
+class DalBase(Base):
+    """
+    Base class of the DAL test objects
+    """
+    NAME = 'dal_test'
+
+
+class Node(DalBase):
+    """
+    Test object representing a node
+    """
+    _table = 'node'
+    _properties = [Property(name='name', property_type=str, unique=True),
+                   Property(name='data', property_type=dict, mandatory=False),
+                   Property(name='enabled', property_type=bool, mandatory=False)]
+    _relations = []
+    _dynamics = []
+
+
+class Setting(DalBase):
+    """
+    Test object representing a setting of a node
+    """
+    _table = 'setting'
+    _properties = [Property(name='key', property_type=str, indexed=True),
+                   Property(name='value', property_type=str, mandatory=False)]
+    _relations = [['node', Node, 'settings']]
+    _indexes = [['node', 'key']]
+    _dynamics = []
+
+
+DAL_OBJECTS = [Node, Setting]
+_get_dal_objects = PluginController.__dict__['get_dal_objects']
+
+
+def setup_database():
+    """
+    Points the test objects to an empty database in a temporary folder and makes their relations resolvable
+    :return: The database folder
+    :rtype: str
+    """
+    database_folder = tempfile.mkdtemp()
+    PluginController.get_dal_objects = classmethod(lambda cls: list(DAL_OBJECTS))
+    RelationMapper.cache = {}
+    DalBase.DATABASE_FOLDER = database_folder
+    return database_folder
+
+
+def teardown_database(database_folder):
+    """
+    Closes the connections of the current thread and removes the database folder
+    :param database_folder: The database folder returned by `setup_database`
+    :type database_folder: str
+    :return: None
+    """
+    Base.close_connections()
+    Base._schemas.clear()
+    PluginController.get_dal_objects = _get_dal_objects
+    RelationMapper.cache = {}
+    DalBase.DATABASE_FOLDER = None
+    shutil.rmtree(database_folder)
+
+
+class DalTestCase(unittest.TestCase):
+    """
+    Test case running every test against a fresh database in a temporary folder
+    """
+
+    def setUp(self):
+        """
+        Prepares an empty database
+        """
+        self._database_folder = setup_database()
+
+    def tearDown(self):
+        """
+        Removes the database
+        """
+        teardown_database(self._database_folder)
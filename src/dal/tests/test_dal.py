@@ -0,0 +1,381 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Test module for the DAL
+"""
+import os
+import pickle
+import sqlite3
+import threading
+from ovs_extensions.dal.base import Base, ObjectNotFoundException
+from ovs_extensions.dal.datalist import DataList
+from ovs_extensions.dal.structures import Property
+from ovs_extensions.dal.tests.objects import DalBase, DalTestCase, Node, Setting
+
+
+class DalTest(DalTestCase):
+    """
+    Test DAL functionality
+    """
+
+    def test_crud(self):
+        """
+        Validates creating, loading, updating and deleting objects
+        """
+        node = Node()
+        node.name = 'node_1'
+        node.data = {'foo': ['bar']}
+        node.enabled = True
+        node.save()
+        self.assertIsNotNone(node.id)
+
+        loaded = Node(node.id)
+        self.assertEqual(loaded.name, 'node_1')
+        self.assertEqual(loaded.data, {'foo': ['bar']})
+        self.assertTrue(loaded.enabled)
+
+        loaded.enabled = False
+        loaded.save()
+        self.assertFalse(Node(node.id).enabled)
+
+        setting = Setting()
+        setting.key = 'foo'
+        setting.value = 'bar'
+        setting.node = node
+        setting.save()
+        self.assertEqual([entry.id for entry in Node(node.id).settings], [setting.id])
+        self.assertEqual(Setting(setting.id).node.name, 'node_1')
+        self.assertEqual([entry.id for entry in DataList.query(Setting, 'SELECT id FROM {table} WHERE node_id=?', [node.id])],
+                         [setting.id])
+
+        setting.delete()
+        with self.assertRaises(ObjectNotFoundException):
+            Setting(setting.id)
+
+    def test_connection_pool(self):
+        """
+        Validates that connections are re-used within a thread and are never shared between threads
+        """
+        connection = Node.connector()
+        self.assertIs(Setting.connector(), connection)
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+        self.assertTrue(os.path.exists('{0}/main.db'.format(self._database_folder)))
+
+        other_connections = []
+        thread = threading.Thread(target=lambda: other_connections.append(Node.connector()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_connections[0], connection)
+
+        node = Node()
+        node.name = 'node_1'
+        node.save()
+        Base.close_connections()
+        self.assertIsNot(Node.connector(), connection)
+        self.assertEqual(Node(node.id).name, 'node_1')
+
+    def test_query(self):
+        """
+        Validates the hydration of query results, both for queries returning identifiers and complete rows
+        """
+        nodes = []
+        for index in xrange(7):
+            node = Node()
+            node.name = 'node_{0}'.format(index)
+            node.data = {'index': index}
+            node.save()
+            nodes.append(node)
+        expected = [node.id for node in reversed(nodes)]
+
+        chunk_size = DataList.CHUNK_SIZE
+        DataList.CHUNK_SIZE = 3
+        try:
+            for query in ['SELECT id FROM {table} ORDER BY id DESC', 'SELECT * FROM {table} ORDER BY id DESC']:
+                result = DataList.query(Node, query)
+                self.assertEqual([node.id for node in result], expected)
+                self.assertEqual([node.data['index'] for node in result], range(6, -1, -1))
+
+            iterator = DataList.iterate(Node, 'SELECT id FROM {table} ORDER BY id DESC')
+            self.assertEqual(next(iterator).id, expected[0])
+            nodes[2].delete()  # Objects removed while iterating are skipped
+            self.assertEqual([node.id for node in iterator], [identifier for identifier in expected[1:] if identifier != nodes[2].id])
+        finally:
+            DataList.CHUNK_SIZE = chunk_size
+
+    def test_schema_registry(self):
+        """
+        Validates that the table of an object is only verified once and that migrations apply constraint changes
+        """
+        def _get_sql(table):
+            return Node.connector().execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", [table]).fetchone()
+
+        Node()
+        self.assertIn(Node._get_schema_key(), Base._schemas)
+        with Node.connector() as connection:
+            connection.execute('DROP TABLE node')
+        Node()
+        self.assertIsNone(_get_sql('node'))  # No DDL was executed anymore
+        Base._schemas.discard(Node._get_schema_key())
+
+        node = Node()
+        node.name = 'node_1'
+        node.save()
+        setting = Setting()
+        setting.key = 'foo'
+        setting.node = node
+        setting.save()
+
+        class UniqueSetting(DalBase):
+            """ Setting with a unique key """
+            _table = 'setting'
+            _properties = [Property(name='key', property_type=str, unique=True),
+                           Property(name='value', property_type=str, mandatory=False)]
+            _relations = [['node', Node, 'settings']]
+            _dynamics = []
+
+        self.assertNotIn('UNIQUE', _get_sql('setting')[0])
+        UniqueSetting.migrate()
+        self.assertIn('UNIQUE', _get_sql('setting')[0])
+        migrated = UniqueSetting(setting.id)
+        self.assertEqual(migrated.key, 'foo')
+        self.assertEqual(migrated.node_id, node.id)
+
+    def test_class_generation(self):
+        """
+        Validates that the slots and descriptors are generated on the class
+        """
+        self.assertEqual(Node.__slots__, ('name', 'data', 'enabled'))
+        self.assertEqual(Setting.__slots__, ('key', 'value', '_node_id', '_node_object'))
+        self.assertIsInstance(Setting.__dict__['node'], property)
+        self.assertIsInstance(Setting.__dict__['node_id'], property)
+
+        node = Node()
+        node.name = 'node_1'
+        node.save()
+        self.assertIsInstance(Node.__dict__['settings'], property)  # Foreign relations are added on first use
+        setting = Setting()
+        setting.key = 'foo'
+        setting.node = node
+        setting.save()
+        loaded = Setting(setting.id)
+        self.assertEqual(loaded.__dict__, {})
+        self.assertEqual(loaded.node_id, node.id)
+        self.assertEqual(loaded.node.name, 'node_1')
+        self.assertEqual(loaded._node, {'id': node.id, 'object': loaded.node})
+        loaded.node = None
+        self.assertIsNone(loaded.node_id)
+
+    def test_pickle(self):
+        """
+        Validates that objects can be pickled with every protocol
+        """
+        node = Node()
+        node.name = 'node_1'
+        node.data = {'foo': 1}
+        node.save()
+        setting = Setting()
+        setting.key = 'foo'
+        setting.node = node
+        setting.other = 'bar'
+        for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(setting, protocol))
+            self.assertIsNone(loaded.id)
+            self.assertEqual(loaded.key, 'foo')
+            self.assertEqual(loaded.node_id, node.id)
+            self.assertEqual(loaded.node.data, {'foo': 1})
+            self.assertEqual(loaded.other, 'bar')
+            loaded = pickle.loads(pickle.dumps(Node(node.id), protocol))
+            self.assertEqual(loaded.name, 'node_1')
+            loaded.save()  # Nothing changed
+            self.assertEqual(Node(node.id).data, {'foo': 1})
+
+    def test_custom_constructor(self):
+        """
+        Validates that queries build objects of classes with their own constructor through that constructor
+        """
+        class ConstructedNode(Node):
+            """
+            Node setting up additional state in its constructor
+            """
+            def __init__(self, identifier=None, ensure_table=True):
+                super(ConstructedNode, self).__init__(identifier, ensure_table)
+                self.constructed = True
+
+        node = Node()
+        node.name = 'node_1'
+        node.save()
+        loaded = DataList.query(ConstructedNode, 'SELECT id FROM {table}')[0]
+        self.assertIsInstance(loaded, ConstructedNode)
+        self.assertTrue(loaded.constructed)
+        self.assertEqual(loaded.name, 'node_1')
+        self.assertNotIn('constructed', DataList.query(Node, 'SELECT id FROM {table}')[0].__dict__)
+
+    def test_unit_of_work(self):
+        """
+        Validates the identity map of a unit of work and the prefetching of relations
+        """
+        nodes = []
+        for index in xrange(3):
+            node = Node()
+            node.name = 'node_{0}'.format(index)
+            node.save()
+            nodes.append(node)
+            for key in ['foo', 'bar']:
+                setting = Setting()
+                setting.key = key
+                setting.node = node
+                setting.save()
+
+        query = 'SELECT id FROM {table} ORDER BY id'
+        self.assertIsNot(DataList.query(Setting, query)[0].node, DataList.query(Setting, query)[1].node)
+        with Base.unit_of_work():
+            settings = DataList.query(Setting, query)
+            self.assertIs(settings[0].node, settings[1].node)
+            self.assertIs(settings[0].node.settings[1], settings[1])
+            self.assertIs(DataList.query(Setting, query)[0], settings[0])
+            with Base.unit_of_work():
+                self.assertIs(Setting(settings[0].id).node, settings[0].node)
+        self.assertIsNot(DataList.query(Setting, query)[0], settings[0])
+
+        settings = DataList.query(Setting, query, prefetch=['node'])
+        nodes = DataList.query(Node, query, prefetch=['settings'])
+        with Node.connector() as connection:  # Prefetched relations don't query the database anymore
+            connection.execute('DELETE FROM node')
+            connection.execute('DELETE FROM setting')
+        self.assertEqual([setting.node.name for setting in settings], ['node_0', 'node_0', 'node_1', 'node_1', 'node_2', 'node_2'])
+        self.assertEqual([[setting.key for setting in node.settings] for node in nodes], [['foo', 'bar']] * 3)
+        with self.assertRaises(ValueError):
+            DataList.query(Node, query, prefetch=['foo'])
+
+    def test_unit_of_work_connector(self):
+        """
+        Validates that using the connector within a unit of work doesn't commit the work done so far
+        """
+        with self.assertRaises(RuntimeError):
+            with Base.unit_of_work():
+                node = Node()
+                node.name = 'node_0'
+                node.save()
+                with Node.connector() as connection:
+                    self.assertEqual(connection.execute('SELECT 1').fetchone()[0], 1)
+                    connection.execute("INSERT INTO node (name) VALUES ('node_1')")
+                raise RuntimeError()
+        self.assertEqual(len(DataList.query(Node, 'SELECT id FROM {table}')), 0)
+
+        with Base.unit_of_work():
+            with Node.connector() as connection:
+                connection.execute("INSERT INTO node (name) VALUES ('node_1')")
+        self.assertEqual([node.name for node in DataList.query(Node, 'SELECT id FROM {table}')], ['node_1'])
+
+    def test_bulk(self):
+        """
+        Validates saving and deleting objects in bulk and the transaction of a unit of work
+        """
+        existing = Node()
+        existing.name = 'node_0'
+        existing.save()
+        existing.enabled = True
+        nodes = [existing]
+        for index in xrange(1, 5):
+            node = Node()
+            node.name = 'node_{0}'.format(index)
+            nodes.append(node)
+        setting = Setting()
+        setting.key = 'foo'
+        setting.node = existing
+        identifiers = Base.bulk_save(nodes + [setting])
+        self.assertEqual(identifiers, [node.id for node in nodes[1:]] + [setting.id])
+        self.assertEqual(len(set(identifiers)), 5)
+        self.assertEqual([Node(node.id).name for node in nodes], ['node_{0}'.format(index) for index in xrange(5)])
+        self.assertTrue(Node(existing.id).enabled)
+        self.assertEqual(Setting(setting.id).node_id, existing.id)
+
+        duplicates = [Node(), Node()]
+        for node in duplicates:
+            node.name = 'node_5'
+        with self.assertRaises(sqlite3.IntegrityError):
+            Base.bulk_save(duplicates)
+        self.assertEqual([node.id for node in duplicates], [None, None])
+        self.assertEqual(len(DataList.query(Node, 'SELECT id FROM {table}')), 5)
+
+        Base.bulk_delete(nodes[3:] + [setting])
+        self.assertEqual(sorted(node.id for node in DataList.query(Node, 'SELECT id FROM {table}')), sorted(node.id for node in nodes[:3]))
+        self.assertEqual(DataList.query(Setting, 'SELECT id FROM {table}'), [])
+
+        with self.assertRaises(RuntimeError):
+            with Base.unit_of_work():
+                nodes[0].delete()
+                node = Node()
+                node.name = 'node_6'
+                node.save()
+                raise RuntimeError()
+        self.assertEqual(len(DataList.query(Node, 'SELECT id FROM {table} WHERE name=?', ['node_0'])), 1)
+        self.assertEqual(len(DataList.query(Node, 'SELECT id FROM {table} WHERE name=?', ['node_6'])), 0)
+        with Base.unit_of_work():
+            nodes[0].delete()
+        self.assertEqual(len(DataList.query(Node, 'SELECT id FROM {table} WHERE name=?', ['node_0'])), 0)
+
+    def test_dirty_tracking(self):
+        """
+        Validates that saving an object only writes the changed columns
+        """
+        node = Node()
+        node.name = 'node_1'
+        node.data = {'foo': ['bar']}
+        node.save()
+        node = Node(node.id)
+
+        def _get_row():
+            return tuple(Node.connector().execute('SELECT name, data, enabled FROM node WHERE id=?', [node.id]).fetchone())
+
+        with Node.connector() as connection:
+            connection.execute('UPDATE node SET name=? WHERE id=?', ['changed', node.id])
+        node.save()  # Nothing changed
+        self.assertEqual(_get_row(), ('changed', '{"foo": ["bar"]}', 0))
+        node.data['foo'].append('baz')
+        node.enabled = True
+        node.save()  # Only the changed columns are written
+        self.assertEqual(_get_row(), ('changed', '{"foo": ["bar", "baz"]}', 1))
+        self.assertEqual(Base._update_statements[(Node, (1, 2))], 'UPDATE node SET data=?, enabled=? WHERE id=? LIMIT 1')
+
+        node.name = 'node_2'
+        Base.bulk_save([node])
+        self.assertEqual(_get_row(), ('node_2', '{"foo": ["bar", "baz"]}', 1))
+        with Node.connector() as connection:
+            connection.execute('UPDATE node SET name=? WHERE id=?', ['changed', node.id])
+        Base.bulk_save([node])
+        self.assertEqual(_get_row()[0], 'changed')
+
+    def test_indexes(self):
+        """
+        Validates the creation of the indexes
+        """
+        Setting._ensure_table()
+        indexes = [row['name'] for row in Setting.connector().execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='setting'")]
+        self.assertEqual(sorted(indexes), ['setting_key_index', 'setting_node_index', 'setting_node_key_index'])
+        self.assertIn('INDEX setting_key_index', DataList.get_query_plan(Setting, 'SELECT id FROM {table} WHERE key=?', ['foo'])[0])
+        self.assertIn('INDEX setting_node_key_index', DataList.get_query_plan(Setting, 'SELECT id FROM {table} WHERE node_id=? AND key=?', [1, 'foo'])[0])
+        self.assertIn('INDEX setting_node_index', DataList.get_query_plan(Setting, 'SELECT * FROM {table} WHERE node_id=?', [1])[0])
+        self.assertIn('SCAN', DataList.get_query_plan(Setting, 'SELECT id FROM {table} WHERE value=?', ['foo'])[0])
+
+        Base._schemas.clear()
+        Setting._ensure_table()  # Creating the indexes is idempotent
+        Setting.migrate()  # Rebuilding the table keeps the indexes
+        indexes = [row['name'] for row in Setting.connector().execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='setting'")]
+        self.assertEqual(len(indexes), 3)
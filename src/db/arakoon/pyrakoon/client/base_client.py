@@ -168,6 +168,21 @@ class PyrakoonBase(object):
         """
         raise NotImplementedError()
 
+    def test_and_set(self, key, old_value, new_value):
+        # type: (str, Optional[str], Optional[str]) -> Optional[str]
+        """
+        Updates the value of a key only if its current value equals the given old value
+        :param key: The key to update
+        :type key: str
+        :param old_value: The expected current value. None when the key is expected not to exist
+        :type old_value: str
+        :param new_value: The value to set. None to remove the key
+        :type new_value: str
+        :return: The value of the key before the operation. The update was executed if it equals old_value
+        :rtype: str
+        """
+        raise NotImplementedError()
+
     def assert_exists(self, key, transaction=None):
         # type: (str, str) -> None
         """
@@ -25,12 +25,13 @@ import ujson
 import random
 import logging
 from functools import wraps
-from threading import RLock, current_thread
+from threading import Lock, RLock, current_thread
 from .base_client import PyrakoonBase
 from .exceptions import NoLockAvailableException
 from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.compat import Sequence, ArakoonAssertionFailed, ArakoonClient, ArakoonClientConfig, \
     ArakoonGoingDown, ArakoonNotFound, ArakoonNodeNotMaster, ArakoonNoMaster, ArakoonNotConnected, \
-    ArakoonSocketException, ArakoonSockNotReadable, ArakoonSockReadNoBytes, ArakoonSockSendError, Consistency
+    ArakoonSocketException, ArakoonSockNotReadable, ArakoonSockReadNoBytes, ArakoonSockSendError, AtLeast, Consistency
+from ovs_extensions.generic.lockprofiler import LockProfiler, ProfiledLock
 from ovs_extensions.generic.repeatingtimer import RepeatingTimer
 
 
@@ -153,7 +154,7 @@ class PyrakoonClient(PyrakoonBase):
         for node, info in nodes.iteritems():
             cleaned_nodes[str(node)] = ([str(entry) for entry in info[0]], int(info[1]))
         # Synchronization
-        self._lock = RLock()
+        self._lock = ProfiledLock(RLock(), 'pyrakoon_client:{0}'.format(cluster))
         # Wrapping
         self._config = ArakoonClientConfig(str(cluster), cleaned_nodes)
         self._client = ArakoonClient(self._config, timeout=5, noMasterTimeout=5)
@@ -365,6 +366,47 @@ class PyrakoonClient(PyrakoonBase):
             return self._sequences[transaction].addAssertExists(key)
         return self._client.aSSert_exists(key)
 
+    @locked()
+    @handle_arakoon_errors(is_read_only=True)
+    def get_txid(self):
+        # type: () -> int
+        """
+        Retrieve the last transaction id that was seen by this client
+        :return: The transaction id. 0 when no transaction has been seen yet
+        :rtype: int
+        """
+        txid = self._client.get_txid()
+        if isinstance(txid, AtLeast):
+            return txid.i
+        return 0
+
+    @locked()
+    def close(self):
+        # type: () -> None
+        """
+        Closes all connections towards the cluster. The client reconnects when it is used again
+        :return: None
+        :rtype: NoneType
+        """
+        self._client.dropConnections()
+
+    @locked()
+    @handle_arakoon_errors(is_read_only=False)
+    def test_and_set(self, key, old_value, new_value):
+        # type: (str, Optional[str], Optional[str]) -> Optional[str]
+        """
+        Updates the value of a key only if its current value equals the given old value
+        :param key: The key to update
+        :type key: str
+        :param old_value: The expected current value. None when the key is expected not to exist
+        :type old_value: str
+        :param new_value: The value to set. None to remove the key
+        :type new_value: str
+        :return: The value of the key before the operation. The update was executed if it equals old_value
+        :rtype: str
+        """
+        return self._client.testAndSet(key, old_value, new_value)
+
     def begin_transaction(self):
         # type: () -> str
         """
@@ -471,38 +513,54 @@ class PyrakoonClient(PyrakoonBase):
 
 class PyrakoonLock(object):
     """
-    Lock implementation around Arakoon
+    Lease based lock on top of Arakoon
     To be used as a context manager
+    * The lease key holds the owner, a fencing token and a renewal counter. It is only changed by a test_and_set or by a
+      sequence asserting its previous value, and is never removed so the fencing token keeps increasing
+    * Every acquisition increases the fencing token and publishes it under the fence key. Writes protected by the lock
+      include `fence(transaction)` so they are refused once another instance has taken over the lock
+    * The holder renews the lease in the background. Waiters don't compare timestamps, which would suffer from clock
+      skew between nodes: a lease has expired when a waiter observed it unchanged for longer than the expiration time
+    * Waiters poll the lease key with a short, exponentially increasing back-off
     """
-    LOCK_LOCATION = '/ovs/locks/{0}'
-    EXPIRATION_KEY = 'expires'
+    LEASE_LOCATION = '/ovs/leases/{0}'
+    FENCE_LOCATION = '/ovs/leases/{0}/fence'
+
+    # Back-off between two polls of the lease key (in seconds)
+    BACKOFF_MIN = 0.005
+    BACKOFF_MAX = 0.25
+    BACKOFF_MULTIPLIER = 1.5
 
     _logger = logging.getLogger(__name__)
 
     def __init__(self, client, name, wait=None, expiration=60):
         # type: (PyrakoonClient, str, float, float) -> None
         """
-        Initialize a ConfigurationLock
+        Initialize a PyrakoonLock
         :param client: PyrakoonClient to work with
         :type client: PyrakoonClient
         :param name: Name of the lock to acquire.
         :type name: str
-        :param expiration: Expiration time of the lock (in seconds)
+        :param expiration: Duration of the lease (in seconds). The lease is renewed while the lock is held, so
+        it only expires when the holder is unable to renew it (eg. the process died)
         :type expiration: float
         :param wait: Amount of time to wait to acquire the lock (in seconds)
         :type wait: float
         """
-        raise NotImplementedError('The Pyrakoon lease mechanism has not been properly implemented')
         self.id = str(uuid.uuid4())
         self.name = name
+        self.fencing_token = None
         self._client = client
         self._expiration = expiration
-        self._data_set = None
-        self._key = self.LOCK_LOCATION.format(self.name)
+        self._key = self.LEASE_LOCATION.format(self.name)
+        self._fence_key = self.FENCE_LOCATION.format(self.name)
         self._wait = wait
         self._start = 0
+        self._lease = None
         self._has_lock = False
-        self._refresher = None
+        self._lost = False
+        self._renewer = None
+        self._state_lock = Lock()
 
     def __enter__(self):
         # type: () -> PyrakoonLock
@@ -526,105 +584,173 @@ class PyrakoonLock(object):
         self._start = time.time()
         if wait is None:
             wait = self._wait
-        while self._client.exists(self._key):
-            time.sleep(0.005)
-            # Check if it has expired
+        backoff = self.BACKOFF_MIN
+        contended = False
+        observed = None
+        observed_since = None
+        while True:
             try:
-                original_lock_data = self._client.get(self._key)
-                lock_data = ujson.loads(original_lock_data)
+                lease = self._client.get(self._key)
+                lease_data = ujson.loads(lease)
             except ArakoonNotFound:
-                self._logger.debug('Unable to retrieve data: Key {0} was removed in meanwhile'.format(self._key))
-                continue  # Key was removed in meanwhile
-            except Exception:
-                self._logger.exception('Unable to retrieve the data of key {0}'.format(self._key))
+                lease = None
+                lease_data = {'id': None, 'token': 0}
+            now = time.time()
+            if observed_since is None or lease != observed:
+                observed = lease
+                observed_since = now
+            if lease_data['id'] is None:
+                if self._take(lease, lease_data['token']) is True:
+                    break
+                continue  # Lost the race with another instance
+            contended = True
+            if now - observed_since > self._expiration:
+                self._logger.info('Lease {0} (lock id: {1}) was not renewed within {2} sec. Taking it over'.format(self._key, lease_data['id'], self._expiration))
+                if self._take(lease, lease_data['token']) is True:
+                    break
                 continue
-            expiration = lock_data.get(self.EXPIRATION_KEY, None)
-            if expiration is None or time.time() > expiration:
-                self._logger.info('Expiration for key {0} (lock id: {1}) was reached. Looking to remove it.'.format(self._key, lock_data['id']))
-                # Remove the expired lock
-                transaction = self._client.begin_transaction()
-                self._client.assert_value(self._key, original_lock_data, transaction=transaction)
-                self._client.delete(self._key, transaction=transaction)
-                try:
-                    self._client.apply_transaction(transaction)
-                except ArakoonAssertionFailed:
-                    self._logger.warning('Lost the race to cleanup the expired key {0}.'.format(self._key))
-                except:
-                    self._logger.exception('Unable to remove the expired entry')
-                continue  # Always check the key again even when errors occurred
-            passed = time.time() - self._start
+            passed = now - self._start
             if wait is not None and passed > wait:
+                if LockProfiler.enabled is True:
+                    LockProfiler.record_acquire('pyrakoon_lock:{0}'.format(self.name), passed, contended=True, timeout=True)
                 self._logger.error('Lock for {0} could not be acquired. {1} sec > {2} sec'.format(self._key, passed, wait))
                 raise NoLockAvailableException('Could not acquire lock {0}'.format(self._key))
-        # Create the lock entry
-        transaction = self._client.begin_transaction()
-        self._client.assert_value(self._key, None, transaction=transaction)  # Key shouldn't exist
-        data_to_set = self._get_lock_data()
-        self._client.set(self._key, data_to_set, transaction=transaction)
-        try:
-            self._client.apply_transaction(transaction)
-            self._data_set = data_to_set
-            self._logger.debug('Acquired lock {0}'.format(self._key))
-        except ArakoonAssertionFailed:
-            self._logger.info('Lost the race with another lock, back to acquiring')
-            return self.acquire(wait)
-        except:
-            self._logger.exception('Exception occurred while setting the lock')
-            raise
+            sleep_time = backoff * random.uniform(0.5, 1)
+            if wait is not None:
+                sleep_time = min(sleep_time, max(wait - passed, 0))
+            time.sleep(sleep_time)
+            backoff = min(backoff * self.BACKOFF_MULTIPLIER, self.BACKOFF_MAX)
+        self._renewer = RepeatingTimer(max(self._expiration / 3.0, 0.01), self._renew)
+        self._renewer.daemon = True
+        self._renewer.start()
         passed = time.time() - self._start
         if passed > 0.2:  # More than 200 ms is a long time to wait
             if self._logger is not None:
                 self._logger.warning('Waited {0} sec for lock {1}'.format(passed, self._key))
+        if LockProfiler.enabled is True:
+            LockProfiler.record_acquire('pyrakoon_lock:{0}'.format(self.name), passed, contended=contended)
+        self._logger.debug('Acquired lock {0} with fencing token {1}'.format(self._key, self.fencing_token))
         self._start = time.time()
-        self._has_lock = True
-        self._refresher = RepeatingTimer(5, self.refresh_lock)
         return True
 
-    def _get_lock_data(self):
-        now = time.time()
-        return ujson.dumps({'time_set': now, self.EXPIRATION_KEY: now + self._expiration, 'id': self.id})
-
     def release(self):
         # type: () -> None
         """
         Releases the lock
         """
-        if self._has_lock and self._data_set and self._refresher:
-            self._refresher.cancel()
-            self._refresher.join()
-            transaction = self._client.begin_transaction()
-            self._client.assert_value(self._key, self._data_set, transaction=transaction)
-            self._client.delete(self._key, transaction=transaction)
-            try:
-                self._client.apply_transaction(transaction)
-                self._logger.debug('Removed lock {0}'.format(self._key))
-            except ArakoonAssertionFailed:
-                self._logger.warning('The lock was removed and possible in use. Another client must have cleaned up the expired entry')
-            except:
-                self._logger.exception('Unable to remove the lock')
-                raise
+        if self._has_lock:
+            self._stop_renewer()
+            with self._state_lock:
+                if self._lost is False:
+                    free = ujson.dumps({'id': None, 'token': self.fencing_token, 'renewal': 0})
+                    try:
+                        original = self._client.test_and_set(self._key, self._lease, free)
+                    except ArakoonNotFound:
+                        original = None
+                    if original == self._lease:
+                        self._logger.debug('Released lock {0}'.format(self._key))
+                    else:
+                        self._logger.warning('The lease {0} was taken over by another instance'.format(self._key))
+                self._lease = None
+                self._has_lock = False
             passed = time.time() - self._start
             if passed > 0.5:  # More than 500 ms is a long time to hold a lock
                 if self._logger is not None:
                     self._logger.warning('A lock on {0} was kept for {1} sec'.format(self._key, passed))
-            self._has_lock = False
+            if LockProfiler.enabled is True:
+                LockProfiler.record_release('pyrakoon_lock:{0}'.format(self.name), passed)
 
-    def refresh_lock(self):
+    def is_held(self):
+        # type: () -> bool
         """
-        Refreshes the lock by setting now expiration dates
+        Verify whether this instance still holds the lock. False once a renewal noticed that the lease was taken over
+        :return: True if the lock is held, False otherwise
+        :rtype: bool
         """
-        if self._has_lock and self._data_set is not None:
-            transaction = self._client.begin_transaction()
-            self._client.assert_value(self._key, self._data_set, transaction=transaction)
-            data_to_set = self._get_lock_data()
-            self._client.set(self._key, data_to_set, transaction=transaction)
+        return self._has_lock is True and self._lost is False
+
+    def fence(self, transaction):
+        # type: (str) -> None
+        """
+        Protect a transaction: it will only be applied when no other instance has acquired the lock in the meantime
+        :param transaction: Transaction to protect
+        :type transaction: str
+        :raises NoLockAvailableException: when the lock is not held
+        :return: None
+        :rtype: NoneType
+        """
+        if not self.is_held():
+            raise NoLockAvailableException('Lock {0} is not held'.format(self._key))
+        self._client.assert_value(self._fence_key, str(self.fencing_token), transaction=transaction)
+
+    def _take(self, lease, token):
+        # type: (Optional[str], int) -> bool
+        """
+        Take the lease, expecting it to still have the given value
+        :param lease: The value of the lease key as last seen
+        :type lease: str
+        :param token: The fencing token stored in the lease
+        :type token: int
+        :return: True if the lease was taken, False if the lease was changed in the meantime
+        :rtype: bool
+        """
+        try:
+            fence = self._client.get(self._fence_key)
+        except ArakoonNotFound:
+            fence = None
+        token = max(token, int(fence or 0)) + 1
+        data_to_set = ujson.dumps({'id': self.id, 'token': token, 'renewal': 0})
+        transaction = self._client.begin_transaction()
+        self._client.assert_value(self._key, lease, transaction=transaction)
+        self._client.assert_value(self._fence_key, fence, transaction=transaction)
+        self._client.set(self._key, data_to_set, transaction=transaction)
+        self._client.set(self._fence_key, str(token), transaction=transaction)
+        try:
+            self._client.apply_transaction(transaction)
+        except ArakoonAssertionFailed:
+            self._logger.debug('Lost the race for lease {0}'.format(self._key))
+            return False
+        with self._state_lock:
+            self._lease = data_to_set
+            self.fencing_token = token
+            self._lost = False
+            self._has_lock = True
+        return True
+
+    def _renew(self):
+        # type: () -> None
+        """
+        Renews the lease. Executed by the renewer in the background
+        :return: None
+        :rtype: NoneType
+        """
+        with self._state_lock:
+            if self._has_lock is False or self._lost is True:
+                return
+            lease_data = ujson.loads(self._lease)
+            lease_data['renewal'] += 1
+            data_to_set = ujson.dumps(lease_data)
             try:
-                self._client.apply_transaction(transaction)
-                self._data_set = data_to_set
-                self._logger.debug('Refreshed lock {0}'.format(self._key))
-            except ArakoonAssertionFailed:
-                self._logger.exception('The lock was taken over by another instance')
-                raise
-            except:
-                self._logger.exception('Unable to remove the lock')
-                raise
\ No newline at end of file
+                original = self._client.test_and_set(self._key, self._lease, data_to_set)
+            except ArakoonNotFound:
+                original = None
+            except Exception:
+                self._logger.exception('Unable to renew lease {0}'.format(self._key))
+                return
+            if original == self._lease:
+                self._lease = data_to_set
+            else:
+                self._lost = True
+                self._logger.error('The lease {0} was taken over by another instance'.format(self._key))
+
+    def _stop_renewer(self):
+        # type: () -> None
+        """
+        Stops the background renewer
+        :return: None
+        :rtype: NoneType
+        """
+        if self._renewer is not None:
+            self._renewer.cancel()
+            self._renewer.join()
+            self._renewer = None
@@ -17,6 +17,7 @@ import uuid
 import time
 import random
 from .base_client import PyrakoonBase
+from .client import PyrakoonLock
 from .client_pool import PyrakoonPool
 from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.compat import Sequence, ArakoonAssertionFailed, Consistency
 from ovs_extensions.log.logger import Logger
@@ -179,6 +180,22 @@ class PyrakoonClientPooled(PyrakoonBase):
         with self._pool.get_client() as client:
             return client.exists(key)
 
+    def test_and_set(self, key, old_value, new_value):
+        # type: (str, Optional[str], Optional[str]) -> Optional[str]
+        """
+        Updates the value of a key only if its current value equals the given old value
+        :param key: The key to update
+        :type key: str
+        :param old_value: The expected current value. None when the key is expected not to exist
+        :type old_value: str
+        :param new_value: The value to set. None to remove the key
+        :type new_value: str
+        :return: The value of the key before the operation. The update was executed if it equals old_value
+        :rtype: str
+        """
+        with self._pool.get_client() as client:
+            return client.test_and_set(key, old_value, new_value)
+
     def assert_value(self, key, value, transaction=None):
         # type: (str, any, str) -> None
         """
@@ -269,7 +286,7 @@ class PyrakoonClientPooled(PyrakoonBase):
         :return: The lock implementation
         :rtype: PyrakoonLock
         """
-        raise NotImplementedError('')
+        return PyrakoonLock(self, name, wait, expiration)
 
     def apply_callback_transaction(self, transaction_callback, max_retries=0, retry_wait_function=None):
         # type: (callable, int, callable) -> None
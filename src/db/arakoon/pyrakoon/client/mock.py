@@ -162,6 +162,21 @@ class MockPyrakoonClient(PyrakoonBase):
         if ujson.dumps(data[key], sort_keys=True) != ujson.dumps(value, sort_keys=True):
             raise ArakoonNotFound(key)
 
+    @locked()
+    def test_and_set(self, key, old_value, new_value):
+        """
+        Updates the value of a key only if its current value equals the given old value
+        """
+        data = self._read()
+        original_value = data.get(key)
+        if original_value == old_value:
+            if new_value is None:
+                data.pop(key, None)
+            else:
+                data[key] = copy.deepcopy(new_value)
+            self._write(data)
+        return original_value
+
     @locked()
     def assert_exists(self, key, transaction=None):
         """
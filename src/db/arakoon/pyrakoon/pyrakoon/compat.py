@@ -32,6 +32,7 @@ import time
 
 from protocol import admin
 from ovs_extensions.db.arakoon.pyrakoon.pyrakoon import client, consistency, errors, protocol, sequence, utils
+from ovs_extensions.generic.lockprofiler import ProfiledLock
 
 __docformat__ = 'epytext'
 
@@ -1111,7 +1112,7 @@ class _ArakoonClient(object, client.AbstractClient, client.ClientMixin):
         self._config = config
         self.master_id = None
 
-        self._lock = threading.RLock()
+        self._lock = ProfiledLock(threading.RLock(), 'arakoon_client:{0}'.format(config.getClusterId()))
         self._connections = dict()
         self._timeout = timeout
         if (isinstance(timeout, (int, float)) and timeout > 0) or timeout is None:
@@ -29,7 +29,7 @@ try:
 except ImportError:
     import StringIO
 
-from ovs_extensions.db.arakoon.pyrakoon.pyrakoon import client, compat, errors, protocol, utils
+from ovs_extensions.db.arakoon.pyrakoon.pyrakoon import client, compat, errors, protocol, sequence, utils
 
 LOGGER = logging.getLogger(__name__)
 
@@ -206,6 +206,200 @@ class FakeClient(object, client.AbstractClient, client.ClientMixin):
                 orig_value):
                 yield rbytes
 
+        def handle_sequence():
+            '''Handle a "sequence" or "synced_sequence" command'''
+
+            sequence_bytes = StringIO.StringIO(recv(protocol.STRING)).read
+            recv_step = lambda type_: utils.read_blocking(type_.receive(), sequence_bytes)
+            values = dict(self._values)
+
+            def apply_step():
+                '''Apply a single (possibly nested) step on the copy of the values'''
+
+                tag = recv_step(protocol.UINT32)
+                if tag == sequence.Sequence.TAG:
+                    for _ in xrange(recv_step(protocol.UINT32)):
+                        apply_step()
+                elif tag == sequence.Set.TAG:
+                    key = recv_step(protocol.STRING)
+                    values[key] = recv_step(protocol.STRING)
+                elif tag == sequence.Delete.TAG:
+                    key = recv_step(protocol.STRING)
+                    if key not in values:
+                        raise errors.NotFound(key)
+                    del values[key]
+                elif tag == sequence.DeletePrefix.TAG:
+                    prefix = recv_step(protocol.STRING)
+                    for key in [key for key in values if key.startswith(prefix)]:
+                        del values[key]
+                elif tag == sequence.Assert.TAG:
+                    key = recv_step(protocol.STRING)
+                    if values.get(key) != recv_step(protocol.Option(protocol.STRING)):
+                        raise errors.AssertionFailed(key)
+                elif tag == sequence.AssertExists.TAG:
+                    key = recv_step(protocol.STRING)
+                    if key not in values:
+                        raise errors.AssertionFailed(key)
+                elif tag == sequence.Replace.TAG:
+                    key = recv_step(protocol.STRING)
+                    wanted = recv_step(protocol.Option(protocol.STRING))
+                    if wanted is None:
+                        values.pop(key, None)
+                    else:
+                        values[key] = wanted
+                else:
+                    raise errors.UnknownFailure('Unsupported step {0}'.format(tag))
+
+            try:
+                apply_step()
+            except errors.ArakoonError as exception:
+                for rbytes in protocol.UINT32.serialize(exception.CODE):
+                    yield rbytes
+                for rbytes in protocol.STRING.serialize(str(exception.args[0])):
+                    yield rbytes
+                return
+
+            # All steps succeeded
+            self._values = values
+
+            for rbytes in protocol.UINT32.serialize(
+                protocol.RESULT_SUCCESS):
+                yield rbytes
+
+
+        def fail(exception_type, message):
+            '''Serialize a failure'''
+
+            for rbytes in protocol.UINT32.serialize(exception_type.CODE):
+                yield rbytes
+            for rbytes in protocol.STRING.serialize(message):
+                yield rbytes
+
+        def succeed(type_=None, value=None):
+            '''Serialize a successful result'''
+
+            for rbytes in protocol.UINT32.serialize(
+                protocol.RESULT_SUCCESS):
+                yield rbytes
+            if type_ is not None:
+                for rbytes in type_.serialize(value):
+                    yield rbytes
+
+        def receive_range():
+            '''Receive the arguments of a "range" or "range_entries" command
+            and return the matching keys, in order'''
+
+            _ = recv(protocol.CONSISTENCY)
+            begin_key = recv(protocol.Option(protocol.STRING))
+            begin_inclusive = recv(protocol.BOOL)
+            end_key = recv(protocol.Option(protocol.STRING))
+            end_inclusive = recv(protocol.BOOL)
+            max_elements = recv(protocol.INT32)
+
+            matches = []
+            for key in sorted(self._values):
+                if begin_key is not None and (key < begin_key or
+                        (key == begin_key and not begin_inclusive)):
+                    continue
+                if end_key is not None and (key > end_key or
+                        (key == end_key and not end_inclusive)):
+                    break
+                matches.append(key)
+                if len(matches) == max_elements:
+                    break
+            return matches
+
+        def handle_range():
+            '''Handle a "range" command'''
+
+            matches = receive_range()
+            # Lists are received back to front
+            return succeed(protocol.List(protocol.STRING), reversed(matches))
+
+        def handle_range_entries():
+            '''Handle a "range_entries" command'''
+
+            matches = receive_range()
+            return succeed(protocol.List(protocol.Product(protocol.STRING,
+                protocol.STRING)), [(key, self._values[key])
+                    for key in reversed(matches)])
+
+        def handle_multi_get():
+            '''Handle a "multi_get" command'''
+
+            _ = recv(protocol.CONSISTENCY)
+            # Lists are received back to front
+            keys = recv(protocol.List(protocol.STRING))[::-1]
+
+            for key in keys:
+                if key not in self._values:
+                    return fail(errors.NotFound, key)
+            return succeed(protocol.List(protocol.STRING),
+                [self._values[key] for key in reversed(keys)])
+
+        def handle_multi_get_option():
+            '''Handle a "multi_get_option" command'''
+
+            _ = recv(protocol.CONSISTENCY)
+            # Lists are received back to front
+            keys = recv(protocol.List(protocol.STRING))[::-1]
+
+            def serialize():
+                '''Arrays are received front to back'''
+                for rbytes in succeed(protocol.UINT32, len(keys)):
+                    yield rbytes
+                for key in keys:
+                    for rbytes in protocol.Option(protocol.STRING).serialize(
+                        self._values.get(key)):
+                        yield rbytes
+            return serialize()
+
+        def handle_replace():
+            '''Handle a "replace" command'''
+
+            key = recv(protocol.STRING)
+            value = recv(protocol.Option(protocol.STRING))
+
+            orig_value = self._values.pop(key, None)
+            if value is not None:
+                self._values[key] = value
+            return succeed(protocol.Option(protocol.STRING), orig_value)
+
+        def handle_delete_prefix():
+            '''Handle a "delete_prefix" command'''
+
+            prefix = recv(protocol.STRING)
+
+            keys = [key for key in self._values if key.startswith(prefix)]
+            for key in keys:
+                del self._values[key]
+            return succeed(protocol.UINT32, len(keys))
+
+        def handle_nop():
+            '''Handle a "nop" command'''
+
+            return succeed()
+
+        def handle_assert():
+            '''Handle an "assert" command'''
+
+            _ = recv(protocol.CONSISTENCY)
+            key = recv(protocol.STRING)
+            value = recv(protocol.Option(protocol.STRING))
+
+            if self._values.get(key) != value:
+                return fail(errors.AssertionFailed, key)
+            return succeed()
+
+        def handle_assert_exists():
+            '''Handle an "assert_exists" command'''
+
+            _ = recv(protocol.CONSISTENCY)
+            key = recv(protocol.STRING)
+
+            if key not in self._values:
+                return fail(errors.AssertionFailed, key)
+            return succeed()
 
         handlers = {
             protocol.Hello.TAG: handle_hello,
@@ -216,6 +410,17 @@ class FakeClient(object, client.AbstractClient, client.ClientMixin):
             protocol.Delete.TAG: handle_delete,
             protocol.PrefixKeys.TAG: handle_prefix_keys,
             protocol.TestAndSet.TAG: handle_test_and_set,
+            0x0010 | protocol.Message.MASK: handle_sequence,
+            0x0024 | protocol.Message.MASK: handle_sequence,
+            protocol.Range.TAG: handle_range,
+            protocol.RangeEntries.TAG: handle_range_entries,
+            protocol.MultiGet.TAG: handle_multi_get,
+            protocol.MultiGetOption.TAG: handle_multi_get_option,
+            protocol.Replace.TAG: handle_replace,
+            protocol.DeletePrefix.TAG: handle_delete_prefix,
+            protocol.Nop.TAG: handle_nop,
+            protocol.Assert.TAG: handle_assert,
+            protocol.AssertExists.TAG: handle_assert_exists,
         }
 
         if command in handlers:
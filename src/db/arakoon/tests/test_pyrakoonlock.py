@@ -0,0 +1,156 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Test module for the lease based PyrakoonLock
+"""
+import time
+import ujson
+import unittest
+from threading import Thread
+from ovs_extensions.db.arakoon.pyrakoon.client import client as client_module
+from ovs_extensions.db.arakoon.pyrakoon.client import NoLockAvailableException, PyrakoonClient
+from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.compat import ArakoonAssertionFailed
+from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.test import FakeClient
+
+
+class _SkewedTime(object):
+    """
+    Replaces the time module of the lock implementation by a clock which is off by a given amount of seconds
+    """
+    def __init__(self, skew):
+        self.skew = skew
+
+    def time(self):
+        return time.time() + self.skew
+
+    @staticmethod
+    def sleep(seconds):
+        time.sleep(seconds)
+
+
+class PyrakoonLockTest(unittest.TestCase):
+    """
+    Test the PyrakoonLock against the in-memory FakeClient
+    """
+
+    def setUp(self):
+        self.client = PyrakoonClient('test', {'arakoon0': (['127.0.0.1'], 26400)})
+        self.client._client._client = FakeClient()
+
+    def tearDown(self):
+        client_module.time = time
+
+    def _protected_write(self, lock, value):
+        transaction = self.client.begin_transaction()
+        lock.fence(transaction)
+        self.client.set('protected', value, transaction=transaction)
+        self.client.apply_transaction(transaction)
+
+    def test_fencing_tokens(self):
+        """
+        Every acquisition gets a higher fencing token, also after the lease was released
+        """
+        lock = self.client.lock('test')
+        with lock:
+            self.assertEqual(lock.fencing_token, 1)
+            self.assertTrue(lock.is_held())
+            self._protected_write(lock, 'first')
+        self.assertFalse(lock.is_held())
+        self.assertEqual(ujson.loads(self.client.get(lock._key)), {'id': None, 'token': 1, 'renewal': 0})
+        with self.assertRaises(NoLockAvailableException):
+            self._protected_write(lock, 'not held')
+        with self.client.lock('test') as other_lock:
+            self.assertEqual(other_lock.fencing_token, 2)
+            self.assertEqual(self.client.get(other_lock._fence_key), '2')
+        with lock:
+            self.assertEqual(lock.fencing_token, 3)
+        self.assertEqual(self.client.get('protected'), 'first')
+
+    def test_handover(self):
+        """
+        Waiters never hold the lock together and acquire it shortly after it was released
+        """
+        holders = []
+        overlaps = []
+        delays = []
+
+        def _run():
+            for _ in xrange(5):
+                start = time.time()
+                with self.client.lock('test', wait=10, expiration=1):
+                    delays.append(time.time() - start)
+                    holders.append(True)
+                    if len(holders) > 1:
+                        overlaps.append(True)
+                    time.sleep(0.01)
+                    holders.pop()
+
+        threads = [Thread(target=_run) for _ in xrange(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlaps, [])
+        self.assertEqual(len(delays), 15)
+        self.assertEqual(ujson.loads(self.client.get(PyrakoonClient.lock(self.client, 'test')._key))['token'], 15)
+
+    def test_process_death(self):
+        """
+        A lease which is no longer renewed is taken over and the previous holder is fenced off
+        """
+        holder = self.client.lock('test', expiration=0.5)
+        holder.acquire()
+        holder._stop_renewer()  # The process died: the lease is neither renewed nor released
+
+        waiter = self.client.lock('test', expiration=0.5)
+        start = time.time()
+        waiter.acquire(wait=5)
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertEqual(waiter.fencing_token, 2)
+        self._protected_write(waiter, 'waiter')
+
+        # The previous holder resumes: its writes are refused, renewing reveals the lost lease and releasing is harmless
+        with self.assertRaises(ArakoonAssertionFailed):
+            self._protected_write(holder, 'holder')
+        holder._renew()
+        self.assertFalse(holder.is_held())
+        holder.release()
+        self.assertTrue(waiter.is_held())
+        self.assertEqual(ujson.loads(self.client.get(waiter._key))['id'], waiter.id)
+        waiter.release()
+        self.assertEqual(self.client.get('protected'), 'waiter')
+
+    def test_clock_skew(self):
+        """
+        A waiter with a clock far ahead does not consider a renewed lease as expired
+        """
+        holder = self.client.lock('test', expiration=0.5)
+        holder.acquire()
+        self.assertEqual(sorted(ujson.loads(self.client.get(holder._key)).keys()), ['id', 'renewal', 'token'])  # No timestamps
+
+        client_module.time = _SkewedTime(3600)
+        waiter = self.client.lock('test', expiration=0.5)
+        with self.assertRaises(NoLockAvailableException):
+            waiter.acquire(wait=1.5)
+        self.assertTrue(holder.is_held())
+        self.assertGreater(ujson.loads(self.client.get(holder._key))['renewal'], 2)
+
+        holder.release()
+        client_module.time = _SkewedTime(-3600)
+        with waiter:
+            self.assertEqual(waiter.fencing_token, 2)
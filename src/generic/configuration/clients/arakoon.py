@@ -18,22 +18,31 @@
 Generic module for managing configuration in Arakoon
 """
 import re
+import copy
 import uuid
 import time
 import ujson
+import random
 import urllib
 import logging
 from ConfigParser import RawConfigParser
+from threading import Lock
 from ovs_extensions.generic.configuration.clients.base_keyvalue import ConfigurationBaseKeyValue
 from ovs_extensions.generic.configuration import NoLockAvailableException
-from ovs_extensions.db.arakoon.pyrakoon.client import PyrakoonClient, ArakoonAssertionFailed, ArakoonNotFound
+from ovs_extensions.generic.lockprofiler import LockProfiler
+from ovs_extensions.db.arakoon.pyrakoon.client import PyrakoonClient
+from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.compat import ArakoonAssertionFailed, ArakoonNotFound
+from ovs_extensions.generic.repeatingtimer import RepeatingTimer
 
 
 class ArakoonConfiguration(ConfigurationBaseKeyValue):
     """
     Client for Configuration Management in Arakoon
+    The PyrakoonClient serializes all calls so a client is built for every thread
     """
 
+    CLIENT_PER_THREAD = True
+
     def __init__(self, cacc_location, *args, **kwargs):
         # type: (str, *any, **any) -> None
         self.cacc_location = cacc_location
@@ -110,6 +119,15 @@ class ArakoonConfiguration(ConfigurationBaseKeyValue):
             nodes[node] = ([parser.get(node, 'ip')], parser.get(node, 'client_port'))
         return PyrakoonClient(parser.get('global', 'cluster_id'), nodes)
 
+    def close(self):
+        # type: () -> None
+        """
+        Closes the connections of the underlying PyrakoonClient
+        :return: None
+        :rtype: NoneType
+        """
+        self._client.close()
+
     @staticmethod
     def _clean_key(key):
         # type: (str) -> str
@@ -149,36 +167,62 @@ class ArakoonConfigurationLock(object):
     """
     Lock implementation around Arakoon
     To be used as a context manager
+    Waiters are queued fairly: every waiter draws a ticket and appends a sequenced entry under the queue of the lock.
+    A waiter only polls the entry of its predecessor (with an adaptive back-off) instead of spinning on the lock key.
+    The lock key itself remains the actual mutex so instances using the previous implementation are still excluded.
+    While waiting or holding, both the queue entry and the lock key are refreshed in the background
     """
     LOCK_LOCATION = '/ovs/locks/{0}'
+    QUEUE_LOCATION = '/ovs/locks/{0}/queue/'
+    TICKET_LOCATION = '/ovs/locks/{0}/ticket'
     EXPIRATION_KEY = 'expires'
 
+    # Adaptive back-off between two polls of the predecessor (in seconds)
+    BACKOFF_MIN = 0.005
+    BACKOFF_MAX = 0.25
+    BACKOFF_MULTIPLIER = 1.5
+
     _logger = logging.getLogger(__name__)
+    _metrics = {}
+    _metrics_lock = Lock()
 
-    def __init__(self, cacc_location, name, wait=None, expiration=60):
-        # type: (str, str, float, float) -> None
+    def __init__(self, cacc_location, name, wait=None, expiration=60, client=None):
+        # type: (str, str, float, float, PyrakoonClient) -> None
         """
         Initialize a ConfigurationLock
         :param cacc_location: Path to the the configuration file
         :type cacc_location: str
         :param name: Name of the lock to acquire.
         :type name: str
-        :param expiration: Expiration time of the lock (in seconds)
+        :param expiration: Expiration time of the lock (in seconds). The lock is refreshed while it is held, so
+        it only expires when the holder is unable to refresh it (eg. the process died)
         :type expiration: float
         :param wait: Amount of time to wait to acquire the lock (in seconds)
         :type wait: float
+        :param client: Client to use. Defaults to a new client built from the cacc_location
+        :type client: PyrakoonClient
         """
         self.id = str(uuid.uuid4())
         self.name = name
         self._cacc_location = cacc_location
-        config = ArakoonConfiguration(self._cacc_location)
-        self._client = config.get_client()
+        if client is None:
+            config = ArakoonConfiguration(self._cacc_location)
+            client = config.get_client()
+        self._client = client
         self._expiration = expiration
         self._data_set = None
         self._key = self.LOCK_LOCATION.format(self.name)
+        self._queue_prefix = self.QUEUE_LOCATION.format(self.name)
+        self._ticket_key = self.TICKET_LOCATION.format(self.name)
+        self._queue_key = None
         self._wait = wait
         self._start = 0
         self._has_lock = False
+        self._refresher = None
+        self._state_lock = Lock()
+        # Metrics of the last acquire/release
+        self.wait_time = None
+        self.hold_time = None
 
     def __enter__(self):
         # type: () -> ArakoonConfigurationLock
@@ -202,58 +246,27 @@ class ArakoonConfigurationLock(object):
         self._start = time.time()
         if wait is None:
             wait = self._wait
-        while self._client.exists(self._key):
-            time.sleep(0.005)
-            # Check if it has expired
+        acquired = self._enqueue(fast_path=True)
+        self._refresher = RepeatingTimer(max(self._expiration / 3.0, 0.1), self._refresh)
+        self._refresher.daemon = True
+        self._refresher.start()
+        if acquired is False:
             try:
-                original_lock_data = self._client.get(self._key)
-                lock_data = ujson.loads(original_lock_data)
-            except ArakoonNotFound:
-                self._logger.debug('Unable to retrieve data: Key {0} was removed in meanwhile'.format(self._key))
-                continue  # Key was removed in meanwhile
-            except Exception:
-                self._logger.exception('Unable to retrieve the data of key {0}'.format(self._key))
-                continue
-            expiration = lock_data.get(self.EXPIRATION_KEY, None)
-            if expiration is None or time.time() > expiration:
-                self._logger.info('Expiration for key {0} (lock id: {1}) was reached. Looking to remove it.'.format(self._key, lock_data['id']))
-                # Remove the expired lock
-                transaction = self._client.begin_transaction()
-                self._client.assert_value(self._key, original_lock_data, transaction=transaction)
-                self._client.delete(self._key, transaction=transaction)
-                try:
-                    self._client.apply_transaction(transaction)
-                except ArakoonAssertionFailed:
-                    self._logger.warning('Lost the race to cleanup the expired key {0}.'.format(self._key))
-                except:
-                    self._logger.exception('Unable to remove the expired entry')
-                continue  # Always check the key again even when errors occurred
-            passed = time.time() - self._start
-            if wait is not None and passed > wait:
-                self._logger.error('Lock for {0} could not be acquired. {1} sec > {2} sec'.format(self._key, passed, wait))
-                raise NoLockAvailableException('Could not acquire lock {0}'.format(self._key))
-        # Create the lock entry
-        now = time.time()
-        transaction = self._client.begin_transaction()
-        self._client.assert_value(self._key, None, transaction=transaction)  # Key shouldn't exist
-        data_to_set = ujson.dumps({'time_set': now, self.EXPIRATION_KEY: now + self._expiration, 'id': self.id})
-        self._client.set(self._key, data_to_set, transaction=transaction)
-        try:
-            self._client.apply_transaction(transaction)
-            self._data_set = data_to_set
-            self._logger.debug('Acquired lock {0}'.format(self._key))
-        except ArakoonAssertionFailed:
-            self._logger.info('Lost the race with another lock, back to acquiring')
-            return self.acquire(wait)
-        except:
-            self._logger.exception('Exception occurred while setting the lock')
-            raise
+                self._wait_for_turn(wait)
+            except:
+                # Never leave a queue entry behind which keeps on being refreshed and blocks all later waiters
+                self._dequeue()
+                raise
         passed = time.time() - self._start
         if passed > 0.2:  # More than 200 ms is a long time to wait
             if self._logger is not None:
                 self._logger.warning('Waited {0} sec for lock {1}'.format(passed, self._key))
+        self.wait_time = passed
+        self._register_metric(self.name, 'wait_time', passed)
+        if LockProfiler.enabled is True:
+            LockProfiler.record_acquire('arakoon_lock:{0}'.format(self.name), passed, contended=not acquired)
+        self._logger.debug('Acquired lock {0}'.format(self._key))
         self._start = time.time()
-        self._has_lock = True
         return True
 
     def release(self):
@@ -262,19 +275,287 @@ class ArakoonConfigurationLock(object):
         Releases the lock
         """
         if self._has_lock and self._data_set is not None:
+            self._stop_refresher()
+            with self._state_lock:
+                transaction = self._client.begin_transaction()
+                self._client.assert_value(self._key, self._data_set, transaction=transaction)
+                self._client.delete(self._key, transaction=transaction)
+                self._client.delete(self._queue_key, must_exist=False, transaction=transaction)
+                try:
+                    self._client.apply_transaction(transaction)
+                    self._logger.debug('Removed lock {0}'.format(self._key))
+                except ArakoonAssertionFailed:
+                    self._logger.warning('The lock was removed and possible in use. Another client must have cleaned up the expired entry')
+                    self._client.delete(self._queue_key, must_exist=False)
+                except:
+                    self._logger.exception('Unable to remove the lock')
+                    raise
+                finally:
+                    self._data_set = None
+                    self._queue_key = None
+            passed = time.time() - self._start
+            if passed > 0.5:  # More than 500 ms is a long time to hold a lock
+                if self._logger is not None:
+                    self._logger.warning('A lock on {0} was kept for {1} sec'.format(self._key, passed))
+            self.hold_time = passed
+            self._register_metric(self.name, 'hold_time', passed)
+            if LockProfiler.enabled is True:
+                LockProfiler.record_release('arakoon_lock:{0}'.format(self.name), passed)
+            self._has_lock = False
+
+    def _enqueue(self, fast_path=False):
+        # type: (bool) -> bool
+        """
+        Draw a ticket and append an entry for this instance to the queue of the lock
+        When the queue is empty and the lock is free, the lock is taken within the same sequence.
+        Entries can only be added by drawing a ticket, so asserting the ticket guarantees the queue is still empty
+        :param fast_path: Attempt to take the lock immediately
+        :type fast_path: bool
+        :return: True if the lock was taken, False if this instance has been queued
+        :rtype: bool
+        """
+        while True:
+            try:
+                ticket = int(self._client.get(self._ticket_key))
+            except ArakoonNotFound:
+                ticket = 0
+            if fast_path is True and len(list(self._client.prefix(self._queue_prefix))) > 0:
+                fast_path = False  # Never pass waiters which are still queued
+            data_to_set = self._get_lock_data()
+            queue_key = self._get_queue_key(ticket + 1)
             transaction = self._client.begin_transaction()
-            self._client.assert_value(self._key, self._data_set, transaction=transaction)
-            self._client.delete(self._key, transaction=transaction)
+            self._client.assert_value(self._ticket_key, str(ticket) if ticket > 0 else None, transaction=transaction)
+            self._client.set(self._ticket_key, str(ticket + 1), transaction=transaction)
+            self._client.set(queue_key, data_to_set, transaction=transaction)
+            if fast_path is True:
+                # Free when nobody holds the lock key
+                self._client.assert_value(self._key, None, transaction=transaction)
+                self._client.set(self._key, data_to_set, transaction=transaction)
             try:
                 self._client.apply_transaction(transaction)
-                self._logger.debug('Removed lock {0}'.format(self._key))
             except ArakoonAssertionFailed:
-                self._logger.warning('The lock was removed and possible in use. Another client must have cleaned up the expired entry')
+                if fast_path is True:
+                    fast_path = False
+                else:
+                    self._logger.debug('Lost the race for ticket {0} of lock {1}'.format(ticket + 1, self._key))
+                    time.sleep(random.random() * self.BACKOFF_MIN)
+                continue
+            with self._state_lock:
+                self._data_set = data_to_set
+                self._queue_key = queue_key
+                self._has_lock = fast_path
+            return fast_path
+
+    def _dequeue(self):
+        # type: () -> None
+        """
+        Remove the entry of this instance from the queue
+        :return: None
+        :rtype: NoneType
+        """
+        self._stop_refresher()
+        with self._state_lock:
+            if self._queue_key is not None:
+                try:
+                    self._client.delete(self._queue_key, must_exist=False)
+                except Exception:
+                    self._logger.exception('Unable to remove queue entry {0}'.format(self._queue_key))
+            self._data_set = None
+            self._queue_key = None
+
+    def _wait_for_turn(self, wait):
+        # type: (float) -> None
+        """
+        Wait until this instance is at the head of the queue and take the lock
+        Only the predecessor is polled. The poll interval backs off until the predecessor changes
+        :param wait: Time to wait for the lock
+        :type wait: float
+        :return: None
+        :rtype: NoneType
+        :raises NoLockAvailableException: when the lock could not be acquired within the wait time
+        """
+        backoff = self.BACKOFF_MIN
+        predecessor = None
+        while True:
+            if predecessor is None:
+                predecessor = self._get_predecessor()
+            if predecessor is None:
+                # Head of the queue
+                if self._take_lock() is True:
+                    return
+            elif self._is_entry_gone(predecessor) is True:
+                predecessor = None
+                backoff = self.BACKOFF_MIN
+                continue
+            passed = time.time() - self._start
+            if wait is not None and passed > wait:
+                self._dequeue()
+                self._register_metric(self.name, 'timeouts', passed)
+                if LockProfiler.enabled is True:
+                    LockProfiler.record_acquire('arakoon_lock:{0}'.format(self.name), passed, contended=True, timeout=True)
+                self._logger.error('Lock for {0} could not be acquired. {1} sec > {2} sec'.format(self._key, passed, wait))
+                raise NoLockAvailableException('Could not acquire lock {0}'.format(self._key))
+            sleep_time = backoff * random.uniform(0.5, 1)
+            if wait is not None:
+                sleep_time = min(sleep_time, max(wait - passed, 0))
+            time.sleep(sleep_time)
+            backoff = min(backoff * self.BACKOFF_MULTIPLIER, self.BACKOFF_MAX)
+
+    def _get_predecessor(self):
+        # type: () -> Optional[str]
+        """
+        Retrieve the queue entry right in front of the entry of this instance
+        :return: The key of the predecessor or None when this instance is at the head of the queue
+        :rtype: str
+        """
+        predecessors = [key for key in self._client.prefix(self._queue_prefix) if key < self._queue_key]
+        if len(predecessors) == 0:
+            return None
+        return max(predecessors)
+
+    def _take_lock(self):
+        # type: () -> bool
+        """
+        Take the lock key. Only to be called at the head of the queue
+        :return: True if the lock was taken, False if the lock key is still in use
+        :rtype: bool
+        """
+        with self._state_lock:
+            transaction = self._client.begin_transaction()
+            self._client.assert_value(self._queue_key, self._data_set, transaction=transaction)
+            self._client.assert_value(self._key, None, transaction=transaction)
+            self._client.set(self._key, self._data_set, transaction=transaction)
+            try:
+                self._client.apply_transaction(transaction)
+                self._has_lock = True
+                return True
+            except ArakoonAssertionFailed:
+                pass
             except:
-                self._logger.exception('Unable to remove the lock')
+                self._logger.exception('Exception occurred while setting the lock')
                 raise
-            passed = time.time() - self._start
-            if passed > 0.5:  # More than 500 ms is a long time to hold a lock
-                if self._logger is not None:
-                    self._logger.warning('A lock on {0} was kept for {1} sec'.format(self._key, passed))
-            self._has_lock = False
+        if self._is_entry_gone(self._queue_key) is True:
+            self._logger.warning('The queue entry for lock {0} was removed. Another client must have cleaned up the expired entry'.format(self._key))
+            self._enqueue()
+            return False
+        self._is_entry_gone(self._key)  # Cleans up the lock key when it expired
+        return False
+
+    def _is_entry_gone(self, key):
+        # type: (str) -> bool
+        """
+        Verify whether an entry (lock key or queue entry) is gone. Expired entries are removed
+        :param key: Key of the entry
+        :type key: str
+        :return: True if the entry is gone, False otherwise
+        :rtype: bool
+        """
+        try:
+            original_lock_data = self._client.get(key)
+            lock_data = ujson.loads(original_lock_data)
+        except ArakoonNotFound:
+            return True
+        except Exception:
+            self._logger.exception('Unable to retrieve the data of key {0}'.format(key))
+            return False
+        expiration = lock_data.get(self.EXPIRATION_KEY, None)
+        if expiration is None or time.time() > expiration:
+            self._logger.info('Expiration for key {0} (lock id: {1}) was reached. Looking to remove it.'.format(key, lock_data.get('id')))
+            transaction = self._client.begin_transaction()
+            self._client.assert_value(key, original_lock_data, transaction=transaction)
+            self._client.delete(key, transaction=transaction)
+            try:
+                self._client.apply_transaction(transaction)
+                return True
+            except ArakoonAssertionFailed:
+                self._logger.warning('Lost the race to cleanup the expired key {0}.'.format(key))
+            except:
+                self._logger.exception('Unable to remove the expired entry')
+        return False
+
+    def _refresh(self):
+        # type: () -> None
+        """
+        Refreshes the queue entry and the lock key (when held) by setting new expiration dates
+        Executed by the refresher in the background
+        :return: None
+        :rtype: NoneType
+        """
+        refresher = self._refresher
+        if refresher is None or refresher.finished.is_set():
+            return  # The RepeatingTimer runs once more after being cancelled
+        with self._state_lock:
+            if self._data_set is None:
+                return
+            data_to_set = self._get_lock_data()
+            transaction = self._client.begin_transaction()
+            self._client.assert_value(self._queue_key, self._data_set, transaction=transaction)
+            self._client.set(self._queue_key, data_to_set, transaction=transaction)
+            if self._has_lock is True:
+                self._client.assert_value(self._key, self._data_set, transaction=transaction)
+                self._client.set(self._key, data_to_set, transaction=transaction)
+            try:
+                self._client.apply_transaction(transaction)
+                self._data_set = data_to_set
+                self._logger.debug('Refreshed lock {0}'.format(self._key))
+            except ArakoonAssertionFailed:
+                self._logger.error('The lock {0} was taken over by another instance'.format(self._key))
+            except Exception:
+                self._logger.exception('Unable to refresh the lock {0}'.format(self._key))
+
+    def _stop_refresher(self):
+        # type: () -> None
+        """
+        Stops the background refresher
+        :return: None
+        :rtype: NoneType
+        """
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher.join()
+            self._refresher = None
+
+    def _get_lock_data(self):
+        # type: () -> str
+        now = time.time()
+        return ujson.dumps({'time_set': now, self.EXPIRATION_KEY: now + self._expiration, 'id': self.id})
+
+    def _get_queue_key(self, ticket):
+        # type: (int) -> str
+        return '{0}{1:020d}'.format(self._queue_prefix, ticket)
+
+    @classmethod
+    def _register_metric(cls, name, metric, value):
+        # type: (str, str, float) -> None
+        with cls._metrics_lock:
+            lock_metrics = cls._metrics.setdefault(name, {})
+            metric_info = lock_metrics.setdefault(metric, {'count': 0, 'total': 0.0, 'max': 0.0})
+            metric_info['count'] += 1
+            metric_info['total'] += value
+            metric_info['max'] = max(metric_info['max'], value)
+
+    @classmethod
+    def get_metrics(cls, name=None):
+        # type: (Optional[str]) -> Dict[str, Dict[str, Dict[str, float]]]
+        """
+        Retrieve the wait time, hold time and timeout metrics of the locks taken within this process
+        :param name: Name of the lock to retrieve the metrics for. Defaults to all locks
+        :type name: str
+        :return: The metrics per lock name. Every metric contains the count, total and max (in seconds)
+        :rtype: dict
+        """
+        with cls._metrics_lock:
+            if name is not None:
+                return copy.deepcopy(cls._metrics.get(name, {}))
+            return copy.deepcopy(cls._metrics)
+
+    @classmethod
+    def reset_metrics(cls):
+        # type: () -> None
+        """
+        Reset all gathered metrics
+        :return: None
+        :rtype: NoneType
+        """
+        with cls._metrics_lock:
+            cls._metrics.clear()
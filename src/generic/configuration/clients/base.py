@@ -28,6 +28,9 @@ class ConfigurationClientBase(object):
     All inheriting classes must overrule lock, get_configuration_path, extract_key_from_path, get, set, dir_exists, list, delete, rename
     """
 
+    # Build a client per thread when the client cannot be used concurrently
+    CLIENT_PER_THREAD = False
+
     _logger = logging.getLogger(__name__)
 
     def __init__(self, *args, **kwargs):
@@ -92,6 +95,17 @@ class ConfigurationClientBase(object):
         # type: (str, bool) -> Iterable(str)
         raise NotImplementedError()
 
+    def prefix_entries(self, key):
+        # type: (str) -> Iterable[Tuple[str, str]]
+        """
+        Lists all keys and their raw values starting with the given key
+        :param key: Key to list under
+        :type key: str
+        :return: All key-value pairs under the key
+        :rtype: Iterable[Tuple[str, str]]
+        """
+        raise NotImplementedError()
+
     def delete(self, key, recursive, transaction=None):
         # type: (str, bool, str) -> None
         """
@@ -117,6 +131,17 @@ class ConfigurationClientBase(object):
         """
         raise NotImplementedError()
 
+    def get_multi(self, keys):
+        # type: (List[str]) -> List[Optional[str]]
+        """
+        Retrieve the values of multiple keys at once
+        :param keys: Keys to retrieve
+        :type keys: list[str]
+        :return: The values in the order of the keys. None for keys that do not exist
+        :rtype: list
+        """
+        raise NotImplementedError()
+
     def get_client(self):
         # type: () -> Any
         """
@@ -126,6 +151,15 @@ class ConfigurationClientBase(object):
         """
         raise NotImplementedError()
 
+    def close(self):
+        # type: () -> None
+        """
+        Releases the resources held by this client (eg. connections)
+        :return: None
+        :rtype: NoneType
+        """
+        pass
+
     def set(self, key, value, transaction=None):
         # type: (str, any) -> None
         """
@@ -164,6 +164,21 @@ class ConfigurationBaseKeyValue(ConfigurationClientBase):
                         entries.append(cleaned)
                         yield cleaned
 
+    def prefix_entries(self, key):
+        # type: (str) -> Generator[Tuple[str, str]]
+        """
+        Lists all keys and their raw values starting with the given key
+        :param key: Key to list under
+        :type key: str
+        :return: Generator with all key-value pairs
+        :rtype: generator
+        """
+        key = self._clean_key(key)
+        for entry, value in self._client.prefix_entries(key):
+            if entry.startswith('_'):
+                continue
+            yield entry, value
+
     def delete(self, key, recursive, transaction=None):
         # type: (str, bool, str) -> None
         """
@@ -194,6 +209,18 @@ class ConfigurationBaseKeyValue(ConfigurationClientBase):
         key = self._clean_key(key)
         return self._client.get(key, **kwargs)
 
+    def get_multi(self, keys):
+        # type: (List[str]) -> List[Optional[str]]
+        """
+        Retrieve the values of multiple keys at once
+        :param keys: Keys to retrieve
+        :type keys: list[str]
+        :return: The values in the order of the keys. None for keys that do not exist
+        :rtype: list
+        """
+        keys = [self._clean_key(key) for key in keys]
+        return list(self._client.get_multi(keys, must_exist=False))
+
     def set(self, key, value, transaction=None):
         # type: (str, str, str) -> None
         """
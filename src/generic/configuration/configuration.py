@@ -21,13 +21,19 @@ import os
 import sys
 import json
 import time
+import zlib
+import ujson
 import logging
+import weakref
 import collections
 from random import randint
 from subprocess import check_output
+from threading import current_thread, local
 from ovs_extensions.constants import is_unittest_mode
-from ovs_extensions.constants.config import CACC_LOCATION, COMPONENTS_KEY
+from ovs_extensions.constants.config import CACC_LOCATION, COMPONENTS_KEY, CONFIG_SNAPSHOT_LOCATION
 from ovs_extensions.constants.file_extensions import RAW_FILES
+from ovs_extensions.generic.configuration.snapshot import ConfigurationSnapshot
+from ovs_extensions.generic.configuration.transaction import ConfigurationTransaction
 from ovs_extensions.generic.system import System
 from ovs_extensions.packages.packagefactory import PackageFactory
 # Import for backwards compatibility/easier access
@@ -58,10 +64,20 @@ class Configuration(object):
     """
 
     BASE_KEY = '/ovs/framework'
+    BINARY_MAGIC = '\x00ovsz'
+    ENCODING_PRETTY = 'pretty'
+    ENCODING_BINARY = 'binary'
+    ENCODING_COMPACT = 'compact'
     CACC_LOCATION = CACC_LOCATION
     EDITION_KEY = '{0}/edition'.format(BASE_KEY)
 
+    _store = None
+    _snapshot = None
     _clients = {}
+    _encodings = {}
+    _thread_clients = local()
+    _thread_client_refs = set()
+    _passthrough_hooks = []
     _logger = logging.getLogger(__name__)
 
     def __init__(self):
@@ -154,12 +170,16 @@ class Configuration(object):
     @classmethod
     def _get(cls, key, raw=False, **kwargs):
         # type: (str, Optional[bool] **any) -> Union[dict, None]
-        data = cls._passthrough(method='get',
-                                key=key,
-                                **kwargs)
+        data = None
+        if cls._snapshot is not None and len(kwargs) == 0:
+            data = cls._snapshot.get(key)
+        if data is None:
+            data = cls._passthrough(method='get',
+                                    key=key,
+                                    **kwargs)
         if key.endswith(RAW_FILES) or raw:
             return data
-        return json.loads(data)
+        return cls._load_data(data)
 
     @classmethod
     def set(cls, key, value, raw=False, transaction=None):
@@ -197,28 +217,173 @@ class Configuration(object):
         # type: (str, any, Optional[str]) -> None
         data = value
         if not any([key.endswith(RAW_FILES), raw]):
-            data = cls._dump_data(data)
+            data = cls._dump_data(data, key)
+        if cls._snapshot is not None:
+            cls._snapshot.invalidate(key)
         return cls._passthrough(method='set',
                                 key=key,
                                 value=data,
                                 transaction=transaction)
 
     @classmethod
-    def _dump_data(cls, value):
-        # type: (Union[str, Dict[Any, Any]]) -> str
+    def _dump_data(cls, value, key=None):
+        # type: (Union[str, Dict[Any, Any]], Optional[str]) -> str
         """
         Dumps data to JSON format if possible
+        Strings containing JSON are dumped as the JSON data they contain
         :param value: The value to dump
         :type value: str or dict
+        :param key: Key the value is stored under. Determines the encoding to use (see set_encoding)
+        :type key: str
         :return: The converted data
         :rtype: str
         """
+        data = value
+        if isinstance(value, basestring):
+            try:
+                data = json.loads(value)
+            except ValueError:
+                pass
+        encoding = cls.ENCODING_PRETTY if key is None else cls.get_encoding(key)
+        if encoding == cls.ENCODING_COMPACT:
+            return cls._dump_compact(data)
+        if encoding == cls.ENCODING_BINARY:
+            return cls.BINARY_MAGIC + zlib.compress(cls._dump_compact(data))
+        return json.dumps(data, indent=4)
+
+    @staticmethod
+    def _dump_compact(data):
+        # type: (any) -> str
+        """
+        Dumps data to JSON without any whitespace
+        :param data: The data to dump
+        :type data: any
+        :return: The JSON data
+        :rtype: str
+        """
         try:
-            data = json.loads(value)
-            data = json.dumps(data, indent=4)
-        except Exception:
-            data = json.dumps(value, indent=4)
-        return data
+            # Configuration values contain a lot of paths: escaping every '/' would make them bigger than pretty JSON
+            return ujson.dumps(data, escape_forward_slashes=False)
+        except OverflowError:
+            # ujson only handles 64 bit integers
+            return json.dumps(data, separators=(',', ':'))
+
+    @classmethod
+    def _load_data(cls, data):
+        # type: (str) -> any
+        """
+        Loads data stored in any of the supported encodings
+        :param data: The stored data
+        :type data: str
+        :return: The loaded data
+        :rtype: any
+        """
+        if data.startswith(cls.BINARY_MAGIC):
+            return json.loads(zlib.decompress(data[len(cls.BINARY_MAGIC):]))
+        return json.loads(data)
+
+    @classmethod
+    def set_encoding(cls, prefix, encoding):
+        # type: (str, str) -> None
+        """
+        Set the encoding of the values stored under a prefix. The most specific prefix wins
+        Values in every encoding can always be read, regardless of the encoding set
+        - pretty: indented JSON (default, readable by all older versions)
+        - compact: JSON without whitespace
+        - binary: zlib compressed compact JSON. Only to be used when all readers support it
+        Existing values can be re-encoded with migrate_encoding
+        :param prefix: Prefix of the keys
+        :type prefix: str
+        :param encoding: Encoding to use. None to remove the encoding of the prefix
+        :type encoding: str
+        :return: None
+        :rtype: NoneType
+        """
+        prefix = prefix.strip('/')
+        if encoding is None:
+            cls._encodings.pop(prefix, None)
+            return
+        if encoding not in [cls.ENCODING_PRETTY, cls.ENCODING_COMPACT, cls.ENCODING_BINARY]:
+            raise ValueError('Unsupported encoding {0}'.format(encoding))
+        cls._encodings[prefix] = encoding
+
+    @classmethod
+    def get_encoding(cls, key):
+        # type: (str) -> str
+        """
+        Retrieve the encoding to use for the given key
+        :param key: Key to retrieve the encoding for
+        :type key: str
+        :return: The encoding
+        :rtype: str
+        """
+        if not cls._encodings:
+            return cls.ENCODING_PRETTY
+        key = key.strip('/')
+        encoding = cls.ENCODING_PRETTY
+        matched_length = -1
+        for prefix, prefix_encoding in cls._encodings.iteritems():
+            if len(prefix) > matched_length and (key == prefix or key.startswith(prefix + '/') or prefix == ''):
+                encoding = prefix_encoding
+                matched_length = len(prefix)
+        return encoding
+
+    @classmethod
+    def migrate_encoding(cls, prefix, batch_size=100, max_retries=20):
+        # type: (str, int, int) -> int
+        """
+        Re-encode all values under the given prefix with the encoding set for them
+        The values are updated in transactions of batch_size keys. Every update asserts the value it re-encodes
+        :param prefix: Prefix of the keys to re-encode
+        :type prefix: str
+        :param batch_size: Number of keys to update in a single transaction
+        :type batch_size: int
+        :param max_retries: Number of retries per batch when values changed during the migration
+        :type max_retries: int
+        :return: The number of re-encoded keys
+        :rtype: int
+        """
+        entries = [(key, value) for key, value in cls.prefix_entries(prefix) if not key.endswith(RAW_FILES)]
+        migrated = 0
+        for index in xrange(0, len(entries), batch_size):
+            batch = entries[index:index + batch_size]
+            tries = 0
+            while True:
+                tries += 1
+                transaction = None
+                changes = 0
+                for key, raw_value in batch:
+                    try:
+                        new_value = cls._dump_data(cls._load_data(raw_value), key)
+                    except (ValueError, zlib.error):
+                        continue  # Not stored as JSON
+                    if new_value == raw_value:
+                        continue
+                    if transaction is None:
+                        transaction = cls.begin_transaction()
+                    cls._passthrough(method='assert_value', key=key, value=raw_value, transaction=transaction)
+                    cls._set(key, new_value, raw=True, transaction=transaction)
+                    changes += 1
+                if transaction is None:
+                    break
+                try:
+                    cls.apply_transaction(transaction)
+                    migrated += changes
+                    break
+                except ConfigurationAssertionException:
+                    if tries > max_retries:
+                        raise
+                    cls._logger.warning('Values under {0} changed during the migration. Retrying'.format(prefix))
+                    time.sleep(randint(0, 25) / 100.0)
+                    current_batch = []
+                    for key, _ in batch:
+                        try:
+                            # Read the live value: a stale value served from the snapshot must never be re-encoded
+                            current_batch.append((key, cls._passthrough(method='get', key=key)))
+                        except NotFoundException:
+                            pass  # Removed in the meantime
+                    batch = current_batch
+        return migrated
 
     @classmethod
     def delete(cls, key, remove_root=False, raw=False, transaction=None):
@@ -253,6 +418,8 @@ class Configuration(object):
     @classmethod
     def _delete(cls, key, recursive, transaction=None):
         # type: (str, bool, str) -> None
+        if cls._snapshot is not None:
+            cls._snapshot.invalidate(key)
         return cls._passthrough(method='delete',
                                 key=key,
                                 recursive=recursive,
@@ -271,6 +438,9 @@ class Configuration(object):
         :type max_retries: int
         :return: None
         """
+        if cls._snapshot is not None:
+            cls._snapshot.invalidate(key)
+            cls._snapshot.invalidate(new_key)
         return cls._passthrough(method='rename',
                                 key=key,
                                 new_key=new_key,
@@ -316,6 +486,59 @@ class Configuration(object):
                                 key=key,
                                 recursive=recursive)
 
+    @classmethod
+    def prefix_entries(cls, key):
+        # type: (str) -> Iterable[Tuple[str, str]]
+        """
+        List all keys and their raw values starting with the given key
+        :param key: Key to list under
+        :type key: str
+        :return: Generator object yielding key-value pairs
+        """
+        return cls._passthrough(method='prefix_entries',
+                                key=key)
+
+    @classmethod
+    def transaction(cls):
+        # type: () -> ConfigurationTransaction
+        """
+        Starts a new transaction builder. Reads, asserts and writes are collected locally and applied in one go
+        > with Configuration.transaction() as transaction:
+        >     transaction.set('/foo|bar', transaction.get('/foo|bar', default=0) + 1)
+        :return: The transaction builder
+        :rtype: ovs_extensions.generic.configuration.transaction.ConfigurationTransaction
+        """
+        return ConfigurationTransaction(cls)
+
+    @classmethod
+    def run_transaction(cls, callback, max_retries=20):
+        # type: (callable, int) -> any
+        """
+        Run a callback against a transaction builder and commit it. Retries when an assert fails
+        The callback is executed again on every retry, with a new transaction builder
+        :param callback: Callable which receives the transaction builder
+        :type callback: callable
+        :param max_retries: Number of retries to attempt
+        :type max_retries: int
+        :return: The result of the callback
+        :rtype: any
+        :raises: ConfigurationAssertionException:
+        - When the transaction could not be applied
+        """
+        tries = 0
+        while True:
+            tries += 1
+            transaction = cls.transaction()
+            result = callback(transaction)
+            try:
+                transaction.commit()
+                return result
+            except ConfigurationAssertionException:
+                if tries > max_retries:
+                    raise
+                cls._logger.warning('Asserting failed. Retrying {0} more times'.format(max_retries - tries + 1))
+                time.sleep(randint(0, 25) / 100.0)
+
     @classmethod
     def begin_transaction(cls):
         # type: () -> str
@@ -356,7 +579,15 @@ class Configuration(object):
         data = value
         # When data is None, checking for a key that does not exist. Avoids comparing None to null
         if raw is False and data is not None:
-            data = cls._dump_data(data)
+            data = cls._dump_data(data, key)
+            if cls.get_encoding(key) != cls.ENCODING_PRETTY:
+                # The stored value might still be in another encoding. Assert the stored value when it holds the same data
+                try:
+                    stored_data = cls._get(key, raw=True)
+                    if stored_data != data and cls._load_data(stored_data) == cls._load_data(data):
+                        data = stored_data
+                except (NotFoundException, ValueError, zlib.error):
+                    pass
         return cls._passthrough(method='assert_value',
                                 key=key,
                                 value=data,
@@ -379,19 +610,78 @@ class Configuration(object):
         """
         return cls._passthrough(method='get_client')
 
+    @classmethod
+    def enable_snapshot(cls, prefixes, path=CONFIG_SNAPSHOT_LOCATION, refresh_interval=60, max_age=3600):
+        # type: (List[str], str, float, float) -> ConfigurationSnapshot
+        """
+        Serve reads of the given prefixes from a local on-disk snapshot during startup
+        Reads are served from a previously taken snapshot immediately while the snapshot is reconciled with the live store
+        in the background. Once reconciled, all reads go to the live store again. Only use this for keys which can
+        tolerate being stale during startup (eg. logging configuration, edition, component registrations)
+        :param prefixes: Configuration prefixes to keep in the snapshot
+        :type prefixes: list[str]
+        :param path: Path to the snapshot file
+        :type path: str
+        :param refresh_interval: Seconds between two snapshots
+        :type refresh_interval: float
+        :param max_age: Seconds after which an unverified snapshot is no longer served
+        :type max_age: float
+        :return: The snapshot
+        :rtype: ovs_extensions.generic.configuration.snapshot.ConfigurationSnapshot
+        """
+        cls.disable_snapshot()
+        snapshot = ConfigurationSnapshot(cls, prefixes, path, refresh_interval, max_age)
+        snapshot.start()
+        cls._snapshot = snapshot
+        return snapshot
+
+    @classmethod
+    def disable_snapshot(cls):
+        # type: () -> None
+        """
+        Stop serving reads from the local snapshot
+        :return: None
+        :rtype: NoneType
+        """
+        if cls._snapshot is not None:
+            cls._snapshot.stop()
+            cls._snapshot = None
+
+    @classmethod
+    def add_passthrough_hook(cls, hook):
+        # type: (callable) -> None
+        """
+        Register a hook which is called after every call towards the underlying configuration client
+        Used for instrumentation: the hook is called with the name of the method and the duration of the call (in seconds)
+        :param hook: Callable accepting the method name and the duration
+        :type hook: callable
+        :return: None
+        :rtype: NoneType
+        """
+        if hook not in cls._passthrough_hooks:
+            cls._passthrough_hooks.append(hook)
+
+    @classmethod
+    def remove_passthrough_hook(cls, hook):
+        # type: (callable) -> None
+        """
+        Remove a previously registered passthrough hook
+        :param hook: The hook to remove
+        :type hook: callable
+        :return: None
+        :rtype: NoneType
+        """
+        if hook in cls._passthrough_hooks:
+            cls._passthrough_hooks.remove(hook)
+
     @classmethod
     def _passthrough(cls, method, *args, **kwargs):
         # type: (str, *any, **any) -> any
-        if is_unittest_mode():
-            store = 'unittest'
-        else:
-            store = cls.get_store_info()
-        instance = cls._clients.get(store)
-        if instance is None:
-            instance = cls._build_instance()
+        instance = cls._get_instance()
         # Map towards generic exceptions
         not_found_exception = instance.key_not_found_exception
         assertion_exception = instance.assertion_exception
+        start = time.time() if cls._passthrough_hooks else None
         try:
             return getattr(instance, method)(*args, **kwargs)
         except not_found_exception as ex:
@@ -402,20 +692,90 @@ class Configuration(object):
             # Preserve traceback
             exception_type, exception_instance, traceback = sys.exc_info()
             raise ConfigurationAssertionException, ConfigurationAssertionException(ex.message), traceback
+        finally:
+            if start is not None:
+                duration = time.time() - start
+                for hook in cls._passthrough_hooks:
+                    try:
+                        hook(method, duration)
+                    except Exception:
+                        cls._logger.exception('Passthrough hook {0} failed'.format(hook))
+
+    @classmethod
+    def _get_store(cls):
+        # type: () -> str
+        """
+        Retrieve the configuration store to use. The store info is only resolved once
+        :return: The store to use
+        :rtype: str
+        """
+        if is_unittest_mode():
+            return 'unittest'
+        if cls._store is None:
+            cls._store = cls.get_store_info()
+        return cls._store
+
+    @classmethod
+    def _get_instance(cls):
+        """
+        Retrieve the cached instance of the underlying Configuration for the current thread
+        Clients which cannot be used concurrently (eg. the Arakoon client locks around every call) are built per thread
+        so configuration reads from different threads run in parallel
+        :return: An instance of an underlying Configuration
+        :rtype: ovs_extensions.generic.configuration.clients.base.ConfigurationBase
+        """
+        store = cls._get_store()
+        instance = cls._clients.get(store) or cls._get_thread_clients().get(store)
+        if instance is None:
+            instance = cls._build_instance()
+        return instance
+
+    @classmethod
+    def _get_thread_clients(cls):
+        # type: () -> Dict[str, ovs_extensions.generic.configuration.clients.base.ConfigurationBase]
+        """
+        Retrieve the instances cached for the current thread
+        The instances are closed as soon as the thread is gone
+        :return: The instances per store
+        :rtype: dict
+        """
+        if not hasattr(cls._thread_clients, 'clients'):
+            clients = {}
+            cls._thread_clients.clients = clients
+            thread_ref = weakref.ref(current_thread(), lambda ref: cls._close_thread_clients(ref, clients))
+            cls._thread_client_refs.add(thread_ref)
+        return cls._thread_clients.clients
+
+    @classmethod
+    def _close_thread_clients(cls, thread_ref, clients):
+        # type: (weakref.ref, Dict[str, ovs_extensions.generic.configuration.clients.base.ConfigurationBase]) -> None
+        """
+        Close the instances which were cached for a thread which is gone
+        :param thread_ref: Weak reference to the thread
+        :type thread_ref: weakref.ref
+        :param clients: The instances per store of that thread
+        :type clients: dict
+        :return: None
+        :rtype: NoneType
+        """
+        cls._thread_client_refs.discard(thread_ref)
+        for instance in clients.values():
+            try:
+                instance.close()
+            except Exception:
+                cls._logger.exception('Unable to close the configuration client of a finished thread')
+        clients.clear()
 
     @classmethod
     def _build_instance(cls, cache=True):
         """
         Build an instance of the underlying Configuration to use
-        :param cache: Cache the instance
+        :param cache: Cache the instance. Instances which have to be built per thread are cached for the current thread only
         :type cache: bool
         :return: An instance of an underlying Configuration
         :rtype: ovs_extensions.generic.configuration.clients.base.ConfigurationBase
         """
-        if is_unittest_mode():
-            store = 'unittest'
-        else:
-            store = cls.get_store_info()
+        store = cls._get_store()
         if store == 'arakoon':
             from ovs_extensions.generic.configuration.clients.arakoon import ArakoonConfiguration
             instance = ArakoonConfiguration(cacc_location=cls.CACC_LOCATION)
@@ -425,7 +785,10 @@ class Configuration(object):
         else:
             raise NotImplementedError('Store {0} is not implemented'.format(store))
         if cache is True:
-            cls._clients[store] = instance
+            if instance.CLIENT_PER_THREAD is True:
+                cls._get_thread_clients()[store] = instance
+            else:
+                cls._clients[store] = instance
         return instance
 
     @classmethod
@@ -490,7 +853,7 @@ class Configuration(object):
         last_exception = None
         return_value = []
         while success is False:
-            transaction = cls.begin_transaction()
+            transaction = cls.transaction()
             return_value = []  # Reset value
             tries += 1
             if tries > max_retries:
@@ -501,10 +864,10 @@ class Configuration(object):
             # Multiple key/values to set
             for key, value, expected_value in callback_result:
                 return_value.append((key, value))
-                cls.assert_value(key, expected_value, transaction=transaction)
-                cls.set(key, value, transaction=transaction)
+                transaction.assert_value(key, expected_value)
+                transaction.set(key, value)
             try:
-                cls.apply_transaction(transaction)
+                transaction.commit()
                 success = True
             except ConfigurationAssertionException as ex:
                 cls._logger.warning('Asserting failed. Retrying {0} more times'.format(max_retries - tries))
@@ -529,11 +892,12 @@ class Configuration(object):
         """
         registration_key = registration_key or cls.get_registration_key()
 
-        def _register_user_callback():
-            registered_applications = cls.get(registration_key, default=None)
+        def _register_user_callback(transaction):
+            registered_applications = transaction.get(registration_key, default=None)
             new_registered_applications = (registered_applications or []) + [component_identifier]
-            return [(registration_key, new_registered_applications, registered_applications)]
-        return cls.safely_store(_register_user_callback, 20)[0][1]
+            transaction.set(registration_key, new_registered_applications)
+            return new_registered_applications
+        return cls.run_transaction(_register_user_callback, 20)
 
     @classmethod
     def get_registration_key(cls):
@@ -570,8 +934,8 @@ class Configuration(object):
         """
         registration_key = cls.get_registration_key()
 
-        def _unregister_user_callback():
-            registered_applications = cls.get(registration_key, default=None)  # type: List[str]
+        def _unregister_user_callback(transaction):
+            registered_applications = transaction.get(registration_key, default=None)  # type: List[str]
             if not registered_applications:
                 # No more entries. Save an empty list
                 new_registered_applications = []
@@ -579,6 +943,7 @@ class Configuration(object):
                 new_registered_applications = registered_applications[:]
                 if component_identifier in registered_applications:
                     new_registered_applications.remove(component_identifier)
-            return [(registration_key, new_registered_applications, registered_applications)]
+            transaction.set(registration_key, new_registered_applications)
+            return new_registered_applications
 
-        return cls.safely_store(_unregister_user_callback, 20)[0][1]
+        return cls.run_transaction(_unregister_user_callback, 20)
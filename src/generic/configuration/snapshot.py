@@ -0,0 +1,307 @@
+# Copyright (C) 2019 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+"""
+Local snapshot module for the Configuration
+"""
+import os
+import mmap
+import time
+import ujson
+import struct
+import logging
+from threading import Lock, Thread, current_thread
+from ovs_extensions.generic.repeatingtimer import RepeatingTimer
+
+
+class ConfigurationSnapshot(object):
+    """
+    On-disk snapshot of selected configuration prefixes
+    Freshly started processes serve reads of these prefixes from the memory-mapped snapshot until the snapshot has been
+    reconciled against the live configuration store in the background. Afterwards all reads go to the live store again.
+    Values written by this process are never served from the snapshot.
+    The snapshot file is kept up to date in the background for the processes which start later on. It is only rewritten
+    when the transaction id of the store changed. Snapshots which were not verified within the maximum age are ignored.
+    File layout:
+    - Header: magic, transaction id of the store, timestamp of the snapshot and the length of the index
+    - Index: JSON mapping of every key to the offset and the length of its value within the data section
+    - Data: all raw values, concatenated
+    """
+    MAGIC = 'OVSCSNP1'
+    HEADER = struct.Struct('<8sQdI')
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, configuration, prefixes, path, refresh_interval=60, max_age=3600):
+        # type: (type, List[str], str, float, float) -> None
+        """
+        Initializes a snapshot
+        :param configuration: The Configuration class to snapshot
+        :type configuration: type
+        :param prefixes: The configuration prefixes to keep in the snapshot
+        :type prefixes: list[str]
+        :param path: Path to the snapshot file
+        :type path: str
+        :param refresh_interval: Seconds between two snapshots taken in the background
+        :type refresh_interval: float
+        :param max_age: Seconds after which a snapshot which was not verified against the live store is no longer served
+        :type max_age: float
+        """
+        self.path = path
+        self.prefixes = [self._clean_key(prefix) for prefix in prefixes]
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.txid = None
+        self.timestamp = None
+        self._configuration = configuration
+        self._index = {}
+        self._mmap = None
+        self._lock = Lock()
+        self._invalidated = {}
+        self._refresher = None
+        self._reconciler = None
+        self._stopped = False
+        self.load()
+
+    @staticmethod
+    def _clean_key(key):
+        # type: (str) -> str
+        return key.split('|')[0].strip('/')
+
+    def load(self):
+        # type: () -> bool
+        """
+        Load the snapshot from disk
+        :return: True if a valid snapshot was loaded, False otherwise
+        :rtype: bool
+        """
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                # The modification time is updated every time the snapshot was verified against the live store
+                age = time.time() - os.fstat(snapshot_file.fileno()).st_mtime
+                if age > self.max_age:
+                    self._logger.info('Snapshot {0} is {1:.0f}s old. Ignoring it'.format(self.path, age))
+                    return False
+                snapshot_map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return False  # No snapshot yet (ValueError is raised for empty files)
+        try:
+            magic, txid, timestamp, index_length = self.HEADER.unpack_from(snapshot_map, 0)
+            if magic != self.MAGIC:
+                raise ValueError('Invalid magic {0!r}'.format(magic))
+            index_start = self.HEADER.size
+            index = ujson.loads(snapshot_map[index_start:index_start + index_length])
+        except Exception:
+            self._logger.exception('Snapshot {0} is invalid. Ignoring it'.format(self.path))
+            snapshot_map.close()
+            return False
+        data_start = index_start + index_length
+        with self._lock:
+            if self._stopped is True:
+                snapshot_map.close()
+                return False
+            old_map = self._mmap
+            self._index = dict((key, (data_start + offset, length)) for key, (offset, length) in index.iteritems())
+            self._mmap = snapshot_map
+            self.txid = txid
+            self.timestamp = timestamp
+        if old_map is not None:
+            old_map.close()
+        return True
+
+    def get(self, key):
+        # type: (str) -> Optional[str]
+        """
+        Retrieve the raw value of a key from the snapshot
+        :param key: Key to retrieve
+        :type key: str
+        :return: The raw value or None when the key is not served by the snapshot
+        :rtype: str
+        """
+        key = self._clean_key(key)
+        with self._lock:
+            if self._mmap is None or key not in self._index:
+                return None
+            for invalidated_key in self._invalidated:
+                if key == invalidated_key or key.startswith(invalidated_key + '/'):
+                    return None
+            offset, length = self._index[key]
+            return self._mmap[offset:offset + length]
+
+    def invalidate(self, key):
+        # type: (str) -> None
+        """
+        Stop serving a key (and everything under it) from the snapshot until a newer snapshot was taken
+        :param key: Key that is being written
+        :type key: str
+        :return: None
+        :rtype: NoneType
+        """
+        key = self._clean_key(key)
+        with self._lock:
+            if self._mmap is not None:
+                self._invalidated[key] = time.time()
+
+    def refresh(self):
+        # type: () -> None
+        """
+        Reconcile the snapshot with the live configuration store
+        A new snapshot is written to disk when the store changed since the snapshot on disk was taken.
+        Values are no longer served from the snapshot afterwards
+        :return: None
+        :rtype: NoneType
+        """
+        if self._stopped is True:
+            return
+        start = time.time()
+        txid = self._get_txid()
+        if txid != 0 and txid == self._read_txid():
+            os.utime(self.path, None)  # Nothing changed: only mark the snapshot as verified
+        else:
+            entries = {}
+            for prefix in self.prefixes:
+                for key, value in self._configuration.prefix_entries(prefix):
+                    if isinstance(value, unicode):
+                        value = value.encode('utf-8')
+                    entries[key.strip('/')] = value
+            if self._stopped is True:
+                return
+            self._write(txid, start, entries)
+        with self._lock:
+            old_map = self._mmap
+            self._mmap = None
+            self._index = {}
+            self._invalidated = {}
+            self.txid = txid
+            self.timestamp = start
+        if old_map is not None:
+            old_map.close()
+
+    def _get_txid(self):
+        # type: () -> int
+        """
+        Retrieve the transaction id of the live configuration store
+        :return: The transaction id or 0 when the store does not expose it
+        :rtype: int
+        """
+        try:
+            client = self._configuration.get_client()
+        except Exception:
+            return 0
+        try:
+            return client.get_txid()
+        except Exception:
+            return 0  # Not every store exposes its transaction id
+        finally:
+            if hasattr(client, 'close'):
+                client.close()  # A new client is built for every call
+
+    def _read_txid(self):
+        # type: () -> Optional[int]
+        """
+        Read the transaction id from the header of the snapshot on disk
+        Other processes might have replaced the snapshot since it was loaded
+        :return: The transaction id or None when there is no valid snapshot
+        :rtype: int
+        """
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                magic, txid, _, _ = self.HEADER.unpack(snapshot_file.read(self.HEADER.size))
+        except (IOError, OSError, struct.error):
+            return None
+        return txid if magic == self.MAGIC else None
+
+    def _write(self, txid, timestamp, entries):
+        # type: (int, float, Dict[str, str]) -> None
+        """
+        Write a snapshot to disk. The snapshot is replaced atomically
+        :param txid: Transaction id of the store at the time of the snapshot
+        :type txid: int
+        :param timestamp: Time of the snapshot
+        :type timestamp: float
+        :param entries: Raw values of all keys
+        :type entries: dict
+        :return: None
+        :rtype: NoneType
+        """
+        index = {}
+        offset = 0
+        for key in sorted(entries):
+            index[key] = (offset, len(entries[key]))
+            offset += len(entries[key])
+        raw_index = ujson.dumps(index)
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(self.HEADER.pack(self.MAGIC, txid, timestamp, len(raw_index)))
+            snapshot_file.write(raw_index)
+            for key in sorted(entries):
+                snapshot_file.write(entries[key])
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.rename(temp_path, self.path)
+
+    def _safe_refresh(self):
+        # type: () -> None
+        """
+        Refresh the snapshot, logging any failure. Used by the background threads
+        :return: None
+        :rtype: NoneType
+        """
+        try:
+            self.refresh()
+        except Exception:
+            self._logger.exception('Unable to refresh configuration snapshot {0}'.format(self.path))
+
+    def start(self):
+        # type: () -> None
+        """
+        Reconcile the snapshot with the live store in the background and keep on refreshing it
+        :return: None
+        :rtype: NoneType
+        """
+        if self._refresher is not None:
+            return
+        self._reconciler = Thread(target=self._safe_refresh, name='configuration-snapshot')
+        self._reconciler.daemon = True
+        self._reconciler.start()
+        self._refresher = RepeatingTimer(self.refresh_interval, self._safe_refresh)
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def stop(self):
+        # type: () -> None
+        """
+        Stop refreshing the snapshot and stop serving values from it
+        Waits for a refresh which is still running
+        :return: None
+        :rtype: NoneType
+        """
+        self._stopped = True
+        if self._refresher is not None:
+            self._refresher.cancel()
+        for thread in [self._refresher, self._reconciler]:
+            if thread is not None and thread is not current_thread():
+                thread.join()
+        self._refresher = None
+        self._reconciler = None
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = None
+            self._index = {}
@@ -17,8 +17,17 @@
 """
 Test module for the SSHClient class
 """
+import gc
+import os
+import json
+import time
+import shutil
+import tempfile
 import unittest
-from ovs_extensions.generic.configuration import Configuration
+from threading import Thread
+from ovs_extensions.generic.configuration import Configuration, ConfigurationAssertionException
+from ovs_extensions.generic.configuration.clients.mock_keyvalue import ConfigurationMockKeyValue
+from ovs_extensions.generic.configuration.snapshot import ConfigurationSnapshot
 
 
 class ConfigurationTest(unittest.TestCase):
@@ -81,3 +90,193 @@ class ConfigurationTest(unittest.TestCase):
             get_value = Configuration.get(key)
             self.assertIsInstance(get_value, data_type)
             self.assertEquals(get_value, value)
+
+    def test_passthrough_hook(self):
+        """
+        Test that registered hooks receive the latency of every passthrough call
+        """
+        calls = []
+
+        def _hook(method, duration):
+            calls.append((method, duration))
+
+        Configuration.add_passthrough_hook(_hook)
+        try:
+            Configuration.set('/foohook', 1)
+            Configuration.get('/foohook')
+        finally:
+            Configuration.remove_passthrough_hook(_hook)
+        Configuration.get('/foohook')
+        self.assertEqual([method for method, _ in calls], ['set', 'get'])
+        self.assertTrue(all(duration >= 0 for _, duration in calls))
+
+    def test_snapshot(self):
+        """
+        Test serving reads from a local snapshot
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'configuration.snapshot')
+            Configuration.set('/foosnapshot/bar', {'foo': 1})
+            Configuration.set('/foosnapshot/raw', 'raw', raw=True)
+            snapshot = ConfigurationSnapshot(Configuration, ['/foosnapshot'], path)
+            self.assertIsNone(snapshot.get('/foosnapshot/bar'))
+            snapshot.refresh()
+
+            # A new process loads the snapshot from disk
+            snapshot = ConfigurationSnapshot(Configuration, ['/foosnapshot'], path)
+            self.assertEqual(snapshot.get('/foosnapshot/raw'), 'raw')
+            Configuration._snapshot = snapshot
+            Configuration._passthrough(method='set', key='/foosnapshot/bar', value='{"foo": 2}')  # Bypasses the snapshot
+            self.assertEqual(Configuration.get('/foosnapshot/bar|foo'), 1)
+            # Writes through the Configuration are never served from the snapshot
+            Configuration.set('/foosnapshot/bar|foo', 3)
+            self.assertEqual(Configuration.get('/foosnapshot/bar|foo'), 3)
+            # Once reconciled, all reads go to the live store
+            Configuration._passthrough(method='set', key='/foosnapshot/raw', value='changed')
+            snapshot.refresh()
+            self.assertEqual(snapshot._invalidated, {})
+            self.assertIsNone(snapshot.get('/foosnapshot/raw'))
+            self.assertEqual(Configuration.get('/foosnapshot/raw', raw=True), 'changed')
+            self.assertEqual(Configuration.get('/foosnapshot/bar|foo'), 3)
+        finally:
+            Configuration.disable_snapshot()
+            shutil.rmtree(directory)
+
+    def test_snapshot_refresh(self):
+        """
+        Test keeping the snapshot on disk up to date
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            key = '/foosnapshotrefresh/bar'
+            prefixes = ['/foosnapshotrefresh']
+            path = os.path.join(directory, 'configuration.snapshot')
+            Configuration.set(key, 'bar', raw=True)
+            snapshot = ConfigurationSnapshot(Configuration, prefixes, path)
+            snapshot._get_txid = lambda: 5
+            snapshot.refresh()
+            self.assertEqual(snapshot._read_txid(), 5)
+            # An unchanged store only marks the snapshot as verified
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+            Configuration._passthrough(method='set', key=key, value='changed')
+            snapshot.refresh()
+            self.assertGreater(os.stat(path).st_mtime, time.time() - 60)
+            self.assertEqual(ConfigurationSnapshot(Configuration, prefixes, path).get(key), 'bar')
+            # A changed store rewrites the snapshot
+            snapshot._get_txid = lambda: 6
+            snapshot.refresh()
+            self.assertEqual(snapshot._read_txid(), 6)
+            self.assertEqual(ConfigurationSnapshot(Configuration, prefixes, path).get(key), 'changed')
+            # Snapshots which were not verified for too long are ignored
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+            self.assertIsNone(ConfigurationSnapshot(Configuration, prefixes, path).get(key))
+            self.assertEqual(ConfigurationSnapshot(Configuration, prefixes, path, max_age=86400).get(key), 'changed')
+            # Nothing is loaded after the snapshot was stopped
+            snapshot = ConfigurationSnapshot(Configuration, prefixes, path, max_age=86400)
+            snapshot.stop()
+            self.assertFalse(snapshot.load())
+            snapshot.refresh()
+            self.assertIsNone(snapshot.get(key))
+            self.assertEqual(snapshot._read_txid(), 6)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_encoding(self):
+        """
+        Test storing values under prefixes with different encodings
+        """
+        Configuration.set('/fooencoding/pretty', {'foo': [1, 2]})
+        Configuration.set('/fooencoding/compact/old', {'foo': [1, 2]})
+        Configuration.set_encoding('/fooencoding/compact', Configuration.ENCODING_COMPACT)
+        Configuration.set_encoding('/fooencoding/compact/binary', Configuration.ENCODING_BINARY)
+        try:
+            Configuration.set('/fooencoding/compact/new', {'foo': [1, 2]})
+            Configuration.set('/fooencoding/compact/binary/new', {'foo': [1, 2]})
+            self.assertEqual(Configuration.get('/fooencoding/pretty', raw=True), '{\n    "foo": [\n        1, \n        2\n    ]\n}')
+            self.assertEqual(Configuration.get('/fooencoding/compact/new', raw=True), '{"foo":[1,2]}')
+            Configuration.set('/fooencoding/compact/path', {'path': '/opt/OpenvStorage', 'size': 2 ** 70})
+            self.assertEqual(Configuration.get('/fooencoding/compact/path', raw=True), '{"path":"/opt/OpenvStorage","size":1180591620717411303424}')
+            self.assertTrue(Configuration.get('/fooencoding/compact/binary/new', raw=True).startswith(Configuration.BINARY_MAGIC))
+            for key in ['pretty', 'compact/old', 'compact/new', 'compact/binary/new']:
+                self.assertEqual(Configuration.get('/fooencoding/{0}|foo'.format(key)), [1, 2])
+
+            # Asserting a value still stored in the previous encoding
+            transaction = Configuration.begin_transaction()
+            Configuration.assert_value('/fooencoding/compact/old', {'foo': [1, 2]}, transaction=transaction)
+            Configuration.set('/fooencoding/compact/old|bar', 1, transaction=transaction)
+            Configuration.apply_transaction(transaction)
+            self.assertEqual(Configuration.get('/fooencoding/compact/old'), {'foo': [1, 2], 'bar': 1})
+
+            Configuration._passthrough(method='set', key='/fooencoding/compact/other', value=json.dumps({'foo': 1}, indent=4))
+            self.assertEqual(Configuration.migrate_encoding('/fooencoding', batch_size=1), 1)
+            self.assertEqual(Configuration.get('/fooencoding/compact/other', raw=True), '{"foo":1}')
+            self.assertEqual(Configuration.migrate_encoding('/fooencoding'), 0)
+        finally:
+            Configuration.set_encoding('/fooencoding/compact', None)
+            Configuration.set_encoding('/fooencoding/compact/binary', None)
+
+    def test_thread_clients(self):
+        """
+        Test that clients built per thread are closed once their thread is gone
+        """
+        closed = []
+        clients = Configuration._clients
+        Configuration._clients = {}
+        ConfigurationMockKeyValue.CLIENT_PER_THREAD = True
+        ConfigurationMockKeyValue.close = lambda s: closed.append(s)
+        try:
+            instances = []
+            thread = Thread(target=lambda: instances.append(Configuration._get_instance()))
+            thread.start()
+            thread.join()
+            self.assertEqual(closed, [])
+            del thread
+            gc.collect()
+            self.assertEqual(closed, instances)
+            self.assertIsNot(Configuration._get_instance(), instances[0])
+        finally:
+            Configuration._clients = clients
+            del ConfigurationMockKeyValue.CLIENT_PER_THREAD
+            del ConfigurationMockKeyValue.close
+
+    def test_transaction(self):
+        """
+        Test the transaction builder
+        """
+        Configuration.set('/footransaction/a', {'count': 1})
+        Configuration.set('/footransaction/b', 'b', raw=True)
+        with Configuration.transaction() as transaction:
+            transaction.prefetch(['/footransaction/a|count', '/footransaction/b', '/footransaction/c'])
+            transaction.set('/footransaction/a|count', transaction.get('/footransaction/a|count') + 1)
+            self.assertEqual(transaction.get('/footransaction/a'), {'count': 2})
+            self.assertEqual(transaction.get('/footransaction/b', raw=True), 'b')
+            self.assertIsNone(transaction.get('/footransaction/c', default=None))
+            transaction.set('/footransaction/c', [1])
+            transaction.delete('/footransaction/b')
+        self.assertEqual(Configuration.get('/footransaction/a'), {'count': 2})
+        self.assertEqual(Configuration.get('/footransaction/c'), [1])
+        self.assertFalse(Configuration.exists('/footransaction/b', raw=True))
+
+        # Pre-images which changed fail the commit
+        transaction = Configuration.transaction()
+        transaction.set('/footransaction/a|count', transaction.get('/footransaction/a|count') + 1)
+        Configuration.set('/footransaction/a|count', 10)
+        with self.assertRaises(ConfigurationAssertionException):
+            transaction.commit()
+
+        # Which are retried when running the transaction
+        calls = []
+
+        def _increment(_transaction):
+            calls.append(_transaction)
+            count = _transaction.get('/footransaction/a|count')
+            if len(calls) == 1:
+                Configuration.set('/footransaction/a|count', 20)
+            _transaction.set('/footransaction/a|count', count + 1)
+            return count + 1
+
+        self.assertEqual(Configuration.run_transaction(_increment), 21)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(Configuration.register_usage('foo', '/footransaction/components'), ['foo'])
+        self.assertEqual(Configuration.register_usage('bar', '/footransaction/components'), ['foo', 'bar'])
@@ -0,0 +1,165 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+"""
+Test module for the ArakoonConfigurationLock
+"""
+import time
+import ujson
+import unittest
+from threading import Thread
+from ovs_extensions.generic.configuration import NoLockAvailableException
+from ovs_extensions.generic.configuration.clients.arakoon import ArakoonConfigurationLock
+from ovs_extensions.storage.persistent.dummystore import DummyPersistentStore
+
+
+class ConfigurationLockTest(unittest.TestCase):
+    """
+    Test the queued Arakoon configuration lock
+    """
+
+    def setUp(self):
+        self.client = DummyPersistentStore(mimick_pyrakoonclient=True)
+        ArakoonConfigurationLock.reset_metrics()
+
+    def _build_lock(self, name='test', wait=None, expiration=60):
+        return ArakoonConfigurationLock(None, name, wait=wait, expiration=expiration, client=self.client)
+
+    def test_fast_path(self):
+        """
+        An uncontended lock is taken without queueing and all keys are cleaned up after releasing
+        """
+        lock = self._build_lock()
+        with lock:
+            self.assertTrue(self.client.exists(lock._key))
+            self.assertEqual(self.client.get(lock._key), self.client.get(lock._queue_key))
+        self.assertFalse(self.client.exists(lock._key))
+        self.assertEqual(list(self.client.prefix(lock._queue_prefix)), [])
+        metrics = ArakoonConfigurationLock.get_metrics('test')
+        self.assertEqual(metrics['wait_time']['count'], 1)
+        self.assertEqual(metrics['hold_time']['count'], 1)
+
+    def test_mutual_exclusion_and_fairness(self):
+        """
+        Concurrent waiters never hold the lock together and are served in order of arrival
+        """
+        holders = []
+        overlaps = []
+        acquired_order = []
+        first_lock = self._build_lock()
+        first_lock.acquire()
+
+        def _worker(index):
+            with self._build_lock():
+                holders.append(index)
+                if len(holders) > 1:
+                    overlaps.append(list(holders))
+                acquired_order.append(index)
+                time.sleep(0.01)
+                holders.remove(index)
+
+        threads = [Thread(target=_worker, args=(index,)) for index in xrange(5)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)  # Make sure every worker has been queued before starting the next one
+        first_lock.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlaps, [])
+        self.assertEqual(acquired_order, range(5))
+        self.assertFalse(self.client.exists(first_lock._key))
+
+    def test_wait_timeout(self):
+        """
+        A waiter gives up after the wait time and removes its queue entry
+        """
+        holder = self._build_lock()
+        holder.acquire()
+        waiter = self._build_lock(wait=0.1)
+        with self.assertRaises(NoLockAvailableException):
+            waiter.acquire()
+        self.assertEqual(list(self.client.prefix(waiter._queue_prefix)), [holder._queue_key])
+        holder.release()
+        self.assertEqual(ArakoonConfigurationLock.get_metrics('test')['timeouts']['count'], 1)
+
+    def test_wait_error(self):
+        """
+        A waiter failing for another reason than the wait time also removes its queue entry and stops refreshing it
+        """
+        holder = self._build_lock()
+        holder.acquire()
+        waiter = self._build_lock()
+
+        def _failing_predecessor():
+            raise RuntimeError('Arakoon unavailable')
+
+        waiter._get_predecessor = _failing_predecessor
+        with self.assertRaises(RuntimeError):
+            waiter.acquire()
+        self.assertIsNone(waiter._refresher)
+        self.assertEqual(list(self.client.prefix(waiter._queue_prefix)), [holder._queue_key])
+        holder.release()
+
+    def test_fast_path_respects_queue(self):
+        """
+        A newcomer does not pass a queued waiter when the newest waiter gave up and the lock is in between holders
+        """
+        holder = self._build_lock()
+        holder.acquire()
+        older_waiter = self._build_lock()
+        self.assertFalse(older_waiter._enqueue())
+        newest_waiter = self._build_lock(wait=0.05)
+        with self.assertRaises(NoLockAvailableException):
+            newest_waiter.acquire()
+        holder.release()
+        newcomer = self._build_lock(wait=0.05)
+        with self.assertRaises(NoLockAvailableException):
+            newcomer.acquire()
+        older_waiter._dequeue()
+
+    def test_no_refresh_after_release(self):
+        """
+        The refresher does not write anymore once the lock was released
+        """
+        lock = self._build_lock(expiration=0.3)
+        refreshes = []
+        set_value = self.client.set
+
+        def _set(key, value, transaction=None):
+            if transaction is not None:
+                refreshes.append(key)
+            return set_value(key, value, transaction=transaction)
+
+        lock.acquire()
+        self.client.set = _set
+        lock.release()  # Well within the refresh interval, so only the run after cancelling could refresh
+        self.assertListEqual(refreshes, [])
+        self.assertFalse(self.client.exists(lock._key))
+
+    def test_expired_holder(self):
+        """
+        The entries of a holder which stopped refreshing are cleaned up by the next waiter
+        """
+        holder = self._build_lock()
+        holder.acquire()
+        holder._stop_refresher()
+        expired_data = ujson.dumps({'time_set': time.time() - 10, 'expires': time.time() - 5, 'id': holder.id})
+        self.client.set(holder._key, expired_data)
+        self.client.set(holder._queue_key, expired_data)
+        waiter = self._build_lock(wait=5)
+        waiter.acquire()
+        self.assertEqual(ujson.loads(self.client.get(waiter._key))['id'], waiter.id)
+        waiter.release()
@@ -0,0 +1,236 @@
+# Copyright (C) 2019 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+"""
+Transaction module for the Configuration
+"""
+from ovs_extensions.constants.file_extensions import RAW_FILES
+from ovs_extensions.generic.configuration.exceptions import ConfigurationNotFoundException as NotFoundException
+
+
+class ConfigurationTransaction(object):
+    """
+    Builds a configuration transaction locally
+    - Reads are served from pre-images which are fetched once (or all at once using prefetch)
+    - All pre-images that were read are asserted to be unchanged when committing
+    - Writes are collected and are visible to subsequent reads within the transaction
+    - Committing applies all asserts and writes in a single sequence
+    Can be used as a context manager: the transaction is committed when the block exits without exception
+    """
+    _NO_DEFAULT = object()
+
+    def __init__(self, configuration):
+        # type: (type) -> None
+        """
+        Initializes a new transaction
+        :param configuration: The Configuration class to apply the transaction to
+        :type configuration: type
+        """
+        self._configuration = configuration
+        self._keys = {}
+        self._reads = {}
+        self._writes = {}
+        self._asserts = []
+        self._operations = []
+        self._committed = False
+
+    def __enter__(self):
+        # type: () -> ConfigurationTransaction
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _ = exc_val, exc_tb
+        if exc_type is None:
+            self.commit()
+
+    @staticmethod
+    def _clean_key(key):
+        # type: (str) -> str
+        return key.strip('/')
+
+    def prefetch(self, keys):
+        # type: (List[str]) -> None
+        """
+        Fetch the pre-images of multiple keys in a single call
+        :param keys: Keys to fetch. JSON paths are ignored
+        :type keys: list[str]
+        :return: None
+        :rtype: NoneType
+        """
+        keys = [key.split('|')[0] for key in keys]
+        keys = [key for key in keys if self._clean_key(key) not in self._reads]
+        if len(keys) == 0:
+            return
+        values = self._configuration._passthrough(method='get_multi', keys=keys)
+        for key, value in zip(keys, values):
+            self._keys[self._clean_key(key)] = key
+            self._reads[self._clean_key(key)] = value
+
+    def _get_raw(self, key):
+        # type: (str) -> Optional[str]
+        """
+        Retrieve the raw value of a key as seen by this transaction
+        :param key: Key to retrieve (without JSON path)
+        :type key: str
+        :return: The raw value or None when the key does not exist
+        :rtype: str
+        """
+        clean_key = self._clean_key(key)
+        if clean_key in self._writes:
+            return self._writes[clean_key]
+        if clean_key not in self._reads:
+            # Not using the Configuration getter: pre-images must come from the live store
+            try:
+                self._reads[clean_key] = self._configuration._passthrough(method='get', key=key)
+            except NotFoundException:
+                self._reads[clean_key] = None
+            self._keys[clean_key] = key
+        return self._reads[clean_key]
+
+    def get(self, key, raw=False, default=_NO_DEFAULT):
+        # type: (str, bool, any) -> any
+        """
+        Get a value as seen by this transaction
+        :param key: Key to get. Supports the <main path>|<json path> format
+        :type key: str
+        :param raw: Raw data if True else json format
+        :type raw: bool
+        :param default: Value to return when the key does not exist. Raises NotFoundException when not specified
+        :type default: any
+        :return: The value
+        :rtype: any
+        """
+        key_entries = key.split('|')
+        raw_value = self._get_raw(key_entries[0])
+        try:
+            if raw_value is None:
+                raise NotFoundException(key_entries[0])
+            if raw is True or key_entries[0].endswith(RAW_FILES):
+                data = raw_value
+            else:
+                data = self._configuration._load_data(raw_value)
+            if len(key_entries) == 1:
+                return data
+            try:
+                for entry in key_entries[1].split('.'):
+                    data = data[entry]
+                return data
+            except KeyError as ex:
+                raise NotFoundException(ex.message)
+        except NotFoundException:
+            if default is not self._NO_DEFAULT:
+                return default
+            raise
+
+    def set(self, key, value, raw=False):
+        # type: (str, any, bool) -> None
+        """
+        Set a value within this transaction
+        :param key: Key to set. Supports the <main path>|<json path> format
+        :type key: str
+        :param value: Value to set
+        :type value: any
+        :param raw: Raw data if True else apply json format
+        :type raw: bool
+        :return: None
+        :rtype: NoneType
+        """
+        key_entries = key.split('|')
+        main_key = key_entries[0]
+        data = value
+        if len(key_entries) > 1:
+            data = self.get(main_key, default={})
+            temp_config = data
+            entries = key_entries[1].split('.')
+            for entry in entries[:-1]:
+                temp_config = temp_config.setdefault(entry, {})
+            temp_config[entries[-1]] = value
+        if raw is False and not main_key.endswith(RAW_FILES):
+            data = self._configuration._dump_data(data, main_key)
+        self._writes[self._clean_key(main_key)] = data
+        self._operations.append(('set', main_key, data))
+
+    def delete(self, key):
+        # type: (str) -> None
+        """
+        Delete a key (recursively) within this transaction
+        :param key: Key to delete
+        :type key: str
+        :return: None
+        :rtype: NoneType
+        """
+        clean_key = self._clean_key(key)
+        for written_key in self._writes.keys():
+            if written_key.startswith(clean_key + '/'):
+                self._writes[written_key] = None
+        self._writes[clean_key] = None
+        self._operations.append(('delete', key, None))
+
+    def assert_value(self, key, value, raw=False):
+        # type: (str, any, bool) -> None
+        """
+        Assert the value of a key when committing
+        :param key: Key to assert
+        :type key: str
+        :param value: The value the key should have. None asserts that the key does not exist
+        :type value: any
+        :param raw: Raw data if True else apply json format
+        :type raw: bool
+        :return: None
+        :rtype: NoneType
+        """
+        self._asserts.append(('assert_value', key, (value, raw)))
+
+    def assert_exists(self, key):
+        # type: (str) -> None
+        """
+        Assert that a key exists when committing
+        :param key: Key to assert
+        :type key: str
+        :return: None
+        :rtype: NoneType
+        """
+        self._asserts.append(('assert_exists', key, None))
+
+    def commit(self):
+        # type: () -> None
+        """
+        Apply all asserts and writes in a single sequence
+        :return: None
+        :rtype: NoneType
+        :raises ConfigurationAssertionException: when a pre-image or an assert no longer matches
+        """
+        if self._committed is True:
+            raise RuntimeError('The transaction has already been committed')
+        self._committed = True
+        if len(self._operations) == 0 and len(self._asserts) == 0:
+            return
+        configuration = self._configuration
+        transaction = configuration.begin_transaction()
+        for clean_key, raw_value in self._reads.iteritems():
+            configuration.assert_value(self._keys[clean_key], raw_value, transaction=transaction, raw=True)
+        for action, key, info in self._asserts:
+            if action == 'assert_value':
+                value, raw = info
+                configuration.assert_value(key, value, transaction=transaction, raw=raw)
+            else:
+                configuration.assert_exists(key, transaction=transaction)
+        for action, key, data in self._operations:
+            if action == 'set':
+                configuration._set(key, data, raw=True, transaction=transaction)
+            else:
+                configuration._delete(key, recursive=True, transaction=transaction)
+        configuration.apply_transaction(transaction)
@@ -18,10 +18,17 @@
 File mutex module
 """
 import os
+import math
 import stat
 import time
+import errno
 import fcntl
+import select
+import thread
 import logging
+from collections import deque
+from threading import Lock, Thread
+from ovs_extensions.generic.lockprofiler import LockProfiler
 
 
 class NoLockAvailableException(Exception):
@@ -31,12 +38,226 @@ class NoLockAvailableException(Exception):
     pass
 
 
+class _Notification(object):
+    """
+    One-time notification between threads. Waiting happens in the kernel (poll on a pipe), so a timed wait doesn't
+    busy-wait and wakes up as soon as the notification is sent. Unlike select, poll handles file descriptors beyond
+    FD_SETSIZE, which long-running processes with many open sockets easily get.
+    """
+
+    def __init__(self, ident=None):
+        self.ident = ident
+        self.sent = False
+        self._read, self._write = os.pipe()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the notification
+        :param timeout: Maximum amount of seconds to wait. None to wait forever
+        :type timeout: float
+        :return: Whether the notification was received
+        :rtype: bool
+        """
+        start = time.time()
+        poller = select.poll()
+        poller.register(self._read, select.POLLIN)
+        remaining = None if timeout is None else max(0, timeout)
+        while True:
+            try:
+                return len(poller.poll(None if remaining is None else int(math.ceil(remaining * 1000)))) > 0
+            except select.error as ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+            if timeout is not None:
+                remaining = max(0, timeout - (time.time() - start))
+
+    def send(self):
+        """
+        Sends the notification
+        """
+        self.sent = True
+        os.write(self._write, '1')
+
+    def close(self):
+        """
+        Closes the pipe
+        """
+        os.close(self._read)
+        os.close(self._write)
+
+
+class _SharedLock(object):
+    """
+    Process-wide state of a lock file, shared by all file mutexes with the same key:
+    * The lock file is opened once. flock locks belong to the open file, so the threads of the process first agree on
+      an owner, in order of arrival, and only that owner locks the file
+    * The owning thread can acquire the lock again, it is released when all acquisitions are released
+    * A timed wait for the file lock is done by a helper thread in a blocking flock call. When the waiting thread gives
+      up, the helper releases the file lock again as soon as it gets it, unless another thread has started waiting
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.users = 0  # Amount of mutexes using this lock, maintained by file_mutex
+        self._handle = open(path, 'w')
+        try:
+            os.chmod(path,
+                     stat.S_IRUSR | stat.S_IWUSR |
+                     stat.S_IRGRP | stat.S_IWGRP |
+                     stat.S_IROTH | stat.S_IWOTH)
+        except OSError:
+            pass
+        self._lock = Lock()
+        self._owner = None
+        self._count = 0
+        self._waiters = deque()
+        self._flock_pending = False
+        self._flock_waiter = None
+        self._closed = False
+
+    def acquire(self, timeout=None):
+        """
+        Acquires the lock for the current thread
+        :param timeout: Maximum amount of seconds to wait. None to wait forever
+        :type timeout: float
+        :return: Whether the lock was acquired
+        :rtype: bool
+        """
+        start = time.time()
+        ident = thread.get_ident()
+        waiter = None
+        with self._lock:
+            if self._owner == ident:
+                self._count += 1
+                return True
+            if self._owner is None and len(self._waiters) == 0:
+                self._owner = ident
+            elif timeout is not None and timeout <= 0:
+                return False
+            else:
+                waiter = _Notification(ident)
+                self._waiters.append(waiter)
+        if waiter is not None:
+            waiter.wait(timeout)
+            with self._lock:
+                waiter.close()
+                if waiter.sent is False:  # Ownership might have been handed over right after the wait timed out
+                    self._waiters.remove(waiter)
+                    return False
+        remaining = None if timeout is None else timeout - (time.time() - start)
+        try:
+            locked = self._lock_file(remaining)
+        except Exception:
+            with self._lock:
+                self._hand_over()
+            raise
+        with self._lock:
+            if locked is False:
+                self._hand_over()
+                return False
+            self._count = 1
+            return True
+
+    def release(self):
+        """
+        Releases one acquisition of the current thread
+        :return: None
+        """
+        with self._lock:
+            self._count -= 1
+            if self._count == 0:
+                fcntl.flock(self._handle, fcntl.LOCK_UN)
+                self._hand_over()
+
+    def close(self):
+        """
+        Closes the lock file, possibly deferred until a pending flock call returns
+        """
+        with self._lock:
+            self._closed = True
+            if self._flock_pending is False:
+                self._handle.close()
+
+    def _hand_over(self):
+        """
+        Passes ownership to the longest waiting thread. Must be called while holding the internal lock
+        """
+        if len(self._waiters) > 0:
+            waiter = self._waiters.popleft()
+            self._owner = waiter.ident
+            waiter.send()
+        else:
+            self._owner = None
+
+    def _lock_file(self, timeout):
+        """
+        Locks the file, waiting at most `timeout` seconds. Only called by the owning thread
+        """
+        with self._lock:
+            if self._flock_pending is False:
+                if timeout is None:
+                    blocking = True
+                else:
+                    blocking = False
+                    try:
+                        fcntl.flock(self._handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        return True
+                    except IOError as ex:
+                        if ex.errno not in [errno.EAGAIN, errno.EACCES]:
+                            raise
+                    if timeout <= 0:
+                        return False
+                    self._flock_pending = True
+                    helper = Thread(target=self._wait_for_file, name='file_mutex {0}'.format(self.path))
+                    helper.daemon = True
+                    helper.start()
+            else:
+                blocking = False
+            if blocking is False:
+                waiter = _Notification()
+                self._flock_waiter = waiter
+        if blocking is True:
+            fcntl.flock(self._handle, fcntl.LOCK_EX)
+            return True
+        waiter.wait(timeout)
+        with self._lock:
+            self._flock_waiter = None
+            waiter.close()
+            return waiter.sent
+
+    def _wait_for_file(self):
+        """
+        Executed by the helper thread: locks the file and passes the lock to the waiting thread, if any
+        """
+        try:
+            fcntl.flock(self._handle, fcntl.LOCK_EX)
+            locked = True
+        except (IOError, ValueError):
+            locked = False
+        with self._lock:
+            self._flock_pending = False
+            if locked is True:
+                if self._flock_waiter is not None:
+                    self._flock_waiter.send()
+                else:
+                    fcntl.flock(self._handle, fcntl.LOCK_UN)
+            if self._closed is True:
+                self._handle.close()
+
+
 class file_mutex(object):
     """
     This is mutex backed on the filesystem. It's cross thread and cross process. However
     its limited to the boundaries of a filesystem
+    * Within a process, all mutexes with the same name share one open lock file and are granted in order of arrival
+    * A thread holding the mutex can acquire it again (also through another file_mutex object with the same name)
+    * Waiting, also with a timeout, happens in the kernel so the lock is handed over as soon as it is released
     """
 
+    _locks = {}
+    _locks_lock = Lock()
+    _locks_pid = os.getpid()
+
     def __init__(self, name, wait=None):
         """
         Creates a file mutex object
@@ -45,17 +266,8 @@ class file_mutex(object):
         self._has_lock = False
         self._start = 0
         self._logger = logging.getLogger(__name__)
-        self._handle = open(self.key(), 'w')
         self._wait = wait
-        try:
-            os.chmod(
-                self.key(),
-                stat.S_IRUSR | stat.S_IWUSR |
-                stat.S_IRGRP | stat.S_IWGRP |
-                stat.S_IROTH | stat.S_IWOTH
-            )
-        except OSError:
-            pass
+        self._lock = file_mutex._get_lock(self.key())
 
     def __call__(self, wait):
         self._wait = wait
@@ -79,21 +291,31 @@ class file_mutex(object):
         self._start = time.time()
         if wait is None:
             wait = self._wait
-        passed = 0
-        if wait is None:
-            fcntl.flock(self._handle, fcntl.LOCK_EX)
+        if LockProfiler.enabled is True:
+            return self._acquire_profiled(wait)
+        if not self._lock.acquire(wait):
             passed = time.time() - self._start
-        else:
-            while True:
-                passed = time.time() - self._start
-                if passed > wait:
-                    self._logger.error('Lock for {0} could not be acquired. {1} sec > {2} sec'.format(self.key(), passed, wait))
-                    raise NoLockAvailableException('Could not acquire lock %s' % self.key())
-                try:
-                    fcntl.flock(self._handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    break
-                except IOError:
-                    time.sleep(0.005)
+            self._logger.error('Lock for {0} could not be acquired. {1} sec > {2} sec'.format(self.key(), passed, wait))
+            raise NoLockAvailableException('Could not acquire lock %s' % self.key())
+        passed = time.time() - self._start
+        if passed > 1:  # More than 1 s is a long time to wait!
+            self._logger.warning('Waited {0} sec for lock {1}'.format(passed, self.key()))
+        self._start = time.time()
+        self._has_lock = True
+        return True
+
+    def _acquire_profiled(self, wait):
+        """
+        Acquires the lock, reporting to the LockProfiler
+        """
+        contended = not self._lock.acquire(0)
+        if contended is True and not self._lock.acquire(None if wait is None else wait - (time.time() - self._start)):
+            passed = time.time() - self._start
+            LockProfiler.record_acquire('file_mutex:{0}'.format(self.name), passed, contended=True, timeout=True)
+            self._logger.error('Lock for {0} could not be acquired. {1} sec > {2} sec'.format(self.key(), passed, wait))
+            raise NoLockAvailableException('Could not acquire lock %s' % self.key())
+        passed = time.time() - self._start
+        LockProfiler.record_acquire('file_mutex:{0}'.format(self.name), passed, contended=contended)
         if passed > 1:  # More than 1 s is a long time to wait!
             self._logger.warning('Waited {0} sec for lock {1}'.format(passed, self.key()))
         self._start = time.time()
@@ -105,8 +327,10 @@ class file_mutex(object):
         Releases the lock
         """
         if self._has_lock:
-            fcntl.flock(self._handle, fcntl.LOCK_UN)
+            self._lock.release()
             passed = time.time() - self._start
+            if LockProfiler.enabled is True:
+                LockProfiler.record_release('file_mutex:{0}'.format(self.name), passed)
             if passed > 2.5:  # More than 2.5 s is a long time to hold a lock
                 self._logger.warning('A lock on {0} was kept for {1} sec'.format(self.key(), passed))
             self._has_lock = False
@@ -119,9 +343,41 @@ class file_mutex(object):
             return self.name  # Assuming a path
         return '/var/lock/ovs_flock_{0}'.format(self.name)
 
+    @classmethod
+    def _get_lock(cls, key):
+        """
+        Returns the shared lock for a given key, registering its use
+        """
+        with file_mutex._locks_lock:
+            if file_mutex._locks_pid != os.getpid():  # A forked process must not share the lock files of its parent
+                file_mutex._locks = {}
+                file_mutex._locks_pid = os.getpid()
+            lock = file_mutex._locks.get(key)
+            if lock is None:
+                lock = _SharedLock(key)
+                file_mutex._locks[key] = lock
+            lock.users += 1
+            return lock
+
+    @classmethod
+    def _put_lock(cls, key, lock):
+        """
+        Unregisters the use of a shared lock, closing its file when no longer used
+        """
+        with file_mutex._locks_lock:
+            lock.users -= 1
+            if lock.users == 0:
+                if file_mutex._locks.get(key) is lock:
+                    del file_mutex._locks[key]
+                lock.close()
+
     def __del__(self):
         """
         __del__ hook, releasing the lock
         """
-        self.release()
-        self._handle.close()
+        if hasattr(self, '_lock'):
+            self.release()
+            file_mutex._put_lock(self.key(), self._lock)
+
+
+LockProfiler.register_internal_file(__file__)
@@ -0,0 +1,303 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Lock profiler module
+"""
+import sys
+import time
+import bisect
+from threading import Lock, local
+
+
+class LockProfiler(object):
+    """
+    Opt-in, in-process profiler for all lock types (volatile_mutex, file_mutex, the Arakoon configuration lock and the
+    thread locks of the clients). Per lock name it keeps:
+    * a histogram of the time needed to acquire the lock and the hold durations
+    * the amount of acquisitions, contended acquisitions (the lock was not free) and timeouts
+    * the call sites which had to wait the longest
+    While disabled, the lock implementations only check the `enabled` flag
+    """
+    HISTOGRAM_BOUNDS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]  # Upper bounds in seconds
+    CALL_SITE_DEPTH = 3
+    INTERNAL_FUNCTIONS = ['acquire', '__enter__', 'new_function']  # Lock methods and locking decorators
+
+    enabled = False
+
+    _lock = Lock()
+    _stats = {}
+    _internal_files = set()
+
+    @classmethod
+    def enable(cls):
+        # type: () -> None
+        """
+        Starts profiling the locks
+        :return: None
+        """
+        LockProfiler.enabled = True
+
+    @classmethod
+    def disable(cls):
+        # type: () -> None
+        """
+        Stops profiling the locks. The collected data is kept
+        :return: None
+        """
+        LockProfiler.enabled = False
+
+    @classmethod
+    def reset(cls):
+        # type: () -> None
+        """
+        Clears the collected data
+        :return: None
+        """
+        with LockProfiler._lock:
+            LockProfiler._stats = {}
+
+    @classmethod
+    def register_internal_file(cls, filename):
+        # type: (str) -> None
+        """
+        Excludes the frames of a file from the call sites, used by the lock implementations
+        :param filename: The file name (__file__ of the module)
+        :type filename: str
+        :return: None
+        """
+        LockProfiler._internal_files.add(filename.rstrip('co'))  # .pyc/.pyo to .py
+
+    @classmethod
+    def record_acquire(cls, name, wait_time, contended, timeout=False):
+        # type: (str, float, bool, bool) -> None
+        """
+        Registers an attempt to acquire a lock
+        :param name: Name of the lock
+        :type name: str
+        :param wait_time: Seconds needed to acquire the lock (or to give up)
+        :type wait_time: float
+        :param contended: Whether the lock was in use when trying to acquire it
+        :type contended: bool
+        :param timeout: Whether the lock could not be acquired
+        :type timeout: bool
+        :return: None
+        """
+        call_site = LockProfiler._get_call_site() if contended is True else None
+        with LockProfiler._lock:
+            stats = LockProfiler._get_stats(name)
+            if timeout is True:
+                stats['timeouts'] += 1
+            else:
+                stats['acquisitions'] += 1
+            if contended is True:
+                stats['contended'] += 1
+                site = stats['call_sites'].setdefault(call_site, [0, 0.0])
+                site[0] += 1
+                site[1] += wait_time
+            LockProfiler._add_to_histogram(stats['wait'], wait_time)
+
+    @classmethod
+    def record_release(cls, name, hold_time):
+        # type: (str, float) -> None
+        """
+        Registers the release of a lock
+        :param name: Name of the lock
+        :type name: str
+        :param hold_time: Seconds the lock was held
+        :type hold_time: float
+        :return: None
+        """
+        with LockProfiler._lock:
+            LockProfiler._add_to_histogram(LockProfiler._get_stats(name)['hold'], hold_time)
+
+    @classmethod
+    def get_report(cls, name=None, top=10):
+        # type: (Optional[str], int) -> dict
+        """
+        Returns the collected data
+        :param name: Name of the lock. None to return the data of all locks
+        :type name: str
+        :param top: Amount of call sites to return per lock
+        :type top: int
+        :return: Per lock name: the amount of acquisitions, contended acquisitions and timeouts, the wait and hold times
+                 (count, total, max and a histogram as a list of (upper bound, count)) and the call sites that waited
+                 the longest (call site, amount of contended acquisitions and total wait time)
+        :rtype: dict
+        """
+        report = {}
+        with LockProfiler._lock:
+            for lock_name, stats in LockProfiler._stats.iteritems():
+                if name is not None and lock_name != name:
+                    continue
+                call_sites = sorted(stats['call_sites'].iteritems(), key=lambda item: item[1][1], reverse=True)[:top]
+                report[lock_name] = {'acquisitions': stats['acquisitions'],
+                                     'contended': stats['contended'],
+                                     'timeouts': stats['timeouts'],
+                                     'wait': LockProfiler._get_histogram_report(stats['wait']),
+                                     'hold': LockProfiler._get_histogram_report(stats['hold']),
+                                     'call_sites': [{'call_site': call_site, 'count': count, 'wait_time': wait_time}
+                                                    for call_site, (count, wait_time) in call_sites]}
+        if name is not None:
+            return report.get(name)
+        return report
+
+    @classmethod
+    def format_report(cls, top=5):
+        # type: (int) -> str
+        """
+        Returns the collected data as readable text, locks with the highest total wait time first
+        :param top: Amount of call sites to show per lock
+        :type top: int
+        :return: The report
+        :rtype: str
+        """
+        lines = []
+        report = LockProfiler.get_report(top=top)
+        for name, stats in sorted(report.iteritems(), key=lambda item: item[1]['wait']['total'], reverse=True):
+            lines.append('{0}: {1} acquisitions, {2} contended, {3} timeouts'.format(name, stats['acquisitions'], stats['contended'], stats['timeouts']))
+            for kind in ['wait', 'hold']:
+                data = stats[kind]
+                if data['count'] == 0:
+                    continue
+                histogram = ', '.join('<{0}s: {1}'.format(bound, count) for bound, count in data['histogram'] if count > 0)
+                lines.append('  {0}: total {1:.4f}s, avg {2:.4f}s, max {3:.4f}s ({4})'.format(kind, data['total'], data['total'] / data['count'], data['max'], histogram))
+            for site in stats['call_sites']:
+                lines.append('  {0:.4f}s in {1} waits at {2}'.format(site['wait_time'], site['count'], site['call_site']))
+        return '\n'.join(lines)
+
+    @classmethod
+    def _get_stats(cls, name):
+        """
+        Returns the statistics of a lock. Must be called while holding the profiler lock
+        """
+        stats = LockProfiler._stats.get(name)
+        if stats is None:
+            stats = {'acquisitions': 0, 'contended': 0, 'timeouts': 0, 'call_sites': {},
+                     'wait': {'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(LockProfiler.HISTOGRAM_BOUNDS) + 1)},
+                     'hold': {'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(LockProfiler.HISTOGRAM_BOUNDS) + 1)}}
+            LockProfiler._stats[name] = stats
+        return stats
+
+    @classmethod
+    def _add_to_histogram(cls, histogram, value):
+        """
+        Adds a duration to a histogram. Must be called while holding the profiler lock
+        """
+        histogram['count'] += 1
+        histogram['total'] += value
+        histogram['max'] = max(histogram['max'], value)
+        histogram['buckets'][bisect.bisect_left(LockProfiler.HISTOGRAM_BOUNDS, value)] += 1
+
+    @classmethod
+    def _get_histogram_report(cls, histogram):
+        """
+        Converts a histogram for the report
+        """
+        bounds = LockProfiler.HISTOGRAM_BOUNDS + [float('inf')]
+        return {'count': histogram['count'],
+                'total': histogram['total'],
+                'max': histogram['max'],
+                'histogram': zip(bounds, histogram['buckets'])}
+
+    @classmethod
+    def _get_call_site(cls):
+        """
+        Describes the code waiting for the lock, skipping the frames of the profiler and the lock implementations
+        """
+        frame = sys._getframe(1)
+        while frame is not None and (frame.f_code.co_filename in LockProfiler._internal_files or
+                                     frame.f_code.co_name in LockProfiler.INTERNAL_FUNCTIONS or
+                                     frame.f_code.co_filename.endswith(('threading.py', 'contextlib.py'))):
+            frame = frame.f_back
+        call_site = []
+        while frame is not None and len(call_site) < LockProfiler.CALL_SITE_DEPTH:
+            call_site.append('{0}:{1} ({2})'.format(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+            frame = frame.f_back
+        return ' <- '.join(call_site)
+
+
+class ProfiledLock(object):
+    """
+    Wraps a threading Lock or RLock, reporting to the LockProfiler while it is enabled
+    """
+
+    def __init__(self, lock, name):
+        # type: (any, str) -> None
+        """
+        Initializes a ProfiledLock
+        :param lock: The lock to wrap
+        :type lock: threading.Lock or threading.RLock
+        :param name: Name of the lock in the profiler reports
+        :type name: str
+        """
+        self.name = name
+        self._lock = lock
+        self._state = local()  # Acquisition depth and start of the outermost acquisition, per thread
+
+    def acquire(self, blocking=True):
+        # type: (bool) -> bool
+        """
+        Acquires the lock
+        :param blocking: Wait for the lock
+        :type blocking: bool
+        :return: Whether the lock was acquired
+        :rtype: bool
+        """
+        if LockProfiler.enabled is False:
+            return self._lock.acquire(blocking)
+        depth = getattr(self._state, 'depth', 0)
+        if depth > 0:  # Reentrant acquisition of an RLock
+            acquired = self._lock.acquire(blocking)
+            if acquired is True:
+                self._state.depth = depth + 1
+            return acquired
+        start = time.time()
+        acquired = self._lock.acquire(False)
+        contended = acquired is False
+        if contended is True and blocking:
+            acquired = self._lock.acquire()
+        now = time.time()
+        LockProfiler.record_acquire(self.name, now - start, contended=contended, timeout=not acquired)
+        if acquired is True:
+            self._state.depth = 1
+            self._state.start = now
+        return acquired
+
+    def release(self):
+        # type: () -> None
+        """
+        Releases the lock
+        :return: None
+        """
+        depth = getattr(self._state, 'depth', 0)
+        if depth > 0:  # The acquisition was profiled
+            self._state.depth = depth - 1
+            if depth == 1:
+                LockProfiler.record_release(self.name, time.time() - self._state.start)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        _ = args, kwargs
+        self.release()
+
+
+LockProfiler.register_internal_file(__file__)
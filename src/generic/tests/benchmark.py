@@ -0,0 +1,148 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Contention benchmark for the volatile mutex. Run as a module:
+python -m ovs_extensions.generic.tests.benchmark [memcache address]
+Without address, a local MemcacheServer is started in a separate process. Every process runs a number of threads which
+all lock the same mutex, comparing the fixed 5 ms polling the volatile mutex used before with the current implementation.
+"""
+import sys
+import time
+from multiprocessing import Process, Queue
+from threading import Thread
+from ovs_extensions.generic.volatilemutex import NoLockAvailableException, volatile_mutex
+from ovs_extensions.storage.volatile.memcachestore import MemcacheStore
+from ovs_extensions.storage.volatile.tests.benchmark import _serve
+
+
+class _benchmark_mutex(volatile_mutex):
+    """
+    Volatile mutex counting the requests to memcache
+    """
+    _logger = None
+    address = None
+    requests = 0
+
+    @classmethod
+    def _get_volatile_client(cls):
+        store = MemcacheStore([cls.address])
+        add = store.add
+
+        def _add(*args, **kwargs):
+            _benchmark_mutex.requests += 1
+            return add(*args, **kwargs)
+
+        store.add = _add
+        return store
+
+
+class _polling_mutex(_benchmark_mutex):
+    """
+    Volatile mutex acquiring the lock by polling memcache every 5 ms
+    """
+
+    def acquire(self, wait=None):
+        self._start = time.time()
+        while not self._volatile.add(self.key(), 1, 60):
+            time.sleep(0.005)
+            if wait is not None and time.time() - self._start > wait:
+                raise NoLockAvailableException('Could not acquire lock {0}'.format(self.key()))
+        self._has_lock = True
+        self._start = time.time()
+        return True
+
+    def release(self):
+        if self._has_lock:
+            self._volatile.delete(self.key())
+            self._has_lock = False
+
+
+def _run_process(address, threads, acquisitions, polling, results):
+    """
+    Locks the mutex from the given amount of threads and reports the requests and wait times
+    """
+    mutex_class = _polling_mutex if polling is True else _benchmark_mutex
+    mutex_class.address = address
+    waits = []
+
+    def _run():
+        mutex = mutex_class('benchmark')
+        for _ in xrange(acquisitions):
+            start = time.time()
+            with mutex:
+                waits.append(time.time() - start)
+                time.sleep(0.0005)
+
+    workers = [Thread(target=_run) for _ in xrange(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put((_benchmark_mutex.requests, waits))
+
+
+def run(address, processes, threads, acquisitions=20, polling=False):
+    """
+    Executes the benchmark
+    :param address: Address of the memcache server
+    :type address: str
+    :param processes: Amount of processes
+    :type processes: int
+    :param threads: Amount of threads per process
+    :type threads: int
+    :param acquisitions: Amount of times every thread acquires the mutex
+    :type acquisitions: int
+    :param polling: Use the fixed polling acquisition instead of the current implementation
+    :type polling: bool
+    :return: Acquisitions per second, memcache requests per acquisition, maximum wait time
+    :rtype: tuple
+    """
+    results = Queue()
+    workers = [Process(target=_run_process, args=(address, threads, acquisitions, polling, results)) for _ in xrange(processes)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    requests = 0
+    waits = []
+    for _ in workers:
+        process_requests, process_waits = results.get()
+        requests += process_requests
+        waits += process_waits
+    duration = time.time() - start
+    for worker in workers:
+        worker.join()
+    return len(waits) / duration, requests / float(len(waits)), max(waits)
+
+
+if __name__ == '__main__':
+    _server = None
+    if len(sys.argv) > 1:
+        _address = sys.argv[1]
+    else:
+        _queue = Queue()
+        _server = Process(target=_serve, args=(_queue,))
+        _server.daemon = True
+        _server.start()
+        _address = _queue.get()
+    for _processes, _threads in [(1, 1), (1, 32), (4, 8), (8, 8)]:
+        for _polling in [True, False]:
+            _rate, _requests, _max_wait = run(_address, _processes, _threads, polling=_polling)
+            print '{0} processes x {1:>2} threads  {2:<8}: {3:>7.0f} acquisitions/s  {4:>6.1f} requests/acquisition  max wait {5:.3f} s'.format(
+                _processes, _threads, 'polling' if _polling is True else 'backoff', _rate, _requests, _max_wait)
+    if _server is not None:
+        _server.terminate()
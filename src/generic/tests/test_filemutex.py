@@ -0,0 +1,186 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Test module for the file mutex
+"""
+import os
+import gc
+import time
+import fcntl
+import shutil
+import resource
+import tempfile
+import unittest
+from threading import Thread
+from ovs_extensions.generic.filemutex import NoLockAvailableException, _Notification, file_mutex
+
+
+class FileMutexTest(unittest.TestCase):
+    """
+    Test the file mutex
+    """
+
+    def setUp(self):
+        """
+        Creates a folder for the lock files
+        """
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'lock')
+
+    def tearDown(self):
+        """
+        Removes the lock files
+        """
+        gc.collect()
+        shutil.rmtree(self.folder)
+
+    def _lock_elsewhere(self):
+        """
+        Locks the file through another open file, as another process would
+        """
+        handle = open(self.path, 'w')
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def test_shared_lock(self):
+        """
+        Validates that mutexes with the same name share their lock file and that the owning thread can reacquire it
+        """
+        mutexes = [file_mutex(self.path) for _ in xrange(10)]
+        self.assertEqual(len(set(id(mutex._lock) for mutex in mutexes)), 1)
+        self.assertEqual(file_mutex._locks[self.path].users, 10)
+
+        mutexes[0].acquire()
+        mutexes[1].acquire(wait=0)  # Reentrant within the same thread
+        errors = []
+
+        def _acquire():
+            try:
+                file_mutex(self.path).acquire(wait=0.1)
+            except NoLockAvailableException:
+                errors.append(True)
+
+        thread = Thread(target=_acquire)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [True])
+        mutexes[0].release()
+        thread = Thread(target=_acquire)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [True, True])  # Still held by the second acquisition
+        mutexes[1].release()
+        other = self._lock_elsewhere()  # The file is unlocked when all acquisitions are released
+        other.close()
+
+        del mutexes
+        gc.collect()
+        self.assertNotIn(self.path, file_mutex._locks)
+
+    def test_fair_ordering(self):
+        """
+        Validates that threads get the mutex in order of arrival
+        """
+        order = []
+        mutex = file_mutex(self.path)
+        mutex.acquire()
+
+        def _run(thread_id):
+            with file_mutex(self.path, wait=5):
+                order.append(thread_id)
+
+        threads = []
+        for thread_id in xrange(10):
+            thread = Thread(target=_run, args=(thread_id,))
+            thread.start()
+            threads.append(thread)
+            for _ in xrange(500):
+                if len(mutex._lock._waiters) == thread_id + 1:
+                    break
+                time.sleep(0.01)
+        mutex.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, range(10))
+
+    def test_timed_wait(self):
+        """
+        Validates that a timed wait sleeps until the lock is released and gives up the lock file when it times out
+        """
+        other = self._lock_elsewhere()
+        mutex = file_mutex(self.path)
+        cpu_start = sum(os.times()[:2])
+        start = time.time()
+        with self.assertRaises(NoLockAvailableException):
+            mutex.acquire(wait=0.5)
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertLess(sum(os.times()[:2]) - cpu_start, 0.1)
+        with self.assertRaises(NoLockAvailableException):
+            mutex.acquire(wait=0)
+
+        released = []
+
+        def _release():
+            time.sleep(0.2)
+            released.append(time.time())
+            other.close()
+
+        thread = Thread(target=_release)
+        thread.start()
+        mutex.acquire(wait=5)
+        self.assertLess(time.time() - released[0], 0.05)  # Handed over immediately
+        thread.join()
+        mutex.release()
+
+        other = self._lock_elsewhere()  # A timed out wait doesn't keep the file locked
+        mutex_thread = Thread(target=self.assertRaises, args=(NoLockAvailableException, mutex.acquire, 0.1))
+        mutex_thread.start()
+        mutex_thread.join()
+        other.close()
+        for _ in xrange(100):
+            if mutex._lock._flock_pending is False:
+                break
+            time.sleep(0.01)
+        other = open(self.path, 'w')
+        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        other.close()
+
+    def test_high_file_descriptors(self):
+        """
+        Validates that waiting works for file descriptors which do not fit in a select set
+        """
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard_limit != resource.RLIM_INFINITY and hard_limit < 1100:
+            self.skipTest('Not enough file descriptors available')
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft_limit, 1100), hard_limit))
+        handles = []
+        try:
+            while len(handles) == 0 or handles[-1] < 1024:
+                handles.append(os.open(os.devnull, os.O_RDONLY))
+            notification = _Notification()
+            try:
+                self.assertGreaterEqual(notification._read, 1024)
+                self.assertFalse(notification.wait(0.01))
+                notification.send()
+                self.assertTrue(notification.wait(0.01))
+            finally:
+                notification.close()
+        finally:
+            for handle in handles:
+                os.close(handle)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft_limit, hard_limit))
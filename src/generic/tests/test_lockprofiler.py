@@ -0,0 +1,132 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Test module for the lock profiler
+"""
+import os
+import gc
+import time
+import shutil
+import tempfile
+import unittest
+from threading import Event, RLock, Thread
+from ovs_extensions.generic.filemutex import NoLockAvailableException, file_mutex
+from ovs_extensions.generic.lockprofiler import LockProfiler, ProfiledLock
+from ovs_extensions.generic.tests.test_volatilemutex import _volatile_mutex
+from ovs_extensions.storage.volatile.dummystore import DummyVolatileStore
+
+
+class LockProfilerTest(unittest.TestCase):
+    """
+    Test the lock profiler
+    """
+
+    def setUp(self):
+        """
+        Enables the profiler
+        """
+        LockProfiler.reset()
+        LockProfiler.enable()
+
+    def tearDown(self):
+        """
+        Disables the profiler
+        """
+        LockProfiler.disable()
+        LockProfiler.reset()
+
+    @staticmethod
+    def _hold(lock, acquired, duration):
+        """
+        Holds a lock for a given duration in another thread
+        """
+        def _run():
+            with lock:
+                acquired.set()
+                time.sleep(duration)
+
+        thread = Thread(target=_run)
+        thread.start()
+        acquired.wait()
+        return thread
+
+    def _wait_for_lock(self, lock):
+        """
+        Acquires the lock while it is held elsewhere. Separate method so it shows up as call site
+        """
+        with lock:
+            pass
+
+    def test_profiled_lock(self):
+        """
+        Validates the statistics of a profiled thread lock
+        """
+        lock = ProfiledLock(RLock(), 'test')
+        with lock:
+            with lock:  # Reentrant acquisitions are not counted separately
+                pass
+        thread = self._hold(lock, Event(), 0.1)
+        self._wait_for_lock(lock)
+        thread.join()
+
+        report = LockProfiler.get_report('test')
+        self.assertEqual((report['acquisitions'], report['contended'], report['timeouts']), (3, 1, 0))
+        self.assertEqual(report['hold']['count'], 3)
+        self.assertGreaterEqual(report['hold']['max'], 0.1)
+        self.assertGreaterEqual(report['wait']['max'], 0.05)
+        self.assertEqual(sum(count for _, count in report['wait']['histogram']), 3)
+        self.assertEqual([count for bound, count in report['hold']['histogram'] if bound == 0.5], [1])
+        self.assertEqual(len(report['call_sites']), 1)
+        self.assertIn('(_wait_for_lock)', report['call_sites'][0]['call_site'].split(' <- ')[0])
+        self.assertIn('test_profiled_lock', report['call_sites'][0]['call_site'])
+
+        LockProfiler.disable()
+        with lock:
+            pass
+        self.assertEqual(LockProfiler.get_report('test')['acquisitions'], 3)  # Nothing is recorded while disabled
+        self.assertIn('test: 3 acquisitions, 1 contended, 0 timeouts', LockProfiler.format_report())
+
+    def test_mutexes(self):
+        """
+        Validates that the mutexes report to the profiler
+        """
+        DummyVolatileStore()._clean()
+        thread = self._hold(_volatile_mutex('profiled'), Event(), 0.1)
+        self._wait_for_lock(_volatile_mutex('profiled'))
+        thread.join()
+        report = LockProfiler.get_report('volatile_mutex:profiled')
+        self.assertEqual((report['acquisitions'], report['contended'], report['hold']['count']), (2, 1, 2))
+        self.assertIn('(_wait_for_lock)', report['call_sites'][0]['call_site'].split(' <- ')[0])
+
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'lock')
+            thread = self._hold(file_mutex(path), Event(), 0.1)
+            self._wait_for_lock(file_mutex(path, wait=5))
+            thread.join()
+            thread = self._hold(file_mutex(path), Event(), 0.1)
+            with self.assertRaises(NoLockAvailableException):
+                file_mutex(path).acquire(wait=0.01)
+            thread.join()
+            gc.collect()
+        finally:
+            shutil.rmtree(folder)
+        report = LockProfiler.get_report('file_mutex:{0}'.format(path))
+        self.assertEqual((report['acquisitions'], report['contended'], report['timeouts']), (3, 2, 1))
+        self.assertGreaterEqual(report['wait']['max'], 0.05)
+        self.assertIn('(_wait_for_lock)', report['call_sites'][0]['call_site'].split(' <- ')[0])
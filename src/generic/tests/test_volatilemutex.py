@@ -0,0 +1,144 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Test module for the volatile mutex
+"""
+import time
+import unittest
+from threading import Thread
+from ovs_extensions.generic.volatilemutex import NoLockAvailableException, volatile_mutex
+from ovs_extensions.storage.volatile.dummystore import DummyVolatileStore
+
+
+class _volatile_mutex(volatile_mutex):
+    """
+    Volatile mutex using the dummy volatile store
+    """
+    _logger = None
+
+    @classmethod
+    def _get_volatile_client(cls):
+        return DummyVolatileStore()
+
+
+class VolatileMutexTest(unittest.TestCase):
+    """
+    Test the volatile mutex
+    """
+
+    def setUp(self):
+        """
+        Clears the volatile store and the metrics
+        """
+        DummyVolatileStore()._clean()
+        volatile_mutex.reset_metrics()
+
+    def _wait_for_waiters(self, key, amount):
+        """
+        Waits until the given amount of threads is waiting in the local queue
+        """
+        for _ in xrange(500):
+            queue = volatile_mutex._queues.get(key)
+            if queue is not None and queue.waiting == amount:
+                return
+            time.sleep(0.01)
+        self.fail('Threads are not waiting')
+
+    def test_fair_ordering(self):
+        """
+        Validates that threads of the same process get the lock in order of arrival and without polling the store
+        """
+        order = []
+        mutex = _volatile_mutex('fair')
+        mutex.acquire()
+
+        def _run(thread_id):
+            with _volatile_mutex('fair'):
+                order.append(thread_id)
+
+        threads = []
+        for thread_id in xrange(10):
+            thread = Thread(target=_run, args=(thread_id,))
+            thread.start()
+            threads.append(thread)
+            self._wait_for_waiters(mutex.key(), thread_id + 1)
+        mutex.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, range(10))
+        metrics = volatile_mutex.get_metrics('fair')
+        self.assertEqual(metrics['acquisitions'], 11)
+        self.assertEqual(metrics['attempts'], 11)  # The lock is handed over locally, the store is claimed only once per acquisition
+        self.assertEqual(metrics['contended'], 10)
+        self.assertEqual(volatile_mutex._queues, {})
+
+    def test_backoff(self):
+        """
+        Validates that a lock held by another process is polled with backoff and that timeouts clean up
+        """
+        mutex = _volatile_mutex('backoff')
+        DummyVolatileStore().add(mutex.key(), 1)  # Another process holds the lock
+        errors = []
+
+        def _run():
+            try:
+                _volatile_mutex('backoff').acquire(wait=0.5)
+            except NoLockAvailableException:
+                errors.append(time.time() - start)
+
+        start = time.time()
+        threads = [Thread(target=_run) for _ in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 5)
+        self.assertLess(max(errors), 1)
+        metrics = volatile_mutex.get_metrics('backoff')
+        self.assertEqual(metrics['timeouts'], 5)
+        self.assertLess(metrics['attempts'], 25)  # Polling every 5 ms from every thread would be 500 attempts
+        self.assertEqual(volatile_mutex._queues, {})
+
+        with self.assertRaises(NoLockAvailableException):
+            mutex.acquire(wait=0)
+        DummyVolatileStore().delete(mutex.key())
+        with mutex:
+            time.sleep(0.01)
+        metrics = volatile_mutex.get_metrics('backoff')
+        self.assertEqual(metrics['acquisitions'], 1)
+        self.assertGreaterEqual(metrics['max_hold_time'], 0.01)
+
+    def test_release_error(self):
+        """
+        Validates that local waiters are released when the lock key could not be removed from the store
+        """
+        mutex = _volatile_mutex('releaseerror')
+        mutex.acquire()
+
+        def _delete(key):
+            raise RuntimeError('Store unavailable: {0}'.format(key))
+
+        mutex._volatile.delete = _delete
+        with self.assertRaises(RuntimeError):
+            mutex.release()
+        self.assertFalse(mutex._has_lock)
+        self.assertIsNone(mutex._queue)
+        self.assertEqual(volatile_mutex._queues, {})
+        DummyVolatileStore().delete(mutex.key())  # The lock key expires in the store
+        with _volatile_mutex('releaseerror')(wait=1):
+            pass
@@ -19,7 +19,11 @@ Volatile mutex module
 """
 
 import time
+import random
 import logging
+from collections import deque
+from threading import Event, Lock
+from ovs_extensions.generic.lockprofiler import LockProfiler
 
 
 class NoLockAvailableException(Exception):
@@ -29,14 +33,80 @@ class NoLockAvailableException(Exception):
     pass
 
 
+class _LocalQueue(object):
+    """
+    First-in, first-out lock shared by all threads of the process waiting for the same volatile mutex
+    Only the thread at the head of the queue polls the volatile store, the others wait on an Event which is set
+    when the lock is handed over to them.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._waiters = deque()
+        self._locked = False
+        self.users = 0  # Amount of mutexes using this queue, maintained by volatile_mutex
+
+    def acquire(self, timeout=None):
+        """
+        Acquires the local lock, waiting at most `timeout` seconds
+        :param timeout: Maximum amount of seconds to wait. None to wait forever
+        :type timeout: float
+        :return: Whether the lock was acquired
+        :rtype: bool
+        """
+        with self._lock:
+            if self._locked is False and len(self._waiters) == 0:
+                self._locked = True
+                return True
+            if timeout is not None and timeout <= 0:
+                return False
+            event = Event()
+            self._waiters.append(event)
+        event.wait(timeout)
+        with self._lock:
+            if event.is_set():  # The lock was handed over, possibly just after the timeout expired
+                return True
+            self._waiters.remove(event)
+            return False
+
+    def release(self):
+        """
+        Releases the local lock, handing it over to the longest waiting thread
+        :return: None
+        """
+        with self._lock:
+            if len(self._waiters) > 0:
+                self._waiters.popleft().set()
+            else:
+                self._locked = False
+
+    @property
+    def waiting(self):
+        """
+        Amount of threads waiting for the lock
+        """
+        return len(self._waiters)
+
+
 class volatile_mutex(object):
     """
     This is a volatile, distributed mutex to provide cross thread, cross process and cross node
     locking. However, this mutex is volatile and thus can fail. You want to make sure you don't
     lock for longer than a few hundred milliseconds to prevent this.
+    * Threads of the same process first queue up locally, in order of arrival. Only the first thread in that queue
+      tries to claim the key in the volatile store
+    * Claiming the key is retried with an exponential backoff with jitter, bounded by MAX_BACKOFF
     """
 
+    INITIAL_BACKOFF = 0.001
+    MAX_BACKOFF = 0.05
+    LOCK_EXPIRATION = 60
+
     _logger = logging.getLogger(__name__)  # Overruled by classes inheriting
+    _queues = {}
+    _queues_lock = Lock()
+    _metrics = {}
+    _metrics_lock = Lock()
 
     def __init__(self, name, wait=None):
         """
@@ -46,6 +116,7 @@ class volatile_mutex(object):
         self._wait = wait
         self._start = 0
         self._has_lock = False
+        self._queue = None
         self._volatile = self._get_volatile_client()
 
     def __call__(self, wait):
@@ -70,18 +141,38 @@ class volatile_mutex(object):
         self._start = time.time()
         if wait is None:
             wait = self._wait
-        while not self._volatile.add(self.key(), 1, 60):
-            time.sleep(0.005)
-            passed = time.time() - self._start
-            if wait is not None and passed > wait:
-                if self._logger is not None:
-                    self._logger.error('Lock for {0} could not be acquired. {1} sec > {2} sec'.format(self.key(), passed, wait))
-                raise NoLockAvailableException('Could not acquire lock {0}'.format(self.key()))
+        key = self.key()
+        queue = self._get_queue(key)
+        contended = False
+        if not queue.acquire(0):
+            contended = True
+            if not queue.acquire(wait):
+                self._put_queue(key, queue)
+                self._fail(wait, attempts=0)
+        attempts = 1
+        delay = volatile_mutex.INITIAL_BACKOFF
+        try:
+            while not self._volatile.add(key, 1, volatile_mutex.LOCK_EXPIRATION):
+                passed = time.time() - self._start
+                if wait is not None and passed > wait:
+                    self._fail(wait, attempts=attempts)
+                delay_with_jitter = delay / 2 + random.uniform(0, delay / 2)
+                if wait is not None:
+                    delay_with_jitter = min(delay_with_jitter, wait - passed)
+                time.sleep(delay_with_jitter)
+                delay = min(delay * 2, volatile_mutex.MAX_BACKOFF)
+                attempts += 1
+        except Exception:
+            queue.release()
+            self._put_queue(key, queue)
+            raise
         passed = time.time() - self._start
         if passed > 0.2:  # More than 200 ms is a long time to wait
             if self._logger is not None:
-                self._logger.warning('Waited {0} sec for lock {1}'.format(passed, self.key()))
+                self._logger.warning('Waited {0} sec for lock {1}'.format(passed, key))
+        self._record(self.name, wait_time=passed, attempts=attempts, contended=contended or attempts > 1)
         self._start = time.time()
+        self._queue = queue
         self._has_lock = True
         return True
 
@@ -90,12 +181,22 @@ class volatile_mutex(object):
         Releases the lock
         """
         if self._has_lock:
-            self._volatile.delete(self.key())
-            passed = time.time() - self._start
+            key = self.key()
+            try:
+                self._volatile.delete(key)
+            finally:
+                # The local waiters must be released even when the lock key could not be removed (it expires anyway)
+                passed = time.time() - self._start
+                self._has_lock = False
+                self._queue.release()
+                self._put_queue(key, self._queue)
+                self._queue = None
+            self._record(self.name, hold_time=passed)
+            if LockProfiler.enabled is True:
+                LockProfiler.record_release('volatile_mutex:{0}'.format(self.name), passed)
             if passed > 0.5:  # More than 500 ms is a long time to hold a lock
                 if self._logger is not None:
-                    self._logger.warning('A lock on {0} was kept for {1} sec'.format(self.key(), passed))
-            self._has_lock = False
+                    self._logger.warning('A lock on {0} was kept for {1} sec'.format(key, passed))
 
     def key(self):
         """
@@ -103,6 +204,91 @@ class volatile_mutex(object):
         """
         return 'ovs_lock_%s' % self.name
 
+    def _fail(self, wait, attempts):
+        """
+        Registers and raises a failed acquisition
+        """
+        key = self.key()
+        passed = time.time() - self._start
+        self._record(self.name, wait_time=passed, attempts=attempts, contended=True, timeout=True)
+        if self._logger is not None:
+            self._logger.error('Lock for {0} could not be acquired. {1} sec > {2} sec'.format(key, passed, wait))
+        raise NoLockAvailableException('Could not acquire lock {0}'.format(key))
+
+    @classmethod
+    def _get_queue(cls, key):
+        """
+        Returns the local queue for a given key, registering its use
+        """
+        with volatile_mutex._queues_lock:
+            queue = volatile_mutex._queues.get(key)
+            if queue is None:
+                queue = _LocalQueue()
+                volatile_mutex._queues[key] = queue
+            queue.users += 1
+            return queue
+
+    @classmethod
+    def _put_queue(cls, key, queue):
+        """
+        Unregisters the use of a local queue, removing it when no longer used
+        """
+        with volatile_mutex._queues_lock:
+            queue.users -= 1
+            if queue.users == 0:
+                volatile_mutex._queues.pop(key, None)
+
+    @classmethod
+    def _record(cls, name, wait_time=None, attempts=0, hold_time=None, contended=False, timeout=False):
+        """
+        Adds an acquisition or release to the contention metrics
+        """
+        if wait_time is not None and LockProfiler.enabled is True:
+            LockProfiler.record_acquire('volatile_mutex:{0}'.format(name), wait_time, contended=contended, timeout=timeout)
+        with volatile_mutex._metrics_lock:
+            metrics = volatile_mutex._metrics.get(name)
+            if metrics is None:
+                metrics = {'acquisitions': 0, 'contended': 0, 'timeouts': 0, 'attempts': 0,
+                           'wait_time': 0.0, 'max_wait_time': 0.0, 'hold_time': 0.0, 'max_hold_time': 0.0}
+                volatile_mutex._metrics[name] = metrics
+            metrics['attempts'] += attempts
+            if wait_time is not None:
+                if timeout is True:
+                    metrics['timeouts'] += 1
+                else:
+                    metrics['acquisitions'] += 1
+                if contended is True:
+                    metrics['contended'] += 1
+                metrics['wait_time'] += wait_time
+                metrics['max_wait_time'] = max(metrics['max_wait_time'], wait_time)
+            if hold_time is not None:
+                metrics['hold_time'] += hold_time
+                metrics['max_hold_time'] = max(metrics['max_hold_time'], hold_time)
+
+    @classmethod
+    def get_metrics(cls, name=None):
+        """
+        Returns the contention metrics of this process
+        :param name: Name of the mutex. None to return the metrics of all mutexes
+        :type name: str
+        :return: Per mutex name: the amount of acquisitions, contended acquisitions (which had to wait), timeouts and
+                 attempts to claim the key in the volatile store, the total and maximum wait and hold times
+        :rtype: dict
+        """
+        with volatile_mutex._metrics_lock:
+            metrics = dict((key, value.copy()) for key, value in volatile_mutex._metrics.iteritems())
+        if name is not None:
+            return metrics.get(name)
+        return metrics
+
+    @classmethod
+    def reset_metrics(cls):
+        """
+        Clears the contention metrics
+        """
+        with volatile_mutex._metrics_lock:
+            volatile_mutex._metrics = {}
+
     def __del__(self):
         """
         __del__ hook, releasing the lock
@@ -112,3 +298,6 @@ class volatile_mutex(object):
     @classmethod
     def _get_volatile_client(cls):
         raise NotImplementedError()
+
+
+LockProfiler.register_internal_file(__file__)
@@ -0,0 +1,167 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Helpers for the dummy stores
+"""
+import os
+import copy
+import json
+import uuid
+
+_IMMUTABLE_TYPES = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+
+def copy_value(value):
+    """
+    Copies a value, only copying what can be changed: strings, numbers, booleans and None are returned as is and dicts
+    and lists are copied without the overhead of copy.deepcopy. Other types are deep copied.
+    As the stores never change the values they keep, copies only need to be made when values enter or leave the store.
+    :param value: The value to copy
+    :type value: any
+    :return: The copy
+    :rtype: any
+    """
+    value_type = type(value)
+    if value_type in _IMMUTABLE_TYPES:
+        return value
+    if value_type is dict:
+        return dict((key, item if type(item) in _IMMUTABLE_TYPES else copy_value(item)) for key, item in value.iteritems())
+    if value_type is list:
+        return [item if type(item) in _IMMUTABLE_TYPES else copy_value(item) for item in value]
+    return copy.deepcopy(value)
+
+
+class AppendOnlyLog(object):
+    """
+    File of JSON records, one per line. Changes are appended, so a reader only parses what was added since its last read.
+    The log is compacted by atomically replacing the file, which makes readers in other processes reload it.
+    Every file starts with a unique header record, as a replacing file can get the inode of the file it replaces.
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        """
+        Initializes an AppendOnlyLog
+        :param path: Path of the file
+        :type path: str
+        """
+        self.path = path
+        self.records = 0  # Approximate amount of records in the file
+        self._header = None
+        self._offset = 0
+
+    @staticmethod
+    def _new_header():
+        # type: () -> str
+        """
+        Returns a unique header line
+        :return: The header line
+        :rtype: str
+        """
+        return '{0}\n'.format(json.dumps({'log': str(uuid.uuid4())}))
+
+    def _reset(self, header=None, offset=0, records=0):
+        # type: (Optional[str], int, int) -> None
+        """
+        Resets the state of the reader
+        :param header: Header line of the file being read
+        :type header: str
+        :param offset: Offset up to which the file was read
+        :type offset: int
+        :param records: Amount of records read
+        :type records: int
+        :return: None
+        """
+        self._header = header
+        self._offset = offset
+        self.records = records
+
+    def read(self):
+        # type: () -> Tuple[bool, List[dict]]
+        """
+        Reads the records added since the last read
+        :return: Whether the file was replaced or removed (the records then are the full content) and the records
+        :rtype: tuple
+        """
+        try:
+            with open(self.path, 'r') as log_file:
+                header = log_file.readline()
+                if not header.endswith('\n'):  # Being created
+                    header = None
+                reset = header != self._header
+                if reset is False:
+                    log_file.seek(0, os.SEEK_END)
+                    reset = log_file.tell() < self._offset  # Truncated
+                if reset is True:
+                    self._reset(header=header, offset=len(header or ''))
+                log_file.seek(self._offset)
+                content = log_file.read() if header is not None else ''
+        except IOError:
+            reset = self._header is not None
+            self._reset()
+            return reset, []
+        end = content.rfind('\n') + 1  # A record which is being appended is read next time
+        self._offset += end
+        records = [record for record in (json.loads(line) for line in content[:end].splitlines()) if 'log' not in record]
+        if reset is True:
+            self.records = len(records)
+        return reset, records
+
+    def append(self, records):
+        # type: (List[dict]) -> None
+        """
+        Appends records. They are returned by the next read as well
+        :param records: Records to append
+        :type records: list
+        :return: None
+        """
+        data = ''.join('{0}\n'.format(json.dumps(record, sort_keys=True)) for record in records)
+        with open(self.path, 'a') as log_file:
+            log_file.seek(0, os.SEEK_END)
+            if log_file.tell() == 0:
+                data = self._new_header() + data
+            log_file.write(data)
+        self.records += len(records)
+
+    def rewrite(self, records):
+        # type: (List[dict]) -> None
+        """
+        Replaces the content of the file by the given records
+        :param records: Records to write
+        :type records: list
+        :return: None
+        """
+        header = self._new_header()
+        data = header + ''.join('{0}\n'.format(json.dumps(record, sort_keys=True)) for record in records)
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as log_file:
+            log_file.write(data)
+        os.rename(temp_path, self.path)
+        self._reset(header=header, offset=len(data), records=len(records))
+
+    def remove(self):
+        # type: () -> None
+        """
+        Removes the file
+        :return: None
+        """
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self._reset()
@@ -14,21 +14,25 @@
 # Open vStorage is distributed in the hope that it will be useful,
 # but WITHOUT ANY WARRANTY of any kind.
 
+
 """
 Dummy persistent module
 """
-import os
-import copy
 import json
 import time
 import uuid
 import random
+from bisect import bisect_left
 from threading import RLock
 from functools import wraps
 from ovs_extensions.generic.filemutex import file_mutex
+from ovs_extensions.storage.dummyhelpers import AppendOnlyLog, copy_value
 from ovs_extensions.storage.exceptions import KeyNotFoundException, AssertException
+from ovs_extensions.storage.persistent.expiry import Expiry
 from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.compat import ArakoonAssertionFailed, ArakoonNotFound
 
+_MISSING = object()
+
 
 def synchronize():
     """
@@ -53,11 +57,16 @@ class DummyPersistentStore(object):
     """
     This is a dummy persistent store that makes use of a local json file or memory
     When operating in memory mode: all functions that make use of _read() are already modifying the DB.
-    This is intended but can lead to consistency problems (copy.deepcopy of the read is slow!)
+    Values are copied when entering and leaving the store and are never changed in place, so they can be shared by snapshots
+    Keys are kept in a sorted index to answer prefix queries in O(log n + k), returning the keys in order like Arakoon
+    When operating in file mode, changes are appended to the file which is compacted once it grows too large
+    Keys can expire after a TTL, like in the PyrakoonStore (see Expiry)
     Can be used to substitute both PyrakoonStore and PyrakoonClient
     (this implementation does not enforce the JSON serialization like PyrakoonStore and implements all methods from PyrakoonClient)
     Note: when mimicking PyrakoonClient instead of store, set mimick_pyrakoonclient = True in the init so the same exceptions would be
     """
+    COMPACTION_MINIMUM = 1000  # Minimum amount of records in the file before compacting it
+
     def __init__(self, mimick_pyrakoonclient=False):
         self._data = {}
         self.id = str(uuid.uuid4())
@@ -66,6 +75,11 @@ class DummyPersistentStore(object):
         self._keep_in_memory_only = True
         self._lock = RLock()
         self.mimick_pyrakoonclient = mimick_pyrakoonclient
+        self._keys = []  # Sorted keys of the indexed data
+        self._indexed = None  # Data which the keys belong to
+        self._undo = None  # Previous values of the keys changed by the transaction being applied
+        self._pending = None  # Records to write once the transaction being applied succeeded
+        self._log = None
 
     @property
     def key_not_found_exception(self):
@@ -90,28 +104,102 @@ class DummyPersistentStore(object):
         """
         Empties the store
         """
-        if self._keep_in_memory_only is True:
-            self._data = {}
-        else:
-            try:
-                os.remove(self._path)
-            except OSError:
-                pass
+        self._data = {}
+        if self._keep_in_memory_only is False:
+            self._get_log().remove()
 
     @synchronize()
     def _read(self):
         """
         Reads the local json file
         """
-        if self._keep_in_memory_only is True:
+        if self._keep_in_memory_only is True or self._undo is not None:
             return self._data
-        try:
-            f = open(self._path, 'r')
-            data = json.loads(f.read())
-            f.close()
-        except IOError:
-            data = {}
-        return data
+        reset, records = self._get_log().read()
+        if reset is True:
+            self._data = {}
+        for record in records:
+            key = record['k']
+            if 'v' in record:
+                self._data[key] = record['v']
+            else:
+                self._data.pop(key, None)
+        if reset is False:
+            self._update_index(record['k'] for record in records)
+        return self._data
+
+    def _get_log(self):
+        # type: () -> AppendOnlyLog
+        """
+        Returns the log of the local json file
+        :return: The log
+        :rtype: AppendOnlyLog
+        """
+        if self._log is None or self._log.path != self._path:
+            self._log = AppendOnlyLog(self._path)
+        return self._log
+
+    def _get_keys(self):
+        # type: () -> List[str]
+        """
+        Returns the sorted keys. The index is rebuilt when the data was replaced or changed without updating the index
+        :return: The sorted keys
+        :rtype: list
+        """
+        if self._indexed is not self._data or len(self._keys) != len(self._data):
+            self._keys = sorted(self._data)
+            self._indexed = self._data
+        return self._keys
+
+    def _update_index(self, keys):
+        # type: (Iterable[str]) -> None
+        """
+        Updates the sorted keys for the given changed keys
+        :param keys: The changed keys
+        :type keys: iterable
+        :return: None
+        """
+        if self._indexed is not self._data:
+            return  # Rebuilt when needed
+        for key in keys:
+            index = bisect_left(self._keys, key)
+            found = index < len(self._keys) and self._keys[index] == key
+            if key in self._data:
+                if found is False:
+                    self._keys.insert(index, key)
+            elif found is True:
+                del self._keys[index]
+
+    def _prefix_keys(self, prefix):
+        # type: (str) -> List[str]
+        """
+        Lists all keys starting with the given prefix, in order
+        :param prefix: The prefix
+        :type prefix: str
+        :return: The keys
+        :rtype: list
+        """
+        keys = self._get_keys()
+        index = bisect_left(keys, prefix)
+        result = []
+        while index < len(keys):
+            key = keys[index]
+            if not isinstance(key, basestring) or not key.startswith(prefix):
+                break
+            result.append(key)
+            index += 1
+        return result
+
+    def _remember(self, key):
+        # type: (str) -> None
+        """
+        Remembers the current value of a key when a transaction is being applied, to be able to roll it back
+        :param key: The key which will be changed
+        :type key: str
+        :return: None
+        """
+        if self._undo is not None and key not in self._undo:
+            self._undo[key] = self._data.get(key, _MISSING)
 
     @synchronize()
     def get(self, key):
@@ -120,9 +208,10 @@ class DummyPersistentStore(object):
         """
         data = self._read()
         if key in data:
-            return copy.deepcopy(data[key])
-        else:
-            raise self.key_not_found_exception(key)
+            value, expired = Expiry.unwrap(data[key])
+            if expired is False:
+                return copy_value(value)
+        raise self.key_not_found_exception(key)
 
     @synchronize()
     def get_multi(self, keys, must_exist=True):
@@ -130,9 +219,11 @@ class DummyPersistentStore(object):
         Retrieves values for all given keys
         """
         data = self._read()
+        now = time.time()
         for key in keys:
-            if key in data:
-                yield copy.deepcopy(data[key])
+            value, expired = Expiry.unwrap(data[key], now) if key in data else (None, True)
+            if expired is False:
+                yield copy_value(value)
             elif must_exist is True:
                 raise self.key_not_found_exception(key)
             else:
@@ -143,8 +234,8 @@ class DummyPersistentStore(object):
         """
         Lists all keys starting with the given prefix
         """
-        data = self._read()
-        return [k for k in data.keys() if k.startswith(key)]
+        self._read()
+        return self._prefix_keys(key)
 
     @synchronize()
     def prefix_entries(self, key):
@@ -152,18 +243,29 @@ class DummyPersistentStore(object):
         Returns all key-values starting with the given prefix
         """
         data = self._read()
-        return [(k, copy.deepcopy(v)) for k, v in data.iteritems() if k.startswith(key)]
+        now = time.time()
+        entries = []
+        for k in self._prefix_keys(key):
+            value, expired = Expiry.unwrap(data[k], now)
+            if expired is False:
+                entries.append((k, copy_value(value)))
+        return entries
 
     @synchronize()
-    def set(self, key, value, transaction=None):
+    def set(self, key, value, transaction=None, ttl=None):
         """
         Sets the value for a key to a given value
+        :param ttl: Amount of seconds after which the key expires. Never expires when omitted
+        :type ttl: float
         """
+        if ttl is not None:
+            value = Expiry.wrap(value, ttl)
         if transaction is not None:
-            return self._sequences[transaction].append([self.set, {'key': key, 'value': copy.deepcopy(value)}])
+            return self._sequences[transaction].append([self.set, {'key': key, 'value': copy_value(value)}])
         data = self._read()
-        data[key] = copy.deepcopy(value)
-        self._save(data)
+        self._remember(key)
+        data[key] = copy_value(value)
+        self._save(data, [key])
 
     @synchronize()
     def delete(self, key, must_exist=True, transaction=None):
@@ -174,8 +276,9 @@ class DummyPersistentStore(object):
             return self._sequences[transaction].append([self.delete, {'key': key, 'must_exist': must_exist}])
         data = self._read()
         if key in data:
+            self._remember(key)
             del data[key]
-            self._save(data)
+            self._save(data, [key])
         elif must_exist is True:
             raise self.key_not_found_exception(key)
 
@@ -187,36 +290,36 @@ class DummyPersistentStore(object):
         if transaction is not None:
             return self._sequences[transaction].append([self.delete_prefix, {'prefix': prefix}])
         data = self._read()
-        keys_to_delete = [k for k in data if isinstance(k, str) and k.startswith(prefix)]
+        keys_to_delete = self._prefix_keys(prefix)
         for key in keys_to_delete:
+            self._remember(key)
             del data[key]
         if len(keys_to_delete) > 0:
-            self._save(data)
+            self._save(data, keys_to_delete)
+        return len(keys_to_delete)
 
     @synchronize()
-    def delete_prefix(self, prefix, transaction=None):
+    def exists(self, key):
         """
-        Deletes all keys which start with the given prefix
+        Check if key exists
         """
-        if transaction is not None:
-            return self._sequences[transaction].append([self.delete_prefix, {'prefix': prefix}])
         data = self._read()
-        keys_to_delete = [k for k in data if isinstance(k, str) and k.startswith(prefix)]
-        for key in keys_to_delete:
-            del data[key]
-        if len(keys_to_delete) > 0:
-            self._save(data)
+        return key in data and Expiry.unwrap(data[key])[1] is False
 
     @synchronize()
-    def exists(self, key):
+    def reap(self, prefix):
         """
-        Check if key exists
+        Removes the expired keys starting with the given prefix
+        :return: Amount of keys removed
         """
-        try:
-            self.get(key)
-            return True
-        except self.key_not_found_exception:
-            return False
+        data = self._read()
+        now = time.time()
+        expired = [key for key in self._prefix_keys(prefix) if Expiry.unwrap(data[key], now)[1] is True]
+        for key in expired:
+            del data[key]
+        if len(expired) > 0:
+            self._save(data, expired)
+        return len(expired)
 
     @synchronize()
     def nop(self):
@@ -232,7 +335,7 @@ class DummyPersistentStore(object):
         Asserts a key-value pair
         """
         if transaction is not None:
-            return self._sequences[transaction].append([self.assert_value, {'key': key, 'value': copy.deepcopy(value)}])
+            return self._sequences[transaction].append([self.assert_value, {'key': key, 'value': copy_value(value)}])
         data = self._read()
         if value is None:
             if key in data:
@@ -266,26 +369,73 @@ class DummyPersistentStore(object):
     def apply_transaction(self, transaction):
         """
         Applies a transaction
+        Only the previous values of the changed keys are kept to roll back. In file mode, the changes are written at once
         """
-        begin_data = copy.deepcopy(self._read())  # Safer to copy than to reverse all actions
-        for item in self._sequences[transaction]:
-            try:
+        self._read()
+        self._undo = {}
+        self._pending = [] if self._keep_in_memory_only is False else None
+        try:
+            for item in self._sequences[transaction]:
                 item[0](**item[1])
-            except Exception:
-                self._save(begin_data)
-                raise
+        except Exception:
+            for key, value in self._undo.iteritems():
+                if value is _MISSING:
+                    self._data.pop(key, None)
+                else:
+                    self._data[key] = value
+            self._update_index(self._undo.keys())
+            raise
+        else:
+            if self._pending:
+                self._write(self._pending)
+        finally:
+            self._undo = None
+            self._pending = None
 
     @synchronize()
-    def _save(self, data):
+    def _save(self, data, keys=None):
         """
         Saves the local json file
+        :param data: The data to save
+        :type data: dict
+        :param keys: The changed keys. All data is saved when omitted
+        :type keys: list
         """
-        if self._keep_in_memory_only is True:
+        if keys is None or data is not self._data:
             self._data = data
+            keys = None
+        else:
+            self._update_index(keys)
+        if self._keep_in_memory_only is True:
+            return
+        if keys is None:
+            self._get_log().rewrite([{'k': key, 'v': value} for key, value in data.iteritems()])
+            return
+        records = []
+        for key in keys:
+            if key in data:
+                data[key] = json.loads(json.dumps(data[key]))  # Values read back from the file as they would be
+                records.append({'k': key, 'v': data[key]})
+            else:
+                records.append({'k': key})
+        if self._pending is not None:
+            self._pending.extend(records)
         else:
-            f = open(self._path, 'w+')
-            f.write(json.dumps(data, sort_keys=True, indent=2))
-            f.close()
+            self._write(records)
+
+    def _write(self, records):
+        # type: (List[dict]) -> None
+        """
+        Appends records to the local json file, compacting it when it holds a lot more records than keys
+        :param records: Records to write
+        :type records: list
+        :return: None
+        """
+        log = self._get_log()
+        log.append(records)
+        if log.records > max(self.COMPACTION_MINIMUM, 2 * len(self._data)):
+            self._read()
+            log.rewrite([{'k': key, 'v': value} for key, value in self._data.iteritems()])
 
     def lock(self, name, wait=None, expiration=60):
         # type: (str, float, float) -> file_mutex
@@ -0,0 +1,151 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+
+"""
+Expiry module for the persistent stores
+"""
+import time
+import logging
+from threading import Lock, current_thread
+from ovs_extensions.generic.repeatingtimer import RepeatingTimer
+
+
+class Expiry(object):
+    """
+    Values set with a TTL are stored in an envelope holding their expiry time: {KEY: expiry time, 'value': value}
+    Reading an expired value behaves as if the key does not exist, while the key is removed by reaping its prefix.
+    As the envelope is what is stored, asserting the value of an expiring key fails, while asserting its existence
+    succeeds until it is reaped. Listing keys does not read values, so expired keys are listed until they are reaped.
+    """
+    KEY = '__ovs_expiry__'
+
+    @staticmethod
+    def wrap(value, ttl):
+        # type: (any, float) -> dict
+        """
+        Wraps a value in an envelope
+        :param value: The value to wrap
+        :type value: any
+        :param ttl: Amount of seconds the value lives
+        :type ttl: float
+        :return: The envelope
+        :rtype: dict
+        """
+        return {Expiry.KEY: time.time() + ttl, 'value': value}
+
+    @staticmethod
+    def unwrap(value, now=None):
+        # type: (any, Optional[float]) -> Tuple[any, bool]
+        """
+        Unwraps the value from an envelope. Values which are not wrapped are returned as is and never expire
+        :param value: The stored value
+        :type value: any
+        :param now: Current time. Defaults to time.time()
+        :type now: float
+        :return: The value and whether it expired
+        :rtype: tuple
+        """
+        if type(value) is dict and len(value) == 2 and Expiry.KEY in value and 'value' in value:
+            return value['value'], value[Expiry.KEY] <= (time.time() if now is None else now)
+        return value, False
+
+
+class ExpiryReaper(object):
+    """
+    Incrementally removes the expired keys of a store in the background
+    Every run reaps the next prefix, so the load of a run is bounded by the size of a single prefix.
+    The store walks the prefix page by page and removes the expired keys of every page in one sequence.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, store, prefixes, interval=60):
+        # type: (any, List[str], float) -> None
+        """
+        Initializes an ExpiryReaper
+        :param store: Store implementing reap(prefix)
+        :type store: ovs_extensions.storage.persistent.pyrakoonstore.PyrakoonStore
+        :param prefixes: Prefixes holding expiring keys
+        :type prefixes: list
+        :param interval: Seconds between two runs
+        :type interval: float
+        """
+        self.store = store
+        self.prefixes = list(prefixes)
+        self.interval = interval
+        self.reaped = 0  # Amount of keys removed
+        self._index = 0
+        self._lock = Lock()
+        self._timer = None
+
+    def run(self):
+        # type: () -> int
+        """
+        Reaps the next prefix
+        :return: Amount of keys removed
+        :rtype: int
+        """
+        with self._lock:
+            if len(self.prefixes) == 0:
+                return 0
+            prefix = self.prefixes[self._index % len(self.prefixes)]
+            self._index += 1
+            reaped = self.store.reap(prefix)
+            self.reaped += reaped
+            return reaped
+
+    def _safe_run(self):
+        # type: () -> None
+        """
+        Reaps the next prefix from the background timer, logging any failure
+        The timer calls this once more after it was cancelled: that call is skipped
+        :return: None
+        :rtype: NoneType
+        """
+        timer = self._timer
+        if timer is None or timer.finished.is_set():
+            return
+        try:
+            self.run()
+        except Exception:
+            self._logger.exception('Unable to reap expired keys')
+
+    def start(self):
+        # type: () -> None
+        """
+        Starts reaping in the background
+        :return: None
+        :rtype: NoneType
+        """
+        if self._timer is not None:
+            return
+        self._timer = RepeatingTimer(self.interval, self._safe_run)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self):
+        # type: () -> None
+        """
+        Stops reaping. Waits for a run which is still in progress
+        :return: None
+        :rtype: NoneType
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            if self._timer is not current_thread():
+                self._timer.join()
+            self._timer = None
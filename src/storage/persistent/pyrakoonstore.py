@@ -18,6 +18,7 @@
 Arakoon store module, using pyrakoon
 """
 
+import time
 import ujson
 from ConfigParser import RawConfigParser
 from functools import wraps
@@ -25,6 +26,7 @@ from StringIO import StringIO
 from ovs_extensions.db.arakoon.pyrakoon.client import PyrakoonClient, PyrakoonClientPooled
 from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.compat import ArakoonAssertionFailed, ArakoonNotFound
 from ovs_extensions.storage.exceptions import AssertException, KeyNotFoundException
+from ovs_extensions.storage.persistent.expiry import Expiry
 
 
 def convert_exception():
@@ -49,12 +51,16 @@ def convert_exception():
         return new_function
     return wrap
 
+
 class PyrakoonStore(object):
     """
     Pyrakoon client wrapper:
     * Uses json serialisation
     * Raises generic exception
+    * Supports keys expiring after a TTL, see Expiry
     """
+    _batch_size = 500  # Entries per page when reaping a prefix, the same as the paging of the PyrakoonClient
+
     def __init__(self, cluster, configuration):
         """
         Initializes the client
@@ -73,26 +79,43 @@ class PyrakoonStore(object):
         Retrieves a certain value for a given key
         """
         try:
-            return ujson.loads(self._client.get(key))
+            value, expired = Expiry.unwrap(ujson.loads(self._client.get(key)))
         except ValueError:
             raise KeyNotFoundException('Could not parse JSON stored for {0}'.format(key))
+        if expired is True:
+            raise KeyNotFoundException(key)
+        return value
 
     @convert_exception()
     def get_multi(self, keys, must_exist=True):
         """
         Get multiple keys at once
+        Exceptions raised while iterating are converted here, as the decorator only covers creating the generator
         """
+        keys = list(keys)
         try:
-            for item in self._client.get_multi(keys, must_exist=must_exist):
-                yield None if item is None else ujson.loads(item)
+            now = time.time()
+            for key, item in zip(keys, self._client.get_multi(keys, must_exist=must_exist)):
+                value, expired = (None, False) if item is None else Expiry.unwrap(ujson.loads(item), now)
+                if expired is True:
+                    if must_exist is True:
+                        raise KeyNotFoundException(key)
+                    value = None
+                yield value
         except ValueError:
             raise KeyNotFoundException('Could not parse JSON stored')
+        except ArakoonNotFound as field:
+            raise KeyNotFoundException(field.message)
 
     @convert_exception()
-    def set(self, key, value, transaction=None):
+    def set(self, key, value, transaction=None, ttl=None):
         """
         Sets the value for a key to a given value
+        :param ttl: Amount of seconds after which the key expires. Never expires when omitted
+        :type ttl: float
         """
+        if ttl is not None:
+            value = Expiry.wrap(value, ttl)
         return self._client.set(key, ujson.dumps(value, sort_keys=True), transaction)
 
     @convert_exception()
@@ -107,8 +130,11 @@ class PyrakoonStore(object):
         """
         Lists all keys starting with the given prefix
         """
+        now = time.time()
         for item in self._client.prefix_entries(prefix):
-            yield [item[0], ujson.loads(item[1])]
+            value, expired = Expiry.unwrap(ujson.loads(item[1]), now)
+            if expired is False:
+                yield [item[0], value]
 
     @convert_exception()
     def delete(self, key, must_exist=True, transaction=None):
@@ -136,7 +162,77 @@ class PyrakoonStore(object):
         """
         Check if key exists
         """
-        return self._client.exists(key)
+        try:
+            raw_value = self._client.get(key)
+        except ArakoonNotFound:
+            return False
+        try:
+            return Expiry.unwrap(ujson.loads(raw_value))[1] is False
+        except ValueError:
+            return True
+
+    @convert_exception()
+    def reap(self, prefix):
+        # type: (str) -> int
+        """
+        Removes the expired keys starting with the given prefix
+        The prefix is walked page by page and the expired keys of every page are removed in one sequence, asserting
+        their values so keys which were set again in the meantime are left untouched
+        :param prefix: Prefix of the keys
+        :type prefix: str
+        :return: Amount of keys removed
+        :rtype: int
+        """
+        reaped = 0
+        expired = []
+        now = time.time()
+        for index, (key, raw_value) in enumerate(self._client.prefix_entries(prefix)):
+            try:
+                if Expiry.unwrap(ujson.loads(raw_value), now)[1] is True:
+                    expired.append((key, raw_value))
+            except ValueError:
+                pass
+            if (index + 1) % self._batch_size == 0:
+                reaped += self._delete_expired(expired)
+                expired = []
+                now = time.time()
+        return reaped + self._delete_expired(expired)
+
+    def _delete_expired(self, entries):
+        # type: (List[Tuple[str, str]]) -> int
+        """
+        Deletes expired keys in one sequence. When one of them changed, the others are deleted one by one
+        :param entries: The keys and the raw values they expired with
+        :type entries: list
+        :return: Amount of keys removed
+        :rtype: int
+        """
+        if len(entries) == 0:
+            return 0
+        if self._delete_unchanged(entries) is True:
+            return len(entries)
+        if len(entries) == 1:
+            return 0
+        return len([entry for entry in entries if self._delete_unchanged([entry]) is True])
+
+    def _delete_unchanged(self, entries):
+        # type: (List[Tuple[str, str]]) -> bool
+        """
+        Deletes keys in one sequence, asserting they still have the given raw values
+        :param entries: The keys and their raw values
+        :type entries: list
+        :return: Whether the keys were deleted
+        :rtype: bool
+        """
+        transaction = self._client.begin_transaction()
+        for key, raw_value in entries:
+            self._client.assert_value(key, raw_value, transaction)
+            self._client.delete(key, transaction=transaction)
+        try:
+            self._client.apply_transaction(transaction)
+            return True
+        except (ArakoonAssertionFailed, ArakoonNotFound):
+            return False
 
     @convert_exception()
     def assert_value(self, key, value, transaction=None):
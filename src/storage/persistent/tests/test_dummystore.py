@@ -0,0 +1,160 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+
+"""
+Test module for the dummy stores
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from ovs_extensions.storage.exceptions import AssertException, KeyNotFoundException
+from ovs_extensions.storage.persistent.dummystore import DummyPersistentStore
+from ovs_extensions.storage.volatile.dummystore import DummyVolatileStore
+
+
+class DummyStoreTest(unittest.TestCase):
+    """
+    Test the DummyPersistentStore and DummyVolatileStore
+    """
+
+    def setUp(self):
+        """
+        Creates a directory for the stores in file mode
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Removes the directory of the stores in file mode
+        """
+        shutil.rmtree(self.directory)
+
+    def _file_store(self, path):
+        """
+        Returns a DummyPersistentStore in file mode
+        """
+        store = DummyPersistentStore()
+        store._keep_in_memory_only = False
+        store._path = os.path.join(self.directory, path)
+        return store
+
+    def test_prefix(self):
+        """
+        Validates the prefix queries return the matching keys in order
+        """
+        store = DummyPersistentStore()
+        for key in ['/b/2', '/a/1', '/b/1', '/ab', '/c', '/b']:
+            store.set(key, key)
+        self.assertListEqual(store.prefix('/b'), ['/b', '/b/1', '/b/2'])
+        self.assertListEqual(store.prefix('/b/'), ['/b/1', '/b/2'])
+        self.assertListEqual(store.prefix_entries('/a'), [('/a/1', '/a/1'), ('/ab', '/ab')])
+        self.assertListEqual(store.prefix('/d'), [])
+        store.delete('/b/1')
+        store.delete_prefix('/a')
+        self.assertListEqual(store.prefix('/'), ['/b', '/b/2', '/c'])
+        store._data['/a'] = 0  # The index follows changes made to the data directly
+        self.assertListEqual(store.prefix('/a'), ['/a'])
+
+    def test_copies(self):
+        """
+        Validates values are copied when entering and leaving the store
+        """
+        store = DummyPersistentStore()
+        value = {'foo': [1, {'bar': 2}]}
+        store.set('key', value)
+        value['foo'][1]['bar'] = 3
+        self.assertDictEqual(store.get('key'), {'foo': [1, {'bar': 2}]})
+        store.get('key')['foo'].append(4)
+        self.assertDictEqual(list(store.get_multi(['key']))[0], {'foo': [1, {'bar': 2}]})
+        store.prefix_entries('k')[0][1]['foo'] = None
+        self.assertDictEqual(store.get('key'), {'foo': [1, {'bar': 2}]})
+
+    def test_transaction_rollback(self):
+        """
+        Validates a failing transaction leaves the store untouched
+        """
+        for store in [DummyPersistentStore(), self._file_store('rollback.json')]:
+            store.set('/a', 1)
+            store.set('/b', 2)
+            transaction = store.begin_transaction()
+            store.set('/a', 10, transaction=transaction)
+            store.delete('/b', transaction=transaction)
+            store.set('/c', 3, transaction=transaction)
+            store.assert_value('/a', 2, transaction=transaction)
+            with self.assertRaises(AssertException):
+                store.apply_transaction(transaction)
+            self.assertListEqual(store.prefix_entries('/'), [('/a', 1), ('/b', 2)])
+            transaction = store.begin_transaction()
+            store.assert_value('/a', 1, transaction=transaction)
+            store.delete_prefix('/', transaction=transaction)
+            store.set('/c', 3, transaction=transaction)
+            store.apply_transaction(transaction)
+            self.assertListEqual(store.prefix_entries('/'), [('/c', 3)])
+            with self.assertRaises(KeyNotFoundException):
+                store.get('/a')
+
+    def test_file_mode(self):
+        """
+        Validates stores in file mode sharing a file see each others changes
+        """
+        store_1 = self._file_store('shared.json')
+        store_2 = self._file_store('shared.json')
+        store_1.set('/a', (1, 2))
+        self.assertListEqual(store_1.get('/a'), [1, 2])  # Read back as it would be from the file
+        self.assertListEqual(store_2.get('/a'), [1, 2])
+        store_2.set('/b', 'b')
+        store_2.delete('/a')
+        self.assertListEqual(store_1.prefix_entries('/'), [('/b', 'b')])
+        store_1.COMPACTION_MINIMUM = 10
+        for i in xrange(25):
+            store_1.set('/c', i)
+        self.assertLessEqual(store_1._get_log().records, 10)
+        self.assertEqual(store_2.get('/c'), 24)
+        self.assertListEqual(store_2.prefix('/'), ['/b', '/c'])
+        store_2._clean()
+        self.assertListEqual(store_1.prefix('/'), [])
+
+    def test_volatile_file_mode(self):
+        """
+        Validates volatile stores in file mode sharing a file see each others changes
+        """
+        stores = []
+        for _ in xrange(2):
+            store = DummyVolatileStore()
+            store._keep_in_memory_only = False
+            store._path = os.path.join(self.directory, 'volatile.json')
+            stores.append(store)
+        store_1, store_2 = stores
+        store_1.set('foo', {'bar': 1})
+        self.assertDictEqual(store_2.get('foo'), {'bar': 1})
+        self.assertFalse(store_2.add('foo', 2))
+        self.assertTrue(store_2.incr('counter') is False)
+        store_2.set('counter', 1)
+        store_2.incr('counter', 5)
+        store_1.set_multi({'a': 1, 'b': 2}, time=-1)
+        self.assertEqual(store_1.get('counter'), 6)
+        self.assertDictEqual(store_2.get_multi(['foo', 'a', 'b']), {'foo': {'bar': 1}})
+        store_1.delete_multi(['foo', 'counter'])
+        self.assertIsNone(store_2.get('foo'))
+        store_2._clean()
+        self.assertIsNone(store_1.get('counter'))
+
+
+if __name__ == '__main__':
+    unittest.main()
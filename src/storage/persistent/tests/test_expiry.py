@@ -0,0 +1,139 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+
+"""
+Test module for the expiring keys of the persistent stores
+"""
+import time
+import unittest
+from ovs_extensions.db.arakoon.pyrakoon.client import PyrakoonClient
+from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.test import FakeClient
+from ovs_extensions.storage.exceptions import KeyNotFoundException
+from ovs_extensions.storage.persistent.expiry import Expiry, ExpiryReaper
+from ovs_extensions.storage.persistent.pyrakoonstore import PyrakoonStore
+
+
+class ExpiryTest(unittest.TestCase):
+    """
+    Test the expiring keys of the PyrakoonStore against the in-memory FakeClient
+    """
+
+    def setUp(self):
+        fake_client = FakeClient()
+        client = PyrakoonClient('test', {'arakoon0': (['127.0.0.1'], 26400)})
+        client._client._client = fake_client
+        self.store = PyrakoonStore('test', '[global]\ncluster = arakoon0\n\n[arakoon0]\nip = 127.0.0.1\nclient_port = 26400\n')
+        self.store._client._pool._create_new_client = lambda: client
+
+    def test_envelope(self):
+        """
+        Validates values are wrapped with their expiry time and only envelopes expire
+        """
+        envelope = Expiry.wrap({'a': 1}, 10)
+        self.assertEqual(Expiry.unwrap(envelope), ({'a': 1}, False))
+        self.assertEqual(Expiry.unwrap(envelope, now=time.time() + 11), ({'a': 1}, True))
+        self.assertEqual(Expiry.unwrap({Expiry.KEY: 0}), ({Expiry.KEY: 0}, False))
+        self.assertEqual(Expiry.unwrap([1]), ([1], False))
+
+    def test_expiry_on_read(self):
+        """
+        Validates keys are readable until they expire
+        """
+        self.store.set('key', 'value', ttl=0.2)
+        self.assertEqual(self.store.get('key'), 'value')
+        time.sleep(0.25)
+        with self.assertRaises(KeyNotFoundException):
+            self.store.get('key')
+        self.assertFalse(self.store.exists('key'))
+        self.store.set('key', 'value')
+        self.assertTrue(self.store.exists('key'))
+
+    def test_reap_pages(self):
+        """
+        Validates the prefix is reaped page by page, removing the expired keys of a page in one sequence
+        """
+        self.store._batch_size = 7
+        for index in xrange(50):
+            self.store.set('/reap/{0:02d}'.format(index), index, ttl=-1 if index % 2 == 0 else 3600)
+        self.store.set('/other', 0, ttl=-1)
+        sequences = []
+        delete_unchanged = self.store._delete_unchanged
+
+        def _delete_unchanged(entries):
+            sequences.append(len(entries))
+            return delete_unchanged(entries)
+
+        self.store._delete_unchanged = _delete_unchanged
+        self.assertEqual(self.store.reap('/reap/'), 25)
+        self.assertListEqual(sequences, [4, 3, 4, 3, 4, 3, 4])  # The last page holds a live key only
+        self.assertListEqual(list(self.store.prefix('/reap/')), ['/reap/{0:02d}'.format(index) for index in xrange(1, 50, 2)])
+        self.assertListEqual(list(self.store.prefix('/other')), ['/other'])
+        self.assertEqual(self.store.reap('/reap/'), 0)
+
+    def test_reap_leaves_changed_keys(self):
+        """
+        Validates keys which were set again after expiring are not removed
+        """
+        self.store.set('/reap/a', 'a', ttl=-1)
+        self.store.set('/reap/b', 'b', ttl=-1)
+        expired_entries = list(self.store._client.prefix_entries('/reap/'))
+        self.store.set('/reap/a', 'a again')
+        self.assertEqual(self.store._delete_expired(expired_entries), 1)
+        self.assertListEqual(list(self.store.prefix_entries('/reap/')), [['/reap/a', 'a again']])
+        self.assertListEqual(list(self.store.prefix('/reap/')), ['/reap/a'])
+
+    def test_reaper(self):
+        """
+        Validates the reaper reaps one prefix per run, in the background as well
+        """
+        for prefix in ['/a/', '/b/']:
+            for index in xrange(3):
+                self.store.set('{0}{1}'.format(prefix, index), index, ttl=-1)
+        reaper = ExpiryReaper(self.store, ['/a/', '/b/'], interval=0.01)
+        self.assertEqual(reaper.run(), 3)
+        self.assertListEqual(list(self.store.prefix('/a/')), [])
+        self.assertEqual(len(list(self.store.prefix('/b/'))), 3)
+        self.store.set('/a/0', 0, ttl=-1)
+        reaper.start()
+        try:
+            deadline = time.time() + 5
+            while reaper.reaped < 7 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            reaper.stop()
+        self.assertEqual(reaper.reaped, 7)
+        self.assertListEqual(list(self.store.prefix('/')), [])
+
+        # Nothing is reaped anymore once stopped
+        runs = []
+        reaper.store = type('Store', (object,), {'reap': lambda s, prefix: runs.append(prefix) or 0})()
+        reaper.start()
+        try:
+            deadline = time.time() + 5
+            while len(runs) == 0 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            reaper.stop()
+        amount = len(runs)
+        time.sleep(0.05)
+        self.assertGreater(amount, 0)
+        self.assertEqual(len(runs), amount)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+
+"""
+Conformance and throughput benchmark of all key-value store backends. Run as a module:
+python -m ovs_extensions.storage.tests.benchmark [amount of keys]
+Arakoon and memcache are replaced by the FakeClient and a local MemcacheServer, so the numbers of the real backends
+mostly show the cost of the client side (serialization and protocol handling)
+"""
+import sys
+from ovs_extensions.storage.tests.conformance import format_report, run
+
+
+if __name__ == '__main__':
+    _size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print format_report(run(size=_size))
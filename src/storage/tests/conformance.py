@@ -0,0 +1,528 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+
+"""
+Backend agnostic conformance and benchmark harness for the key-value stores.
+The same scenarios run against every backend of a family, using local stand-ins for Arakoon and memcache.
+The traces of the fakes are compared with the trace of the real implementation of their family, which gives the
+correctness diffs, while timing the scenarios gives the operations per second of every backend.
+"""
+import json
+import time
+import shutil
+import tempfile
+from contextlib import contextmanager
+from ovs_extensions.db.arakoon.pyrakoon.client import MockPyrakoonClient, PyrakoonClient
+from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.compat import ArakoonAssertionFailed, ArakoonNotFound
+from ovs_extensions.db.arakoon.pyrakoon.pyrakoon.test import FakeClient
+from ovs_extensions.storage.exceptions import AssertException, KeyNotFoundException
+from ovs_extensions.storage.persistent.dummystore import DummyPersistentStore
+from ovs_extensions.storage.persistent.pyrakoonstore import PyrakoonStore
+from ovs_extensions.storage.volatile.dummystore import DummyVolatileStore
+from ovs_extensions.storage.volatile.memcachestore import MemcacheStore
+from ovs_extensions.storage.volatile.tests.memcacheserver import MemcacheServer
+
+NODES = {'arakoon0': (['127.0.0.1'], 26400)}
+CONFIGURATION = '[global]\ncluster = arakoon0\n\n[arakoon0]\nip = 127.0.0.1\nclient_port = 26400\n'
+
+
+def _pyrakoon_client(fake_client):
+    """
+    Returns a PyrakoonClient talking to the given FakeClient
+    """
+    client = PyrakoonClient('conformance', NODES)
+    client._client._client = fake_client
+    return client
+
+
+@contextmanager
+def _pyrakoon_client_backend():
+    """
+    PyrakoonClient, talking to a FakeClient
+    """
+    yield _pyrakoon_client(FakeClient())
+
+
+@contextmanager
+def _pyrakoon_store():
+    """
+    PyrakoonStore, with its pool of clients talking to a FakeClient
+    """
+    fake_client = FakeClient()
+    store = PyrakoonStore('conformance', CONFIGURATION)
+    store._client._pool._create_new_client = lambda: _pyrakoon_client(fake_client)
+    yield store
+
+
+@contextmanager
+def _dummy_persistent_store(in_memory=True, mimick_pyrakoonclient=False):
+    """
+    DummyPersistentStore, in memory or using a file in a temporary directory
+    """
+    directory = tempfile.mkdtemp()
+    store = DummyPersistentStore(mimick_pyrakoonclient=mimick_pyrakoonclient)
+    if in_memory is False:
+        store._keep_in_memory_only = False
+        store._path = '{0}/store.json'.format(directory)
+    try:
+        yield store
+    finally:
+        shutil.rmtree(directory)
+
+
+@contextmanager
+def _mock_pyrakoon_client():
+    """
+    MockPyrakoonClient, using a cluster of its own as the data of the mock is shared
+    """
+    cluster = 'conformance_{0}'.format(time.time())
+    try:
+        yield MockPyrakoonClient(cluster, NODES)
+    finally:
+        MockPyrakoonClient._data.pop(cluster, None)
+        MockPyrakoonClient._sequences.pop(cluster, None)
+
+
+@contextmanager
+def _memcache_store():
+    """
+    MemcacheStore, talking to a local MemcacheServer
+    """
+    server = MemcacheServer().start()
+    try:
+        yield MemcacheStore([server.address])
+    finally:
+        server.stop()
+
+
+@contextmanager
+def _dummy_volatile_store():
+    """
+    DummyVolatileStore. Its data is shared, so it is emptied before and after use
+    """
+    store = DummyVolatileStore()
+    store._clean()
+    try:
+        yield store
+    finally:
+        store._clean()
+
+
+class Backend(object):
+    """
+    Backend under test
+    A family groups the backends exposing the same semantics: 'store' for the JSON serializing persistent stores,
+    'client' for the Arakoon clients storing strings and 'volatile' for the volatile stores.
+    The reference backend of a family is the real implementation, which the others are compared with
+    """
+    EXCEPTIONS = {'store': (KeyNotFoundException, AssertException),
+                  'client': (ArakoonNotFound, ArakoonAssertionFailed),
+                  'volatile': ((), ())}
+
+    def __init__(self, name, family, factory, reference=False):
+        """
+        Initializes a Backend
+        :param name: Name of the backend
+        :type name: str
+        :param family: Family of the backend
+        :type family: str
+        :param factory: Context manager yielding a new, empty instance of the backend
+        :type factory: callable
+        :param reference: Whether this is the reference backend of its family
+        :type reference: bool
+        """
+        self.name = name
+        self.family = family
+        self.factory = factory
+        self.reference = reference
+        self.not_found_exception, self.assertion_exception = Backend.EXCEPTIONS[family]
+
+    def encode(self, value):
+        """
+        Converts a value into the representation the backend stores: the clients store strings
+        """
+        if self.family == 'client':
+            return json.dumps(value, sort_keys=True)
+        return value
+
+
+def get_backends():
+    """
+    Returns all backends, references first
+    :return: The backends
+    :rtype: list[Backend]
+    """
+    return [Backend('PyrakoonStore', 'store', _pyrakoon_store, reference=True),
+            Backend('DummyPersistentStore', 'store', _dummy_persistent_store),
+            Backend('DummyPersistentStore (file)', 'store', lambda: _dummy_persistent_store(in_memory=False)),
+            Backend('PyrakoonClient', 'client', _pyrakoon_client_backend, reference=True),
+            Backend('MockPyrakoonClient', 'client', _mock_pyrakoon_client),
+            Backend('DummyPersistentStore (client)', 'client', lambda: _dummy_persistent_store(mimick_pyrakoonclient=True)),
+            Backend('MemcacheStore', 'volatile', _memcache_store, reference=True),
+            Backend('DummyVolatileStore', 'volatile', _dummy_volatile_store)]
+
+
+class Run(object):
+    """
+    Executes the operations of a scenario against a backend, recording their outcomes and timing them
+    """
+
+    def __init__(self, backend, store, size):
+        """
+        Initializes a Run
+        :param backend: Backend under test
+        :type backend: Backend
+        :param store: Instance of the backend
+        :type store: any
+        :param size: Amount of keys used by the scenarios working on larger data sets
+        :type size: int
+        """
+        self.backend = backend
+        self.store = store
+        self.size = size
+        self.trace = []
+        self.operations = 0
+        self.duration = 0.0
+
+    def value(self, value):
+        """
+        Converts a value into the representation the backend stores
+        """
+        return self.backend.encode(value)
+
+    def call(self, step, method, *args, **kwargs):
+        """
+        Calls a method of the store. Returned iterators are consumed, as some backends return generators
+        :param step: Description of the step. When None, the outcome is not recorded
+        :type step: str
+        :param method: Name of the method to call
+        :type method: str
+        :return: The outcome of the call
+        """
+        start = time.time()
+        try:
+            result = getattr(self.store, method)(*args, **kwargs)
+            if hasattr(result, 'next'):
+                result = list(result)
+        except Exception as ex:
+            if isinstance(ex, self.backend.not_found_exception):
+                result = 'raised KeyNotFound'
+            elif isinstance(ex, self.backend.assertion_exception):
+                result = 'raised AssertFailed'
+            else:
+                result = 'raised {0}'.format(ex.__class__.__name__)
+        self.duration += time.time() - start
+        self.operations += 1
+        result = _normalize(result)
+        if step is not None:
+            self.trace.append((step, result))
+        return result
+
+
+def _normalize(value):
+    """
+    Makes outcomes comparable: tuples become lists
+    """
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _normalize(item)) for key, item in value.iteritems())
+    return value
+
+
+def _point_operations(run):
+    """
+    Single key operations, including the missing key cases
+    """
+    run.call('get missing', 'get', '/point/missing')
+    run.call('exists missing', 'exists', '/point/missing')
+    run.call('set', 'set', '/point/a', run.value({'a': [1, 2]}))
+    run.call('get', 'get', '/point/a')
+    run.call('exists', 'exists', '/point/a')
+    run.call('overwrite', 'set', '/point/a', run.value('a'))
+    run.call('get overwritten', 'get', '/point/a')
+    run.call('set other', 'set', '/point/b', run.value(2))
+    run.call('get_multi', 'get_multi', ['/point/b', '/point/a'])
+    run.call('get_multi missing', 'get_multi', ['/point/a', '/point/missing'])
+    run.call('get_multi missing allowed', 'get_multi', ['/point/a', '/point/missing'], must_exist=False)
+    run.call('delete', 'delete', '/point/a')
+    run.call('get deleted', 'get', '/point/a')
+    run.call('delete missing', 'delete', '/point/a')
+    run.call('delete missing allowed', 'delete', '/point/a', must_exist=False)
+    run.call('nop', 'nop')
+    for index in xrange(run.size / 10):
+        run.call(None, 'set', '/point/c', run.value(index))
+        run.call(None, 'get', '/point/c')
+    run.call('get repeatedly set', 'get', '/point/c')
+
+
+def _prefix_scans(run):
+    """
+    Prefix scans over a larger set of keys
+    """
+    for key in ['/sca', '/scan', '/scao']:
+        run.call(None, 'set', key, run.value(key))
+    for index in xrange(run.size):
+        run.call(None, 'set', '/scan/{0:06d}'.format(index), run.value({'index': index}))
+    for _ in xrange(5):
+        run.call('prefix', 'prefix', '/scan/')
+        run.call('prefix_entries', 'prefix_entries', '/scan/')
+    for index in xrange(0, run.size / 10, max(1, run.size / 1000)):
+        run.call('prefix {0}'.format(index), 'prefix', '/scan/{0:05d}'.format(index))
+        run.call('prefix_entries {0}'.format(index), 'prefix_entries', '/scan/{0:05d}'.format(index))
+    run.call('prefix without matches', 'prefix', '/scan/x')
+    run.call('delete_prefix', 'delete_prefix', '/scan/00000')
+    run.call('prefix after delete_prefix', 'prefix', '/scan/0000')
+    run.call('delete_prefix everything', 'delete_prefix', '/scan/')
+    run.call('prefix remaining', 'prefix_entries', '/sca')
+
+
+def _transactions(run):
+    """
+    Transactions which succeed, changing multiple keys at once
+    """
+    run.call('set', 'set', '/transaction/a', run.value(1))
+    run.call('set other', 'set', '/transaction/b', run.value(2))
+    transaction = run.call(None, 'begin_transaction')
+    run.call(None, 'assert_value', '/transaction/a', run.value(1), transaction=transaction)
+    run.call(None, 'assert_value', '/transaction/missing', None, transaction=transaction)
+    run.call(None, 'assert_exists', '/transaction/b', transaction=transaction)
+    run.call(None, 'set', '/transaction/a', run.value(10), transaction=transaction)
+    run.call(None, 'delete', '/transaction/b', transaction=transaction)
+    run.call(None, 'delete', '/transaction/missing', must_exist=False, transaction=transaction)
+    run.call(None, 'set', '/transaction/c/1', run.value(3), transaction=transaction)
+    run.call(None, 'set', '/transaction/c/2', run.value(4), transaction=transaction)
+    run.call('apply', 'apply_transaction', transaction)
+    run.call('result', 'prefix_entries', '/transaction/')
+    transaction = run.call(None, 'begin_transaction')
+    run.call(None, 'delete_prefix', '/transaction/c/', transaction=transaction)
+    run.call('apply delete_prefix', 'apply_transaction', transaction)
+    run.call('result delete_prefix', 'prefix_entries', '/transaction/')
+    for index in xrange(run.size / 100):
+        transaction = run.call(None, 'begin_transaction')
+        run.call(None, 'assert_value', '/transaction/a', run.value(10 + index), transaction=transaction)
+        run.call(None, 'set', '/transaction/a', run.value(11 + index), transaction=transaction)
+        run.call(None, 'apply_transaction', transaction)
+    run.call('result repeated', 'get', '/transaction/a')
+
+
+def _assert_failures(run):
+    """
+    Failing asserts, directly and within transactions, which must leave the data untouched
+    """
+    run.call('set', 'set', '/assert/a', run.value({'a': 1}))
+    run.call('assert_value', 'assert_value', '/assert/a', run.value({'a': 1}))
+    run.call('assert_value wrong', 'assert_value', '/assert/a', run.value({'a': 2}))
+    run.call('assert_value missing', 'assert_value', '/assert/missing', run.value(1))
+    run.call('assert_value None', 'assert_value', '/assert/missing', None)
+    run.call('assert_value None existing', 'assert_value', '/assert/a', None)
+    run.call('assert_exists', 'assert_exists', '/assert/a')
+    run.call('assert_exists missing', 'assert_exists', '/assert/missing')
+    for name, failing_step in [('assert_value', ['assert_value', '/assert/a', run.value({'a': 2})]),
+                               ('assert_value None', ['assert_value', '/assert/a', None]),
+                               ('assert_exists', ['assert_exists', '/assert/missing']),
+                               ('delete', ['delete', '/assert/missing'])]:
+        transaction = run.call(None, 'begin_transaction')
+        run.call(None, 'set', '/assert/b', run.value('new'), transaction=transaction)
+        run.call(None, failing_step[0], *failing_step[1:], transaction=transaction)
+        run.call(None, 'set', '/assert/a', run.value('changed'), transaction=transaction)
+        run.call(None, 'delete_prefix', '/assert/', transaction=transaction)
+        run.call('apply failing {0}'.format(name), 'apply_transaction', transaction)
+        run.call('untouched after failing {0}'.format(name), 'prefix_entries', '/assert/')
+
+
+def _expiry(run):
+    """
+    Keys expiring after a TTL: negative TTLs give keys which already expired
+    """
+    run.call('set live', 'set', '/expiry/live', {'a': 1}, ttl=3600)
+    run.call('set expired', 'set', '/expiry/expired', 'expired', ttl=-1)
+    run.call('set permanent', 'set', '/expiry/permanent', 1)
+    run.call('get live', 'get', '/expiry/live')
+    run.call('get expired', 'get', '/expiry/expired')
+    run.call('exists live', 'exists', '/expiry/live')
+    run.call('exists expired', 'exists', '/expiry/expired')
+    run.call('get_multi expired', 'get_multi', ['/expiry/live', '/expiry/expired'])
+    run.call('get_multi expired allowed', 'get_multi', ['/expiry/live', '/expiry/expired'], must_exist=False)
+    run.call('prefix_entries', 'prefix_entries', '/expiry/')
+    run.call('prefix lists expired keys', 'prefix', '/expiry/')
+    run.call('assert_exists expired', 'assert_exists', '/expiry/expired')
+    transaction = run.call(None, 'begin_transaction')
+    run.call(None, 'set', '/expiry/live', 'expired', transaction=transaction, ttl=-1)
+    run.call('apply', 'apply_transaction', transaction)
+    run.call('get expired in transaction', 'get', '/expiry/live')
+    for index in xrange(run.size):
+        run.call(None, 'set', '/expiry/many/{0:06d}'.format(index), index, ttl=-1 if index % 3 else 3600)
+    run.call('reap', 'reap', '/expiry/')
+    run.call('prefix after reap', 'prefix', '/expiry/')
+    run.call('reap again', 'reap', '/expiry/')
+
+
+def _volatile_operations(run):
+    """
+    Single key operations of the volatile stores
+    """
+    run.call('get missing', 'get', 'missing')
+    run.call('get missing with default', 'get', 'missing', default=0)
+    run.call('set', 'set', 'a', {'a': [1, 2]})
+    run.call('get', 'get', 'a')
+    run.call('gets', 'gets', 'a')
+    run.call('add existing', 'add', 'a', 1)
+    run.call('add', 'add', 'b', 1)
+    run.call('get added', 'get', 'b')
+    run.call('incr', 'incr', 'b')
+    run.call('get incremented', 'get', 'b')
+    run.call('delete', 'delete', 'a')
+    run.call('get deleted', 'get', 'a')
+    for index in xrange(run.size / 10):
+        run.call(None, 'set', 'c', index)
+        run.call(None, 'get', 'c')
+    run.call('get repeatedly set', 'get', 'c')
+
+
+def _volatile_multi_operations(run):
+    """
+    Multi key operations of the volatile stores
+    """
+    keys = ['multi_{0}'.format(index) for index in xrange(100)]
+    run.call('set_multi', 'set_multi', dict((key, {'key': key}) for key in keys))
+    run.call('get_multi', 'get_multi', keys[:10] + ['missing'])
+    run.call('delete_multi', 'delete_multi', keys[:50])
+    run.call('get_multi partially deleted', 'get_multi', keys[40:60])
+    for _ in xrange(run.size / 100):
+        run.call(None, 'get_multi', keys)
+
+
+SCENARIOS = {'store': [_point_operations, _prefix_scans, _transactions, _assert_failures, _expiry],
+             'client': [_point_operations, _prefix_scans, _transactions, _assert_failures],
+             'volatile': [_volatile_operations, _volatile_multi_operations]}
+
+
+class Result(object):
+    """
+    Outcome of running a scenario against a backend
+    """
+
+    def __init__(self, backend, scenario, run):
+        """
+        Initializes a Result
+        :param backend: Backend the scenario ran against
+        :type backend: Backend
+        :param scenario: Name of the scenario
+        :type scenario: str
+        :param run: The finished run
+        :type run: Run
+        """
+        self.backend = backend
+        self.scenario = scenario
+        self.trace = run.trace
+        self.operations = run.operations
+        self.duration = run.duration
+
+    @property
+    def operations_per_second(self):
+        """
+        Operations per second, counting the time spent in the backend only
+        """
+        return self.operations / self.duration if self.duration > 0 else 0.0
+
+
+def run(backends=None, size=10000):
+    """
+    Runs all scenarios of their family against the given backends, every scenario on a new instance
+    :param backends: Backends to run against. Defaults to all backends
+    :type backends: list[Backend]
+    :param size: Amount of keys used by the scenarios working on larger data sets
+    :type size: int
+    :return: The results
+    :rtype: list[Result]
+    """
+    results = []
+    for backend in backends or get_backends():
+        for scenario in SCENARIOS[backend.family]:
+            with backend.factory() as store:
+                scenario_run = Run(backend, store, size)
+                scenario(scenario_run)
+            results.append(Result(backend, scenario.__name__.strip('_'), scenario_run))
+    return results
+
+
+def get_diffs(results):
+    """
+    Compares the traces of every backend with the traces of the reference backend of its family
+    :param results: Results of a run, containing the reference backends
+    :type results: list[Result]
+    :return: The differing steps per backend and scenario: {(backend name, scenario): [(step, expected, actual)]}
+    :rtype: dict
+    """
+    references = dict(((result.backend.family, result.scenario), result) for result in results if result.backend.reference is True)
+    diffs = {}
+    for result in results:
+        reference = references.get((result.backend.family, result.scenario))
+        if reference is None or reference is result:
+            continue
+        differences = []
+        for index in xrange(max(len(reference.trace), len(result.trace))):
+            expected = reference.trace[index] if index < len(reference.trace) else (None, None)
+            actual = result.trace[index] if index < len(result.trace) else (None, None)
+            if expected != actual:
+                differences.append((expected[0] or actual[0], expected[1], actual[1]))
+        if len(differences) > 0:
+            diffs[(result.backend.name, result.scenario)] = differences
+    return diffs
+
+
+def format_report(results, max_length=100):
+    """
+    Formats the operations per second and the correctness diffs of a run
+    :param results: Results of a run
+    :type results: list[Result]
+    :param max_length: Maximum length of a reported outcome
+    :type max_length: int
+    :return: The report
+    :rtype: str
+    """
+    def _shorten(value):
+        value = repr(value)
+        return value if len(value) <= max_length else '{0}...'.format(value[:max_length - 3])
+
+    names = []
+    scenarios = []
+    per_backend = {}
+    for result in results:
+        if result.backend.name not in names:
+            names.append(result.backend.name)
+        if result.scenario not in scenarios:
+            scenarios.append(result.scenario)
+        per_backend.setdefault(result.backend.name, {})[result.scenario] = result
+    width = max(len(name) for name in names)
+    lines = ['Operations per second', '{0:<{1}}  {2}'.format('', width, '  '.join('{0:>18}'.format(scenario[:18]) for scenario in scenarios))]
+    for name in names:
+        columns = []
+        for scenario in scenarios:
+            result = per_backend[name].get(scenario)
+            columns.append('{0:>18}'.format('' if result is None else '{0:.0f}'.format(result.operations_per_second)))
+        lines.append('{0:<{1}}  {2}'.format(name, width, '  '.join(columns)))
+    diffs = get_diffs(results)
+    lines.append('')
+    lines.append('Correctness diffs with the reference backend of the family' if diffs else 'No correctness diffs')
+    for (name, scenario), differences in sorted(diffs.iteritems()):
+        lines.append('{0} - {1}:'.format(name, scenario))
+        for step, expected, actual in differences:
+            lines.append('  {0}: expected {1}, got {2}'.format(step, _shorten(expected), _shorten(actual)))
+    return '\n'.join(lines)
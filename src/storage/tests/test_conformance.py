@@ -0,0 +1,76 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+
+"""
+Test module verifying the fake key-value stores behave like the real ones
+"""
+import unittest
+from ovs_extensions.storage.tests.conformance import get_backends, get_diffs, run
+
+
+class ConformanceTest(unittest.TestCase):
+    """
+    Runs the conformance scenarios against all backends and compares the fakes with the reference of their family
+    """
+
+    def _assert_conform(self, family):
+        """
+        Asserts the backends of the given family behave like the reference backend
+        MockPyrakoonClient is left out: its transactions and asserts are known to differ from Arakoon
+        """
+        backends = [backend for backend in get_backends() if backend.family == family and backend.name != 'MockPyrakoonClient']
+        self.assertGreater(len(backends), 1)
+        diffs = get_diffs(run(backends, size=200))
+        self.assertDictEqual(diffs, {})
+
+    def test_stores(self):
+        """
+        Validates the DummyPersistentStore behaves like the PyrakoonStore, in memory and in file mode
+        """
+        self._assert_conform('store')
+
+    def test_clients(self):
+        """
+        Validates the DummyPersistentStore mimicking a client behaves like the PyrakoonClient
+        """
+        self._assert_conform('client')
+
+    def test_volatile_stores(self):
+        """
+        Validates the DummyVolatileStore behaves like the MemcacheStore
+        """
+        self._assert_conform('volatile')
+
+    def test_diffs_are_reported(self):
+        """
+        Validates differences with the reference backend are reported per backend and scenario
+        """
+        backends = [backend for backend in get_backends() if backend.family == 'client']
+        results = run(backends, size=50)
+        for result in results:
+            self.assertGreater(result.operations, 0)
+        diffs = get_diffs(results)
+        self.assertIn(('MockPyrakoonClient', 'transactions'), diffs)
+        step, expected, actual = diffs[('MockPyrakoonClient', 'transactions')][0]
+        self.assertEqual(step, 'apply')
+        self.assertIsNone(expected)
+        self.assertEqual(actual, 'raised KeyError')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,38 +17,49 @@
 """
 Dummy volatile module
 """
-import os
-import copy
 import json
 import time as time_module
+from ovs_extensions.storage.dummyhelpers import AppendOnlyLog, copy_value
+from ovs_extensions.storage.volatile.nearcache import NearCache
 
 
 class DummyVolatileStore(object):
     """
     This is a dummy volatile store that makes use of a local json file
+    Values are copied when entering and leaving the store and are never changed in place
+    When operating in file mode, changes are appended to the file which is compacted once it grows too large
     """
+    COMPACTION_MINIMUM = 1000  # Minimum amount of records in the file before compacting it
+
     _path = '/run/dummyvolatile.json'
     _storage = {}
     _timeout = {}
     _data = {'t': {}, 's': {}}
 
-    def __init__(self):
+    def __init__(self, near_cache_size=0, near_cache_ttl=1.0):
         """
         Init method
+        :param near_cache_size: Amount of keys to keep in the near cache. 0 disables the near cache
+        :type near_cache_size: int
+        :param near_cache_ttl: Maximum amount of seconds a value is kept in the near cache
+        :type near_cache_ttl: float
         """
         self._keep_in_memory_only = True
+        self._near_cache = NearCache(max_entries=near_cache_size, ttl=near_cache_ttl) if near_cache_size > 0 else None
+        self._file_data = {'t': {}, 's': {}}
+        self._log = None
 
     def _clean(self):
         """
         Empties the store
         """
+        if self._near_cache is not None:
+            self._near_cache.clear()
         if self._keep_in_memory_only is True:
             DummyVolatileStore._data = {'t': {}, 's': {}}
         else:
-            try:
-                os.remove(DummyVolatileStore._path)
-            except OSError:
-                pass
+            self._file_data = {'t': {}, 's': {}}
+            self._get_log().remove()
 
     def _read(self):
         """
@@ -57,22 +68,43 @@ class DummyVolatileStore(object):
         if self._keep_in_memory_only is True:
             return DummyVolatileStore._data
 
-        try:
-            f = open(self._path, 'r')
-            data = json.loads(f.read())
-            f.close()
-        except IOError:
-            data = {'t': {}, 's': {}}
+        reset, records = self._get_log().read()
+        if reset is True:
+            self._file_data = {'t': {}, 's': {}}
+        data = self._file_data
+        for record in records:
+            key = record['k']
+            if 'v' in record:
+                data['s'][key] = record['v']
+                data['t'][key] = record['t']
+            elif key in data['s']:
+                del data['s'][key]
+                del data['t'][key]
         return data
 
+    def _get_log(self):
+        """
+        Returns the log of the local json file
+        """
+        if self._log is None or self._log.path != self._path:
+            self._log = AppendOnlyLog(self._path)
+        return self._log
+
     def get(self, key, default=None):
         """
         Retrieves a certain value for a given key
         """
+        if self._near_cache is not None:
+            value = self._near_cache.get(key)
+            if value is NearCache.NOT_CACHED:
+                token = self._near_cache.reserve(key)
+                value = self.gets(key, default=NearCache.MISSING)
+                self._near_cache.fill(key, value, token)
+            return default if value is NearCache.MISSING else value
         data = self._read()
         if key in data['t'] and data['t'][key] > time_module.time():
             value = data['s'].get(key)
-            return copy.deepcopy(value)
+            return copy_value(value)
         return default
 
     def gets(self, key, default=None):
@@ -82,7 +114,7 @@ class DummyVolatileStore(object):
         data = self._read()
         if key in data['t'] and data['t'][key] > time_module.time():
             value = data['s'].get(key)
-            return copy.deepcopy(value)
+            return copy_value(value)
         return default
 
     def set(self, key, value, time=99999999):
@@ -90,15 +122,19 @@ class DummyVolatileStore(object):
         Sets the value for a key to a given value
         """
         data = self._read()
-        data['s'][key] = copy.deepcopy(value)
+        data['s'][key] = copy_value(value)
         data['t'][key] = time_module.time() + time
-        self._save(data)
+        self._save(data, [key])
+        if self._near_cache is not None:
+            self._near_cache.set(key, value, time)
+        return True
 
     def add(self, key, value, time=99999999):
         """
         Adds a given key to the store, expecting the key does not exists yet
         """
         data = self._read()
+        self._invalidate(key)
         if key not in data['s']:
             self.set(key, value, time)
             return True
@@ -113,7 +149,9 @@ class DummyVolatileStore(object):
         if key in data['s']:
             del data['s'][key]
             del data['t'][key]
-            self._save(data)
+            self._save(data, [key])
+        self._invalidate(key)
+        return True
 
     def incr(self, key, delta=1):
         """
@@ -122,18 +160,98 @@ class DummyVolatileStore(object):
         data = self._read()
         if key in data['s']:
             data['s'][key] += delta
-            self._save(data)
+            self._save(data, [key])
+            self._invalidate(key)
             return True
         return False
 
-    def _save(self, data):
+    def get_multi(self, keys):
+        """
+        Retrieves the values for the given keys
+        """
+        if self._near_cache is not None:
+            values = {}
+            for key in keys:
+                value = self.get(key, default=NearCache.MISSING)
+                if value is not NearCache.MISSING:
+                    values[key] = value
+            return values
+        data = self._read()
+        now = time_module.time()
+        return dict((key, copy_value(data['s'].get(key))) for key in keys if key in data['t'] and data['t'][key] > now)
+
+    def set_multi(self, mapping, time=99999999):
+        """
+        Sets the values of multiple keys
+        """
+        data = self._read()
+        for key, value in mapping.iteritems():
+            data['s'][key] = copy_value(value)
+            data['t'][key] = time_module.time() + time
+        self._save(data, mapping.keys())
+        if self._near_cache is not None:
+            for key, value in mapping.iteritems():
+                self._near_cache.set(key, value, time)
+        return []
+
+    def delete_multi(self, keys):
+        """
+        Deletes the given keys from the store
+        """
+        data = self._read()
+        for key in keys:
+            if key in data['s']:
+                del data['s'][key]
+                del data['t'][key]
+        self._save(data, keys)
+        for key in keys:
+            self._invalidate(key)
+        return True
+
+    def _invalidate(self, key):
+        """
+        Removes a key from the near cache
+        """
+        if self._near_cache is not None:
+            self._near_cache.invalidate(key)
+
+    def get_near_cache_stats(self):
+        """
+        Returns the statistics of the near cache, see NearCache.get_stats
+        """
+        return None if self._near_cache is None else self._near_cache.get_stats()
+
+    def _save(self, data, keys=None):
         """
         Saves the local json file
+        :param data: The data to save
+        :type data: dict
+        :param keys: The changed keys. All data is saved when omitted
+        :type keys: list
         """
         if self._keep_in_memory_only is True:
             DummyVolatileStore._data = data
-        else:
-            rawdata = json.dumps(data, sort_keys=True, indent=2)
-            f = open(self._path, 'w+')
-            f.write(rawdata)
-            f.close()
+            return
+        self._file_data = data
+        log = self._get_log()
+        if keys is None:
+            self._compact()
+            return
+        records = []
+        for key in keys:
+            if key in data['s']:
+                data['s'][key] = json.loads(json.dumps(data['s'][key]))  # Values read back from the file as they would be
+                records.append({'k': key, 'v': data['s'][key], 't': data['t'][key]})
+            else:
+                records.append({'k': key})
+        log.append(records)
+        if log.records > max(self.COMPACTION_MINIMUM, 2 * len(data['s'])):
+            self._read()
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrites the local json file
+        """
+        data = self._file_data
+        self._get_log().rewrite([{'k': key, 'v': value, 't': data['t'][key]} for key, value in data['s'].iteritems()])
@@ -0,0 +1,127 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Consistent hashing module
+"""
+import time
+import struct
+import bisect
+import hashlib
+
+
+class HashRing(object):
+    """
+    Ketama style consistent hash ring. Every node is placed on the ring multiple times (virtual nodes), proportional to
+    its weight. A key belongs to the first node found walking the ring clockwise from the hash of the key, so adding
+    or removing a node only moves the keys of that node.
+    Nodes can be marked dead for a short period, during which their keys move to the next node on the ring.
+    """
+    POINTS_PER_HASH = 4  # Every md5 digest yields 4 points on the ring
+    POINT = struct.Struct('<I')
+
+    def __init__(self, nodes, vnodes=160, dead_retry=5):
+        # type: (List[Union[str, tuple]], int, int) -> None
+        """
+        Initializes a new HashRing
+        :param nodes: The nodes, either as name or as tuple (name, weight)
+        :type nodes: list
+        :param vnodes: Amount of virtual nodes for a node with weight 1
+        :type vnodes: int
+        :param dead_retry: Amount of seconds a node is skipped after being marked dead
+        :type dead_retry: int
+        """
+        self.dead_retry = dead_retry
+        self.nodes = []
+        self._dead = {}
+        points = {}
+        for node in nodes:
+            name, weight = node if isinstance(node, tuple) else (node, 1)
+            self.nodes.append(name)
+            for index in xrange(max(1, vnodes * weight / HashRing.POINTS_PER_HASH)):
+                digest = hashlib.md5('{0}-{1}'.format(name, index)).digest()
+                for offset in xrange(HashRing.POINTS_PER_HASH):
+                    points[HashRing.POINT.unpack_from(digest, offset * 4)[0]] = name
+        self._points = sorted(points)
+        self._owners = [points[point] for point in self._points]
+
+    @staticmethod
+    def _hash(key):
+        # type: (str) -> int
+        return HashRing.POINT.unpack_from(hashlib.md5(key).digest())[0]
+
+    def get_node(self, key):
+        # type: (str) -> Optional[str]
+        """
+        Returns the node the given key belongs to, skipping nodes which are marked dead
+        :param key: The key
+        :type key: str
+        :return: The node or None when all nodes are marked dead
+        :rtype: str
+        """
+        for node in self.iterate_nodes(key):
+            return node
+        return None
+
+    def iterate_nodes(self, key):
+        # type: (str) -> Iterator[str]
+        """
+        Yields the distinct alive nodes in the order they are found walking the ring from the given key
+        :param key: The key
+        :type key: str
+        :return: Iterator over the node names
+        """
+        if not self._points:
+            return
+        start = bisect.bisect(self._points, HashRing._hash(key))
+        seen = set()
+        for index in xrange(start, start + len(self._points)):
+            node = self._owners[index % len(self._points)]
+            if node in seen:
+                continue
+            seen.add(node)
+            if not self.is_dead(node):
+                yield node
+            if len(seen) == len(self.nodes):
+                return
+
+    def mark_dead(self, node):
+        # type: (str) -> None
+        """
+        Marks a node as dead for `dead_retry` seconds
+        :param node: Name of the node
+        :type node: str
+        :return: None
+        """
+        self._dead[node] = time.time() + self.dead_retry
+
+    def is_dead(self, node):
+        # type: (str) -> bool
+        """
+        Returns whether a node is currently marked dead
+        :param node: Name of the node
+        :type node: str
+        :return: True when the node is marked dead
+        :rtype: bool
+        """
+        until = self._dead.get(node)
+        if until is None:
+            return False
+        if until > time.time():
+            return True
+        self._dead.pop(node, None)
+        return False
@@ -22,7 +22,10 @@ import re
 import ujson
 import memcache
 from functools import wraps
-from threading import Lock
+from threading import local, Lock
+from ovs_extensions.generic.lockprofiler import ProfiledLock
+from ovs_extensions.storage.volatile.hashring import HashRing
+from ovs_extensions.storage.volatile.nearcache import NearCache
 
 
 def locked():
@@ -50,23 +53,92 @@ def locked():
     return wrap
 
 
+class RingClient(memcache.Client):
+    """
+    Memcache client distributing the keys over the nodes using a (shared) consistent hash ring instead of modulo hashing
+    """
+
+    def __init__(self, ring, servers, **kwargs):
+        """
+        Initializes the client
+        :param ring: The hash ring, shared between the clients of all threads
+        :type ring: ovs_extensions.storage.volatile.hashring.HashRing
+        :param servers: The memcache nodes, matching the nodes of the ring
+        :type servers: list
+        """
+        super(RingClient, self).__init__(servers, **kwargs)
+        self._ring = ring
+        self._servers = dict(zip(ring.nodes, self.servers))
+        for node, server in self._servers.iteritems():
+            server.mark_dead = self._get_mark_dead(node, server.mark_dead)
+
+    def _get_mark_dead(self, node, mark_dead):
+        """
+        Wraps the dead marking of a server, so failures during requests are shared with the other threads immediately
+        """
+        def _mark_dead(reason):
+            self._ring.mark_dead(node)
+            mark_dead(reason)
+        return _mark_dead
+
+    def _get_server(self, key):
+        """
+        Returns the server a key belongs to. Servers which can't be reached are marked dead on the ring, so their keys
+        temporarily move to the next server on the ring and other threads don't wait for the same server
+        """
+        if isinstance(key, tuple):
+            key = key[1]
+        for node in self._ring.iterate_nodes(key):
+            server = self._servers[node]
+            if server.connect():
+                return server, key
+            self._ring.mark_dead(node)
+        return None, None
+
+
 class MemcacheStore(object):
     """
     Memcache client wrapper:
     * stringifies the keys
+    * uses a client (and thus a set of connections) per thread, so threads don't wait on each other
+    * distributes the keys using a consistent hash ring: when a node is added or removed, only its share of keys moves.
+      Nodes which can't be reached are skipped for DEAD_RETRY seconds
+    * optionally keeps recently used values in an in-process near cache. `gets`, `cas`, `add` and `incr` always go to
+      memcache, so compare-and-set flows and mutexes are not affected by it
     """
 
     COMPRESSION_THRESHOLD = 1 * 1024 * 1024
+    DEAD_RETRY = 5
 
-    def __init__(self, nodes):
+    def __init__(self, nodes, near_cache_size=0, near_cache_ttl=1.0):
         """
         Initializes the client
+        :param nodes: The memcache nodes
+        :type nodes: list
+        :param near_cache_size: Amount of keys to keep in the in-process near cache. 0 disables the near cache
+        :type near_cache_size: int
+        :param near_cache_ttl: Maximum amount of seconds a value is kept in the near cache
+        :type near_cache_ttl: float
         """
         self._nodes = nodes
-        self._client = memcache.Client(self._nodes, cache_cas=True, socket_timeout=0.5)
-        self._lock = Lock()
+        self._near_cache = NearCache(max_entries=near_cache_size, ttl=near_cache_ttl) if near_cache_size > 0 else None
+        self._ring = HashRing(nodes, dead_retry=MemcacheStore.DEAD_RETRY)
+        self._clients = local()
+        self._lock = ProfiledLock(Lock(), 'memcache_incr')  # Only guards the read-modify-write of incr
         self._validate = True
 
+    @property
+    def _client(self):
+        """
+        Returns the memcache client of the current thread.
+        The CAS identifiers are tracked per client, so a `gets` and its `cas` have to be executed by the same thread
+        """
+        client = getattr(self._clients, 'client', None)
+        if client is None:
+            client = RingClient(self._ring, self._nodes, cache_cas=True, socket_timeout=0.5, dead_retry=MemcacheStore.DEAD_RETRY)
+            self._clients.client = client
+        return client
+
     def _get(self, action, key, default=None):
         """
         Retrieves a certain value for a given key (get or gets)
@@ -79,6 +151,12 @@ class MemcacheStore(object):
         if data is None:
             # Cache miss
             return default
+        return self._decode(key, data)
+
+    def _decode(self, key, data):
+        """
+        Decodes the data stored for a given (cleaned) key
+        """
         data = ujson.loads(data)
         if self._validate:
             if data['key'] == key:
@@ -88,14 +166,31 @@ class MemcacheStore(object):
         else:
             return data
 
-    @locked()
+    def _encode(self, key, value):
+        """
+        Encodes a value to store for a given (cleaned) key
+        """
+        if self._validate:
+            data = {'value': value,
+                    'key': key}
+        else:
+            data = value
+        return ujson.dumps(data)
+
     def get(self, key, default=None):
         """
         Retrieves a certain value for a given key (get)
         """
-        return self._get('get', key, default=default)
+        if self._near_cache is None:
+            return self._get('get', key, default=default)
+        key = MemcacheStore._clean_key(key)
+        value = self._near_cache.get(key)
+        if value is NearCache.NOT_CACHED:
+            token = self._near_cache.reserve(key)
+            value = self._get('get', key, default=NearCache.MISSING)
+            self._near_cache.fill(key, value, token)
+        return default if value is NearCache.MISSING else value
 
-    @locked()
     def gets(self, key, default=None):
         """
         Retrieves a certain value for a given key (gets)
@@ -107,43 +202,41 @@ class MemcacheStore(object):
         Sets the value for a key to a given value
         """
         key = MemcacheStore._clean_key(key)
-        if self._validate:
-            data = {'value': value,
-                    'key': key}
-        else:
-            data = value
-        data = ujson.dumps(data)
+        data = self._encode(key, value)
         if action == 'set':
             return self._client.set(key, data, time, min_compress_len=MemcacheStore.COMPRESSION_THRESHOLD)
         return self._client.cas(key, data, time, min_compress_len=MemcacheStore.COMPRESSION_THRESHOLD)
 
-    @locked()
     def set(self, key, value, time=0):
         """
         Sets the value for a key to a given value (set)
         """
-        return self._set('set', key, value, time=time)
+        result = self._set('set', key, value, time=time)
+        if self._near_cache is not None:
+            if result:
+                self._near_cache.set(MemcacheStore._clean_key(key), value, time)
+            else:
+                self._near_cache.invalidate(MemcacheStore._clean_key(key))
+        return result
 
-    @locked()
     def cas(self, key, value, time=0):
         """
         Sets the value for a key to a given value (cas)
         """
-        return self._set('cas', key, value, time=time)
+        try:
+            return self._set('cas', key, value, time=time)
+        finally:
+            self._invalidate(key)  # Afterwards, so a concurrent miss can't cache the previous value
 
-    @locked()
     def add(self, key, value, time=0):
         """
         Adds a given key to the store, expecting the key does not exists yet
         """
         key = MemcacheStore._clean_key(key)
-        if self._validate:
-            data = {'value': value,
-                    'key': key}
-        else:
-            data = value
-        data = ujson.dumps(data)
-        return self._client.add(key, data, time)
+        try:
+            return self._client.add(key, self._encode(key, value), time)
+        finally:
+            self._invalidate(key)
 
     @locked()
     def incr(self, key, delta=1):
@@ -151,22 +244,112 @@ class MemcacheStore(object):
         Increments the value of the key, expecting it exists
         """
         if self._validate:
-            value = self.get(key, lock=False)
+            value = self._get('get', key)
             if value is not None:
                 value += delta
             else:
                 value = 1
-            self.set(key, value, 60, lock=False)
+            self.set(key, value, 60)
             return True
         else:
-            return self._client.incr(MemcacheStore._clean_key(key), delta)
+            try:
+                return self._client.incr(MemcacheStore._clean_key(key), delta)
+            finally:
+                self._invalidate(key)
 
-    @locked()
     def delete(self, key):
         """
         Deletes a given key from the store
         """
-        return self._client.delete(MemcacheStore._clean_key(key))
+        try:
+            return self._client.delete(MemcacheStore._clean_key(key))
+        finally:
+            self._invalidate(key)
+
+    def get_multi(self, keys):
+        """
+        Retrieves the values for the given keys, using a single request per memcache node
+        :param keys: The keys to retrieve
+        :type keys: list
+        :return: The values of the keys which were found, keyed by the given keys
+        :rtype: dict
+        """
+        cleaned_keys = dict((MemcacheStore._clean_key(key), key) for key in keys)
+        values = {}
+        if self._near_cache is not None:
+            for cleaned_key in cleaned_keys.keys():
+                value = self._near_cache.get(cleaned_key)
+                if value is not NearCache.NOT_CACHED:
+                    if value is not NearCache.MISSING:
+                        values[cleaned_keys[cleaned_key]] = value
+                    del cleaned_keys[cleaned_key]
+        if len(cleaned_keys) == 0:
+            return values
+        tokens = {}
+        if self._near_cache is not None:
+            tokens = dict((cleaned_key, self._near_cache.reserve(cleaned_key)) for cleaned_key in cleaned_keys)
+        data = self._client.get_multi(cleaned_keys.keys())
+        for cleaned_key, key in cleaned_keys.iteritems():
+            value = self._decode(cleaned_key, data[cleaned_key]) if cleaned_key in data else NearCache.MISSING
+            if self._near_cache is not None:
+                self._near_cache.fill(cleaned_key, value, tokens[cleaned_key])
+            if value is not NearCache.MISSING:
+                values[key] = value
+        return values
+
+    def set_multi(self, mapping, time=0):
+        """
+        Sets the values of multiple keys, using a single request per memcache node
+        :param mapping: The values to set, keyed by their key
+        :type mapping: dict
+        :param time: Expiration time of the keys
+        :type time: int
+        :return: The keys which could not be stored
+        :rtype: list
+        """
+        cleaned_keys = {}
+        data = {}
+        for key, value in mapping.iteritems():
+            cleaned_key = MemcacheStore._clean_key(key)
+            cleaned_keys[cleaned_key] = key
+            data[cleaned_key] = self._encode(cleaned_key, value)
+        failed_keys = self._client.set_multi(data, time, min_compress_len=MemcacheStore.COMPRESSION_THRESHOLD)
+        if self._near_cache is not None:
+            for cleaned_key, key in cleaned_keys.iteritems():
+                if cleaned_key in failed_keys:
+                    self._near_cache.invalidate(cleaned_key)
+                else:
+                    self._near_cache.set(cleaned_key, mapping[key], time)
+        return [cleaned_keys[key] for key in failed_keys]
+
+    def delete_multi(self, keys):
+        """
+        Deletes the given keys from the store, using a single request per memcache node
+        :param keys: The keys to delete
+        :type keys: list
+        :return: True when all memcache nodes could be reached
+        :rtype: bool
+        """
+        try:
+            return self._client.delete_multi([MemcacheStore._clean_key(key) for key in keys]) == 1
+        finally:
+            for key in keys:
+                self._invalidate(key)
+
+    def _invalidate(self, key):
+        """
+        Removes a key from the near cache
+        """
+        if self._near_cache is not None:
+            self._near_cache.invalidate(MemcacheStore._clean_key(key))
+
+    def get_near_cache_stats(self):
+        """
+        Returns the statistics of the near cache, see NearCache.get_stats
+        :return: The statistics or None when the near cache is disabled
+        :rtype: dict
+        """
+        return None if self._near_cache is None else self._near_cache.get_stats()
 
     @staticmethod
     def _clean_key(key):
@@ -0,0 +1,209 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Near cache module
+"""
+import copy
+import time as time_module
+from collections import OrderedDict
+from threading import Lock
+
+
+class NearCache(object):
+    """
+    Bounded, in-process LRU cache with short time-to-live values, placed in front of a volatile store.
+    * Entries never live longer than `ttl` seconds, nor longer than the expiration time they were stored with
+    * Keys which are not present in the store are cached as well (negative caching)
+    * Mutable values are copied when returned, so callers can't alter the cached values
+    Values are not shared between processes: within the time-to-live, changes made by other processes are not seen.
+    Values fetched from the store after a miss are cached through `reserve` and `fill`: a fill is dropped when the key
+    was changed in the meantime, so a slow read never overwrites a newer value set by this process.
+    """
+    NOT_CACHED = object()  # Returned when a key is not in the near cache
+    MISSING = object()  # Returned when a key is cached as not being present in the store
+    IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None))
+
+    def __init__(self, max_entries=1024, ttl=1.0, negative_ttl=None):
+        # type: (int, float, Optional[float]) -> None
+        """
+        Initializes a new NearCache
+        :param max_entries: Maximum amount of cached keys
+        :type max_entries: int
+        :param ttl: Maximum amount of seconds a value is cached
+        :type ttl: float
+        :param negative_ttl: Maximum amount of seconds the absence of a key is cached. Defaults to `ttl`
+        :type negative_ttl: float
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._lock = Lock()
+        self._entries = OrderedDict()  # Key -> (expiration, value)
+        self._reservations = OrderedDict()  # Key -> token of the last reservation
+        self._generation = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # type: (str) -> any
+        """
+        Returns the cached value of a key
+        :param key: The key
+        :type key: str
+        :return: The value, MISSING when the key is cached as absent or NOT_CACHED when the key is not cached
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time_module.time():
+                self.misses += 1
+                return NearCache.NOT_CACHED
+            self._entries[key] = entry
+            value = entry[1]
+            if value is NearCache.MISSING:
+                self.negative_hits += 1
+                return value
+            self.hits += 1
+        if isinstance(value, NearCache.IMMUTABLE_TYPES):
+            return value
+        return copy.deepcopy(value)
+
+    def set(self, key, value, time=0):
+        # type: (str, any, int) -> None
+        """
+        Caches a value
+        :param key: The key
+        :type key: str
+        :param value: The value, or MISSING to cache that the key is absent
+        :type value: any
+        :param time: Expiration time the value was stored with in the volatile store. 0 for no expiration
+        :type time: int
+        :return: None
+        """
+        entry = self._build_entry(value, time)
+        with self._lock:
+            self._reservations.pop(key, None)
+            self._entries.pop(key, None)
+            if entry is not None:
+                self._store(key, entry)
+
+    def reserve(self, key):
+        # type: (str) -> int
+        """
+        Registers that the value of a key will be fetched from the store after a miss
+        :param key: The key
+        :type key: str
+        :return: Token to pass to `fill`
+        :rtype: int
+        """
+        with self._lock:
+            self._generation += 1
+            self._reservations.pop(key, None)
+            self._reservations[key] = self._generation
+            while len(self._reservations) > self.max_entries:
+                self._reservations.popitem(last=False)
+            return self._generation
+
+    def fill(self, key, value, token, time=0):
+        # type: (str, any, int, int) -> bool
+        """
+        Caches a value fetched from the store after a miss, unless the key was changed since it was reserved
+        :param key: The key
+        :type key: str
+        :param value: The value, or MISSING to cache that the key is absent
+        :type value: any
+        :param token: Token returned by `reserve`
+        :type token: int
+        :param time: Expiration time the value was stored with in the volatile store. 0 for no expiration
+        :type time: int
+        :return: Whether the value was cached
+        :rtype: bool
+        """
+        entry = self._build_entry(value, time)
+        with self._lock:
+            if self._reservations.get(key) != token:
+                return False
+            del self._reservations[key]
+            if entry is None:
+                return False
+            self._store(key, entry)
+            return True
+
+    def _build_entry(self, value, time):
+        # type: (any, int) -> Optional[tuple]
+        """
+        Builds the cache entry of a value
+        :return: The expiration time and the (copied) value or None when the value shouldn't be cached
+        :rtype: tuple
+        """
+        ttl = self.negative_ttl if value is NearCache.MISSING else self.ttl
+        if time > 0:
+            ttl = min(ttl, time)
+        if ttl <= 0:
+            return None
+        if not isinstance(value, NearCache.IMMUTABLE_TYPES) and value is not NearCache.MISSING:
+            value = copy.deepcopy(value)
+        return time_module.time() + ttl, value
+
+    def _store(self, key, entry):
+        # type: (str, tuple) -> None
+        """
+        Stores an entry, evicting the least recently used entries. Must be called while holding the lock
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        # type: (str) -> None
+        """
+        Removes a key from the cache
+        :param key: The key
+        :type key: str
+        :return: None
+        """
+        with self._lock:
+            self._reservations.pop(key, None)
+            self._entries.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+        """
+        Removes all keys from the cache
+        :return: None
+        """
+        with self._lock:
+            self._reservations.clear()
+            self._entries.clear()
+
+    def get_stats(self):
+        # type: () -> dict
+        """
+        Returns the statistics of the near cache
+        :return: The amount of hits, negative hits and misses, the hit ratio (including negative hits) and the amount of cached keys
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {'hits': self.hits,
+                    'negative_hits': self.negative_hits,
+                    'misses': self.misses,
+                    'hit_ratio': (self.hits + self.negative_hits) / float(lookups) if lookups > 0 else 0.0,
+                    'entries': len(self._entries)}
+
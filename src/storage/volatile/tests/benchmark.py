@@ -0,0 +1,94 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Throughput benchmark for the MemcacheStore. Run as a module:
+python -m ovs_extensions.storage.volatile.tests.benchmark [memcache address]
+Without address, a local MemcacheServer is started in a separate process. As that server is written in Python,
+absolute numbers are low; run against a real memcached for representative numbers.
+"""
+import sys
+import time
+from multiprocessing import Process, Queue
+from threading import Lock, Thread
+from ovs_extensions.storage.volatile.memcachestore import MemcacheStore
+from ovs_extensions.storage.volatile.tests.memcacheserver import MemcacheServer
+
+
+def run(address, threads, operations=2000, global_lock=False):
+    """
+    Executes get/set pairs from the given amount of threads
+    :param address: Address of the memcache server
+    :type address: str
+    :param threads: Amount of threads
+    :type threads: int
+    :param operations: Amount of get/set pairs per thread
+    :type operations: int
+    :param global_lock: Serialize all calls on one lock, as the MemcacheStore did before it used a client per thread
+    :type global_lock: bool
+    :return: Operations per second
+    :rtype: float
+    """
+    store = MemcacheStore([address])
+    lock = Lock()
+
+    def _run(thread_id):
+        for index in xrange(operations):
+            key = 'benchmark_{0}_{1}'.format(thread_id, index % 100)
+            if global_lock is True:
+                with lock:
+                    store.set(key, index)
+                with lock:
+                    store.get(key)
+            else:
+                store.set(key, index)
+                store.get(key)
+
+    workers = [Thread(target=_run, args=(thread_id,)) for thread_id in xrange(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * operations * 2 / (time.time() - start)
+
+
+def _serve(queue):
+    """
+    Runs a MemcacheServer, reporting its address on the given queue
+    """
+    server = MemcacheServer()
+    queue.put(server.address)
+    server.start()._thread.join()
+
+
+if __name__ == '__main__':
+    _server = None
+    if len(sys.argv) > 1:
+        _address = sys.argv[1]
+    else:
+        _queue = Queue()
+        _server = Process(target=_serve, args=(_queue,))
+        _server.daemon = True
+        _server.start()
+        _address = _queue.get()
+    for _threads in [1, 8, 32]:
+        _before = run(_address, _threads, global_lock=True)
+        _after = run(_address, _threads)
+        print '{0:>2} threads  global lock: {1:>8.0f} ops/s  per-thread clients: {2:>8.0f} ops/s'.format(_threads, _before, _after)
+    if _server is not None:
+        _server.terminate()
@@ -0,0 +1,196 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Local stand-in for a memcached server, speaking the memcached text protocol
+"""
+import time
+import socket
+import SocketServer
+from threading import Lock, Thread
+
+
+class MemcacheServer(object):
+    """
+    In-process server implementing the subset of the memcached text protocol used by the memcache clients:
+    get, gets, set, add, replace, cas, delete, incr, decr, touch, flush_all, version and stats
+    """
+    RELATIVE_EXPIRATION_LIMIT = 60 * 60 * 24 * 30  # Larger expiration times are unix timestamps
+
+    def __init__(self, host='127.0.0.1', port=0):
+        """
+        Initializes a new server. Port 0 binds to a free port
+        """
+        self._lock = Lock()
+        self._data = {}  # Key -> [flags, data, expiration, cas identifier]
+        self._cas_counter = 0
+        self._server = SocketServer.ThreadingTCPServer((host, port), self._get_handler(), bind_and_activate=False)
+        self._server.daemon_threads = True
+        self._server.allow_reuse_address = True
+        self._server.server_bind()
+        self._server.server_activate()
+        self._thread = None
+        self.available = True  # When False, connections are closed without a reply
+
+    @property
+    def address(self):
+        """
+        Address of the server, in the format used by the memcache clients
+        """
+        return '{0}:{1}'.format(*self._server.server_address)
+
+    def start(self):
+        """
+        Starts serving in a background thread
+        """
+        self._thread = Thread(target=self._server.serve_forever, name='memcache-server')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops serving and closes the listening socket
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def keys(self):
+        """
+        Returns the keys currently stored
+        """
+        with self._lock:
+            return [key for key in self._data if self._get_entry(key) is not None]
+
+    def _get_entry(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[2] != 0 and entry[2] <= time.time():
+            del self._data[key]
+            return None
+        return entry
+
+    def _get_expiration(self, expiration):
+        expiration = int(expiration)
+        if expiration == 0:
+            return 0
+        if expiration < 0:
+            return -1
+        if expiration <= MemcacheServer.RELATIVE_EXPIRATION_LIMIT:
+            return time.time() + expiration
+        return expiration
+
+    def _store(self, command, key, flags, expiration, data, cas_identifier=None):
+        with self._lock:
+            entry = self._get_entry(key)
+            if command == 'add' and entry is not None:
+                return 'NOT_STORED'
+            if command == 'replace' and entry is None:
+                return 'NOT_STORED'
+            if command == 'cas':
+                if entry is None:
+                    return 'NOT_FOUND'
+                if entry[3] != cas_identifier:
+                    return 'EXISTS'
+            self._cas_counter += 1
+            self._data[key] = [flags, data, self._get_expiration(expiration), self._cas_counter]
+            return 'STORED'
+
+    def _execute(self, parts, read_data):
+        """
+        Executes a single command and returns the response
+        """
+        command = parts[0]
+        if command in ['get', 'gets']:
+            response = []
+            with self._lock:
+                for key in parts[1:]:
+                    entry = self._get_entry(key)
+                    if entry is None:
+                        continue
+                    header = 'VALUE {0} {1} {2}'.format(key, entry[0], len(entry[1]))
+                    if command == 'gets':
+                        header += ' {0}'.format(entry[3])
+                    response.extend([header, entry[1]])
+            return '\r\n'.join(response + ['END'])
+        if command in ['set', 'add', 'replace', 'cas']:
+            noreply = parts[-1] == 'noreply'
+            data = read_data(int(parts[4]))
+            result = self._store(command, parts[1], parts[2], parts[3], data, int(parts[5]) if command == 'cas' else None)
+            return None if noreply else result
+        if command == 'delete':
+            with self._lock:
+                found = self._get_entry(parts[1]) is not None
+                self._data.pop(parts[1], None)
+            return None if parts[-1] == 'noreply' else ('DELETED' if found else 'NOT_FOUND')
+        if command in ['incr', 'decr']:
+            with self._lock:
+                entry = self._get_entry(parts[1])
+                if entry is None:
+                    result = 'NOT_FOUND'
+                else:
+                    value = int(entry[1]) + (int(parts[2]) if command == 'incr' else -int(parts[2]))
+                    self._cas_counter += 1
+                    entry[1], entry[3] = str(max(value, 0)), self._cas_counter
+                    result = entry[1]
+            return None if parts[-1] == 'noreply' else result
+        if command == 'touch':
+            with self._lock:
+                entry = self._get_entry(parts[1])
+                if entry is not None:
+                    entry[2] = self._get_expiration(parts[2])
+            return 'TOUCHED' if entry is not None else 'NOT_FOUND'
+        if command == 'flush_all':
+            with self._lock:
+                self._data.clear()
+            return 'OK'
+        if command == 'version':
+            return 'VERSION 1.4.0-standin'
+        if command == 'stats':
+            return 'END'
+        return 'ERROR'
+
+    def _get_handler(self):
+        server = self
+
+        class _Handler(SocketServer.StreamRequestHandler):
+            """
+            Handles a single client connection
+            """
+            def handle(self):
+                def _read_data(length):
+                    return self.rfile.read(length + 2)[:-2]
+
+                while True:
+                    try:
+                        line = self.rfile.readline()
+                    except socket.error:
+                        return
+                    if not line:
+                        return
+                    if server.available is False:
+                        return
+                    parts = line.strip().split()
+                    if not parts:
+                        continue
+                    response = server._execute(parts, _read_data)
+                    if response is not None:
+                        try:
+                            self.wfile.write(response + '\r\n')
+                            self.wfile.flush()
+                        except socket.error:
+                            return
+        return _Handler
@@ -0,0 +1,258 @@
+# Copyright (C) 2018 iNuron NV
+#
+# This file is part of Open vStorage Open Source Edition (OSE),
+# as available from
+#
+#      http://www.openvstorage.org and
+#      http://www.openvstorage.com.
+#
+# This file is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License v3 (GNU AGPLv3)
+# as published by the Free Software Foundation, in version 3 as it comes
+# in the LICENSE.txt file of the Open vStorage OSE distribution.
+#
+# Open vStorage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY of any kind.
+
+
+"""
+Test module for the MemcacheStore
+"""
+import time
+import socket
+import unittest
+from threading import Event, Thread
+from ovs_extensions.storage.volatile.dummystore import DummyVolatileStore
+from ovs_extensions.storage.volatile.hashring import HashRing
+from ovs_extensions.storage.volatile.memcachestore import MemcacheStore
+from ovs_extensions.storage.volatile.tests.memcacheserver import MemcacheServer
+
+
+class MemcacheStoreTest(unittest.TestCase):
+    """
+    Test the MemcacheStore against a local memcache server
+    """
+
+    def setUp(self):
+        """
+        Starts a memcache server
+        """
+        self.server = MemcacheServer().start()
+        self.store = MemcacheStore([self.server.address])
+
+    def tearDown(self):
+        """
+        Stops the memcache server
+        """
+        self.server.stop()
+
+    def test_single_key(self):
+        """
+        Validates the single key operations
+        """
+        self.assertIsNone(self.store.get('foo'))
+        self.assertEqual(self.store.get('foo', default=1), 1)
+        self.assertTrue(self.store.set('foo', {'bar': [1, 2]}))
+        self.assertEqual(self.store.get('foo'), {'bar': [1, 2]})
+        self.assertFalse(self.store.add('foo', 'baz'))
+        self.assertTrue(self.store.add('bar', 'baz'))
+        self.assertEqual(self.store.get('b a\nr'), 'baz')  # Keys are cleaned
+        self.assertEqual(self.store.gets('foo'), {'bar': [1, 2]})
+        self.assertTrue(self.store.cas('foo', 'changed'))
+        self.assertFalse(self.store.cas('foo', 'changed again'))
+        self.assertEqual(self.store.get('foo'), 'changed')
+        self.assertTrue(self.store.incr('counter'))
+        self.assertTrue(self.store.incr('counter', 2))
+        self.assertEqual(self.store.get('counter'), 3)
+        self.assertTrue(self.store.delete('foo'))
+        self.assertIsNone(self.store.get('foo'))
+
+    def test_multi_key(self):
+        """
+        Validates the multi key operations
+        """
+        self.assertEqual(self.store.set_multi({'foo': 1, 'b a r': [2], 3: {'baz': 3}}), [])
+        self.assertEqual(self.store.get_multi(['foo', 'b a r', 3, 'missing']), {'foo': 1, 'b a r': [2], 3: {'baz': 3}})
+        self.assertEqual(self.store.get('bar'), [2])
+        self.assertTrue(self.store.delete_multi(['foo', 3]))
+        self.assertEqual(self.store.get_multi(['foo', 'bar', 3]), {'bar': [2]})
+
+    def test_threads(self):
+        """
+        Validates that concurrent threads each use their own client
+        """
+        clients = []
+        errors = []
+
+        def _run(thread_id):
+            clients.append(self.store._client)
+            for index in xrange(50):
+                key = 'key_{0}_{1}'.format(thread_id, index)
+                self.store.set(key, index)
+                if self.store.get(key) != index:
+                    errors.append(key)
+
+        threads = [Thread(target=_run, args=(thread_id,)) for thread_id in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(id(client) for client in clients)), 8)
+        self.assertEqual(len(self.server.keys()), 400)
+
+    def test_near_cache(self):
+        """
+        Validates the near cache in front of the memcache and the dummy store
+        """
+        store = MemcacheStore([self.server.address], near_cache_size=2, near_cache_ttl=0.5)
+        other_store = MemcacheStore([self.server.address])  # Another process, writing without near cache
+        self.assertEqual(store.get_near_cache_stats()['entries'], 0)
+        self.assertIsNone(other_store.get_near_cache_stats())
+
+        self.assertIsNone(store.get('foo'))
+        other_store.set('foo', 1)
+        self.assertIsNone(store.get('foo'))  # The absence of the key is cached
+        self.assertTrue(store.set('foo', {'bar': 1}))
+        value = store.get('foo')
+        value['bar'] = 2  # Changing a returned value doesn't change the cached value
+        self.assertEqual(store.get('foo'), {'bar': 1})
+        other_store.set('foo', 'changed')
+        self.assertEqual(store.get('foo'), {'bar': 1})
+        self.assertEqual(store.gets('foo'), 'changed')  # Gets bypasses the near cache
+        self.assertTrue(store.cas('foo', 'cas'))  # Cas invalidates the near cache
+        other_store.set('foo', 'changed again')
+        self.assertEqual(store.get('foo'), 'changed again')
+        stats = store.get_near_cache_stats()
+        self.assertEqual((stats['hits'], stats['negative_hits'], stats['misses'], stats['entries']), (3, 1, 2, 1))
+        self.assertAlmostEqual(stats['hit_ratio'], 4 / 6.0)
+
+        store.set('short', 1, time=1)  # The memcache expiration time bounds the near cache time-to-live
+        self.assertLessEqual(store._near_cache._entries['short'][0] - time.time(), 0.5)
+        time.sleep(0.5)
+        other_store.set('foo', 'expired')
+        self.assertEqual(store.get('foo'), 'expired')
+        store.set_multi({'a': 1, 'b': 2})  # The near cache is bounded
+        self.assertEqual(store._near_cache._entries.keys(), ['a', 'b'])
+        other_store.delete('a')
+        self.assertEqual(store.get_multi(['a', 'b', 'c']), {'a': 1, 'b': 2})
+        self.assertTrue(store.delete_multi(['a', 'b']))
+        self.assertEqual(store.get_multi(['a', 'b']), {})
+        store.incr('counter')
+        store.incr('counter')
+        self.assertEqual(store.get('counter'), 2)
+
+        dummy_store = DummyVolatileStore(near_cache_size=10, near_cache_ttl=10)
+        dummy_store._clean()
+        self.assertIsNone(dummy_store.get('foo'))
+        DummyVolatileStore().set('foo', 1)
+        self.assertIsNone(dummy_store.get('foo'))
+        self.assertEqual(dummy_store.gets('foo'), 1)
+        dummy_store.set('foo', [2])
+        self.assertEqual(dummy_store.get_multi(['foo', 'bar']), {'foo': [2]})
+        dummy_store.delete('foo')
+        self.assertIsNone(dummy_store.get('foo'))
+        self.assertEqual(dummy_store.get_near_cache_stats()['negative_hits'], 1)
+        dummy_store._clean()
+
+    def test_near_cache_slow_miss(self):
+        """
+        Validates that a slow miss doesn't overwrite a value set in the meantime by the same process
+        """
+        store = MemcacheStore([self.server.address], near_cache_size=10, near_cache_ttl=10)
+        dummy_store = DummyVolatileStore(near_cache_size=10, near_cache_ttl=10)
+        dummy_store._clean()
+        for volatile, read_method, key in [(store, '_get', 'foo'), (dummy_store, 'gets', 'bar')]:
+            volatile.set(key, 'old')
+            volatile._near_cache.invalidate(key)
+            fetching = Event()
+            proceed = Event()
+            read = getattr(volatile, read_method)
+
+            def _slow_read(*args, **kwargs):
+                value = read(*args, **kwargs)
+                fetching.set()
+                proceed.wait(5)
+                return value
+
+            setattr(volatile, read_method, _slow_read)
+            values = []
+            thread = Thread(target=lambda: values.append(volatile.get(key)))
+            thread.start()
+            fetching.wait(5)
+            volatile.set(key, 'new')  # Set while the other thread is still fetching the old value
+            proceed.set()
+            thread.join()
+            delattr(volatile, read_method)
+            self.assertEqual(values, ['old'])
+            self.assertEqual(volatile.get(key), 'new')
+
+            volatile._near_cache.invalidate(key)
+            fetching.clear()
+            proceed.clear()
+            setattr(volatile, read_method, _slow_read)
+            thread = Thread(target=volatile.get, args=(key,))
+            thread.start()
+            fetching.wait(5)
+            volatile.delete(key)  # Deleted while the other thread is still fetching
+            proceed.set()
+            thread.join()
+            delattr(volatile, read_method)
+            self.assertIsNone(volatile.get(key))
+        dummy_store._clean()
+
+    def test_hash_ring(self):
+        """
+        Validates that removing a node from the ring only moves the keys of that node
+        """
+        nodes = ['10.100.1.{0}:11211'.format(index) for index in xrange(10)]
+        keys = ['ovs_key_{0}'.format(index) for index in xrange(10000)]
+        ring = HashRing(nodes)
+        before = dict((key, ring.get_node(key)) for key in keys)
+        distribution = [before.values().count(node) for node in nodes]
+        self.assertGreater(min(distribution), 500)
+        self.assertLess(max(distribution), 1500)
+
+        smaller_ring = HashRing(nodes[:5] + nodes[6:])
+        moved = [key for key in keys if smaller_ring.get_node(key) != before[key]]
+        self.assertEqual(set(before[key] for key in moved), set([nodes[5]]))
+        self.assertLess(len(moved) / float(len(keys)), 0.15)
+
+        ring.mark_dead(nodes[5])  # Marking a node dead moves its keys the same way
+        self.assertEqual([key for key in keys if ring.get_node(key) != before[key]], moved)
+        self.assertEqual(len(list(ring.iterate_nodes('foo'))), 9)
+
+    def test_dead_node(self):
+        """
+        Validates that requests for keys of an unresponsive node only wait for that node once
+        """
+        unresponsive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Accepts connections but never replies
+        unresponsive.bind(('127.0.0.1', 0))
+        unresponsive.listen(100)
+        try:
+            address = '{0}:{1}'.format(*unresponsive.getsockname())
+            store = MemcacheStore([self.server.address, address])
+            keys = ['key_{0}'.format(index) for index in xrange(100)]
+            self.assertGreater(len([key for key in keys if store._ring.get_node(key) == address]), 20)
+
+            durations = []
+            failures = []
+
+            def _run():
+                start = time.time()
+                for key in keys:
+                    if not store.set(key, key):
+                        failures.append(key)
+                durations.append(time.time() - start)
+
+            threads = [Thread(target=_run) for _ in xrange(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertLess(max(durations), 2)  # The socket timeout is 0.5 seconds
+            self.assertTrue(store._ring.is_dead(address))
+            self.assertLessEqual(len(failures), 4)  # Only the request detecting the unresponsive node fails
+            self.assertEqual(set(keys) - set(store.get_multi(keys)), set(key for key in failures if failures.count(key) == 4))
+        finally:
+            unresponsive.close()